@@ -1,7 +1,9 @@
+import json
+import os
+
 import numpy as np
 
 #from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
 
 from nn_logging import getLogger
 logger = getLogger()
@@ -29,6 +31,7 @@ def cnn_data(filename):
   return the_image_pixels, the_image_channels, the_labels, the_parameters
 
 def cnn_data_split(filename, test_size=0.5, shuffle=True, nentries=None):
+  from sklearn.model_selection import train_test_split
   images_px, images_ch, labels, parameters = cnn_data(filename)
 
   if nentries is not None:
@@ -42,8 +45,7 @@ def cnn_data_split(filename, test_size=0.5, shuffle=True, nentries=None):
 
 
 # ______________________________________________________________________________
-from cnn_globals import (superstrip_size, n_zones, rows_per_zone, n_rows, n_columns, n_channels, n_classes)
-from keras.utils import to_categorical
+from cnn_globals import (superstrip_size, n_zones, rows_per_zone, n_rows, n_columns, n_channels, n_classes, sector_hits_capacity)
 
 def parse_image_fn(pixels, channels):
   n = pixels.shape[0]
@@ -59,8 +61,216 @@ def parse_image_fn(pixels, channels):
   image[pixels[mask,0], pixels[mask,1]] = np.column_stack((channels[mask,0],1-channels[mask,0]))
   return image
 
+def parse_image_batch_fn(pixels, channels):
+  # Same as parse_image_fn, for a batch of images
+  n = pixels.shape[0]
+  assert(pixels.shape[1:] == (pixels.shape[1],2))
+  assert(channels.shape[1:] == (pixels.shape[1],n_channels))
+
+  bad_pixel = -99
+  mask = (pixels[:,:,0] != bad_pixel)
+  sample = np.broadcast_to(np.arange(n)[:,np.newaxis], mask.shape)[mask]
+
+  image_shape = (n_rows, n_columns, n_channels)
+  images = np.zeros((n,) + image_shape, dtype=channels.dtype)
+  images[sample, pixels[mask][:,0], pixels[mask][:,1]] = np.column_stack((channels[mask][:,0],1-channels[mask][:,0]))
+  return images
+
 def parse_label_fn(labels):
   assert(labels.shape == (3,))
+  from keras.utils import to_categorical
   lb = labels[:1]
   lb = to_categorical(lb[0], num_classes=n_classes)  # in Keras, use one-hot encoding
   return lb
+
+
+# ______________________________________________________________________________
+# Batched augmentation of the sparse images
+
+class SparseImageAugmenter(object):
+  """Random phi translations and mirror flips of a batch of sparse images.
+
+  Works on (image_pixels, image_channels, labels[, parameters]) as stored in
+  the npz files, for the whole batch at once:
+   - translation: the columns are shifted by a random integer number of
+     superstrips in [-max_shift, max_shift]. The pixels shifted out of the
+     image are masked (row = -99, channels = NaN).
+   - mirror: with probability 'mirror_prob', the columns are reversed
+     (phi -> -phi about the center of the image), which is the image of the
+     opposite charge: the bend channel becomes 1 - bend, and the q/pT class
+     is reversed (the q/pT bins are symmetric).
+  The sector phi class (labels[:,1]) follows the image, from the bin centers.
+  The parameters (q/pT, phi, eta, best_sector) are updated exactly.
+  """
+
+  # Geometry of the images and labels, see EMTFImage and EMTFLabel in test7/rootpy_trackbuilding6.py
+  column_deg = superstrip_size / 60.  # emtf_phi is in 1/60 deg
+  center_loc_deg = (n_columns * superstrip_size / 2.) / 60. - 22.  # local phi of the image center
+  label_center_loc_deg = 25.
+  phi_bin_lo, phi_bin_width, n_phi_bins = -40., 80./128, 128
+
+  def __init__(self, max_shift=14, mirror_prob=0.5, seed=None):
+    self.max_shift = max_shift
+    self.mirror_prob = mirror_prob
+    self.random_state = np.random.RandomState(seed)
+
+  def augment(self, pixels, channels, labels, parameters=None, shifts=None, flips=None):
+    # 'shifts' (columns) and 'flips' (bool) are drawn for each image if not given
+    n = pixels.shape[0]
+    if shifts is None:
+      shifts = self.random_state.randint(-self.max_shift, self.max_shift+1, size=n)
+    if flips is None:
+      flips = self.random_state.uniform(size=n) < self.mirror_prob
+    shifts = np.asarray(shifts, dtype=np.int32)
+    flips = np.asarray(flips, dtype=bool)
+
+    # Pixels
+    bad_pixel = -99
+    valid = (pixels[:,:,0] != bad_pixel)
+    cols = np.where(flips[:,np.newaxis], (n_columns-1) - pixels[:,:,1], pixels[:,:,1]) + shifts[:,np.newaxis]
+    keep = valid & (0 <= cols) & (cols < n_columns)
+    new_pixels = np.where(keep[:,:,np.newaxis], np.stack((pixels[:,:,0], cols), axis=-1), bad_pixel).astype(pixels.dtype)
+
+    new_channels = channels.copy()
+    flipped = flips[:,np.newaxis] & valid
+    new_channels[:,:,0] = np.where(flipped, 1 - channels[:,:,0], channels[:,:,0])
+    new_channels[~keep] = np.nan
+
+    # Labels: (q/pT class, sector phi class, eta class)
+    new_labels = labels.copy()
+    new_labels[:,0] = np.where(flips, (n_classes-1) - labels[:,0], labels[:,0])
+    dphi = self.phi_bin_lo + self.phi_bin_width * (labels[:,1] + 0.5)
+    dphi = self.get_new_loc(dphi + self.label_center_loc_deg, shifts, flips) - self.label_center_loc_deg
+    new_labels[:,1] = np.clip(np.floor((dphi - self.phi_bin_lo) / self.phi_bin_width), 0, self.n_phi_bins-1)
+
+    if parameters is None:
+      return new_pixels, new_channels, new_labels
+
+    # Parameters: (q/pT, phi [rad], eta, best_sector)
+    new_parameters = parameters.copy()
+    new_parameters[:,0] = np.where(flips, -parameters[:,0], parameters[:,0])
+    glob = np.rad2deg(parameters[:,1].astype(np.float64))
+    loc = glob - 15. - 60. * (parameters[:,3].astype(np.int32) % 6)
+    loc = (loc + 180.) % 360. - 180.
+    glob = glob + (self.get_new_loc(loc, shifts, flips) - loc)
+    new_parameters[:,1] = np.deg2rad((glob + 180.) % 360. - 180.)
+    return new_pixels, new_channels, new_labels, new_parameters
+
+  def get_new_loc(self, loc, shifts, flips):
+    # Local phi in deg after the mirror flip (about the image center) and the translation
+    loc = np.where(flips, 2*self.center_loc_deg - loc, loc)
+    return loc + shifts * self.column_deg
+
+  def __call__(self, x_misc, y):
+    # For ImageDataGenerator(preprocessing_function_batch=...): x_misc is [image_pixels, image_channels], y the labels
+    pixels, channels, labels = self.augment(x_misc[0], x_misc[1], y)
+    return [pixels, channels] + list(x_misc[2:]), labels
+
+
+# ______________________________________________________________________________
+# Sharded TFRecord files, streamed by the Estimator input_fn (see cnn_estimator.py)
+# Each record holds the raw bytes of image_pixels (int32), image_channels
+# (float32), labels (int32) and parameters (float32) of one image.
+# A manifest (records_manifest.json) is written next to the shards, with the
+# number of records and a hash of the labels and parameters of each split, so
+# that records made from other data are not reused by mistake.
+
+records_manifest = 'records_manifest.json'
+
+def get_record_files(data_dir, prefix, num_shards):
+  return [os.path.join(data_dir, '{0}-{1:05d}-of-{2:05d}.tfrecord'.format(prefix, i, num_shards)) for i in range(num_shards)]
+
+def write_image_records(data_dir, prefix, images_px, images_ch, labels, parameters, num_shards=16):
+  import tensorflow as tf
+
+  n = images_px.shape[0]
+  assert(images_px.shape[1:] == (sector_hits_capacity,2))
+  assert(images_ch.shape[1:] == (sector_hits_capacity,n_channels))
+  images_px = images_px.astype(np.int32, copy=False)
+  images_ch = images_ch.astype(np.float32, copy=False)
+  labels = labels.astype(np.int32, copy=False)
+  parameters = parameters.astype(np.float32, copy=False)
+
+  def bytes_feature(x):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[x.tobytes()]))
+
+  if not os.path.isdir(data_dir):
+    os.makedirs(data_dir)
+  files = get_record_files(data_dir, prefix, num_shards)
+  # Remove the shards of a previous conversion, the input_fn reads all of '<prefix>-*.tfrecord'
+  for oldfile in tf.gfile.Glob(os.path.join(data_dir, prefix + '-*.tfrecord')):
+    tf.gfile.Remove(oldfile)
+  for i, outfile in enumerate(files):
+    # Round-robin, so that each shard is a sample of the whole file
+    with tf.python_io.TFRecordWriter(outfile) as writer:
+      for j in range(i, n, num_shards):
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'image_pixels': bytes_feature(images_px[j]),
+            'image_channels': bytes_feature(images_ch[j]),
+            'labels': bytes_feature(labels[j]),
+            'parameters': bytes_feature(parameters[j]),
+        }))
+        writer.write(example.SerializeToString())
+  logger.info('Wrote {0} images to {1} shards: {2}'.format(n, num_shards, os.path.join(data_dir, prefix + '-*.tfrecord')))
+  return files
+
+def get_records_manifest(data, **kwargs):
+  # 'data' is returned by cnn_data_split. The other arguments (e.g. source, test_size) are stored as they are
+  import hashlib
+  (images_px_train, images_px_test, images_ch_train, images_ch_test, labels_train, labels_test, parameters_train, parameters_test) = data
+  manifest = dict(kwargs)
+  for prefix, labels, parameters in (('train', labels_train, parameters_train), ('eval', labels_test, parameters_test)):
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(labels, dtype=np.int32).tobytes())
+    h.update(np.ascontiguousarray(parameters, dtype=np.float32).tobytes())
+    manifest[prefix] = dict(num_records=int(labels.shape[0]), sha1=h.hexdigest())
+  return manifest
+
+def read_records_manifest(data_dir):
+  # Returns None if there is no manifest
+  fname = os.path.join(data_dir, records_manifest)
+  if not os.path.isfile(fname):
+    return None
+  with open(fname) as f:
+    return json.load(f)
+
+def check_records_manifest(data, data_dir):
+  # True if the records in data_dir were made from 'data'
+  manifest = read_records_manifest(data_dir)
+  if manifest is None:
+    return False
+  expected = get_records_manifest(data)
+  return all(manifest.get(prefix) == expected[prefix] for prefix in ('train', 'eval'))
+
+def write_cnn_data_records(data, data_dir, num_shards=16, **kwargs):
+  # 'data' is returned by cnn_data_split. The eval images are written to fewer shards.
+  # The other arguments are stored in the manifest.
+  (images_px_train, images_px_test, images_ch_train, images_ch_test, labels_train, labels_test, parameters_train, parameters_test) = data
+  train_files = write_image_records(data_dir, 'train', images_px_train, images_ch_train, labels_train, parameters_train, num_shards=num_shards)
+  eval_files = write_image_records(data_dir, 'eval', images_px_test, images_ch_test, labels_test, parameters_test, num_shards=max(1, num_shards//4))
+
+  manifest = get_records_manifest(data, num_shards=num_shards, **kwargs)
+  fname = os.path.join(data_dir, records_manifest)
+  logger.info('Creating file: {0}'.format(fname))
+  with open(fname, 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  return train_files, eval_files
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  import argparse
+  from cnn_globals import infile_images
+
+  parser = argparse.ArgumentParser(description='Write the cnn data to sharded TFRecord files')
+  parser.add_argument('--infile', default=infile_images)
+  parser.add_argument('--data-dir', default='./reiam_data')
+  parser.add_argument('--test-size', type=float, default=0.3)
+  parser.add_argument('--num-shards', type=int, default=16)
+  parser.add_argument('--nentries', type=int, default=None)
+  args = parser.parse_args()
+
+  data = cnn_data_split(args.infile, test_size=args.test_size, shuffle=True, nentries=args.nentries)
+  write_cnn_data_records(data, args.data_dir, num_shards=args.num_shards,
+                         source=os.path.abspath(args.infile), test_size=args.test_size, nentries=args.nentries)
+  logger.info('DONE')
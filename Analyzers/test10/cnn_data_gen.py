@@ -277,9 +277,15 @@ class NumpyArrayIterator(Iterator):
         batch_y = np.zeros(tuple([len(index_array)] + self.image_data_generator.preprocessing_output_shape_y),
                            dtype=self.dtype)
 
-        for i, j in enumerate(index_array):
-            batch_x[i] = self.image_data_generator.preprocessing_function_x(*(x[j] for x in self.x_misc))
-            batch_y[i] = self.image_data_generator.preprocessing_function_y(self.y[j])
+        # Transform the whole batch before the per-sample preprocessing
+        batch_misc = [x[index_array] for x in self.x_misc]
+        batch_y_misc = self.y[index_array]
+        if self.image_data_generator.preprocessing_function_batch is not None:
+            batch_misc, batch_y_misc = self.image_data_generator.preprocessing_function_batch(batch_misc, batch_y_misc)
+
+        for i in range(len(index_array)):
+            batch_x[i] = self.image_data_generator.preprocessing_function_x(*(x[i] for x in batch_misc))
+            batch_y[i] = self.image_data_generator.preprocessing_function_y(batch_y_misc[i])
 
         if self.save_to_dir:
             for i, j in enumerate(index_array):
@@ -374,6 +380,11 @@ class ImageDataGenerator(object):
             The function should take one argument:
             one image (Numpy tensor with rank 3),
             and should output a Numpy tensor with the same shape.
+        preprocessing_function_batch: function that will be applied on each
+            batch, before preprocessing_function_x and preprocessing_function_y.
+            The function takes the list of the miscellaneous input arrays
+            and the labels of the batch, and returns them transformed,
+            e.g. `cnn_data.SparseImageAugmenter`.
         data_format: Image data format,
             either "channels_first" or "channels_last".
             "channels_last" mode means that the images should have shape
@@ -532,6 +543,7 @@ class ImageDataGenerator(object):
                  rescale=None,
                  preprocessing_function_x=None,
                  preprocessing_function_y=None,
+                 preprocessing_function_batch=None,
                  preprocessing_output_shape_x=None,
                  preprocessing_output_shape_y=None,
                  data_format='channels_last',
@@ -557,6 +569,7 @@ class ImageDataGenerator(object):
         self.rescale = rescale
         self.preprocessing_function_x = preprocessing_function_x
         self.preprocessing_function_y = preprocessing_function_y
+        self.preprocessing_function_batch = preprocessing_function_batch
         self.preprocessing_output_shape_x = preprocessing_output_shape_x
         self.preprocessing_output_shape_y = preprocessing_output_shape_y
         self.dtype = dtype
@@ -1,10 +1,12 @@
 # Based on official TensorFlow implementation of MNIST
 # https://github.com/tensorflow/models/tree/master/official/mnist
 
+import os
+
 import numpy as np
 import tensorflow as tf
 
-from cnn_globals import (superstrip_size, n_zones, rows_per_zone, n_rows, n_columns, n_channels, n_classes, dropout, learning_rate, gradient_clip_norm)
+from cnn_globals import (superstrip_size, n_zones, rows_per_zone, n_rows, n_columns, n_channels, n_classes, dropout, learning_rate, gradient_clip_norm, sector_hits_capacity)
 
 from cnn_models import create_model, save_my_model
 
@@ -30,6 +32,82 @@ def parse_label_fn(labels):
   lb = labels[0]
   return lb
 
+def parse_image_batch_fn(pixels, channels):
+  # Same as parse_image_fn, for a batch of images
+  bad_pixel = -99
+  mask = tf.not_equal(pixels[:,:,0], bad_pixel)
+  sample = tf.tile(tf.expand_dims(tf.range(tf.shape(pixels)[0]), 1), [1, tf.shape(pixels)[1]])
+
+  indices = tf.concat([tf.expand_dims(tf.boolean_mask(sample, mask), 1), tf.boolean_mask(pixels, mask)], axis=1)
+  updates = tf.boolean_mask(channels, mask)
+  updates = tf.stack([updates[:,0], 1-updates[:,0]], axis=1)
+  images_shape = tf.stack([tf.shape(pixels)[0], n_rows, n_columns, n_channels])
+  images = tf.scatter_nd(indices, updates, images_shape)
+  images.set_shape([None, n_rows, n_columns, n_channels])
+  return images
+
+def parse_sparse_record_fn(record):
+  # Parse one record written by cnn_data.write_image_records
+  features = {
+      'image_pixels': tf.FixedLenFeature([], tf.string),
+      'image_channels': tf.FixedLenFeature([], tf.string),
+      'labels': tf.FixedLenFeature([], tf.string),
+  }
+  parsed = tf.parse_single_example(record, features)
+  pixels = tf.reshape(tf.decode_raw(parsed['image_pixels'], tf.int32), (sector_hits_capacity,2))
+  channels = tf.reshape(tf.decode_raw(parsed['image_channels'], tf.float32), (sector_hits_capacity,n_channels))
+  labels = tf.reshape(tf.decode_raw(parsed['labels'], tf.int32), (3,))
+  return pixels, channels, labels
+
+def get_augment_fn(augmenter):
+  # Wraps a cnn_data.SparseImageAugmenter, to be mapped over batches of (pixels, channels, labels)
+  def augment_fn(pixels, channels, labels):
+    outputs = tf.py_func(augmenter.augment, [pixels, channels, labels], [tf.int32, tf.float32, tf.int32], stateful=True)
+    for x, y in zip(outputs, (pixels, channels, labels)):
+      x.set_shape(y.get_shape())
+    return tuple(outputs)
+  return augment_fn
+
+
+# ______________________________________________________________________________
+def get_input_fn(flags_obj, prefix, batch_size, training, augmenter=None):
+  """Returns an input_fn that streams the sharded records '<prefix>-*.tfrecord' in data_dir.
+
+  If 'augmenter' (e.g. cnn_data.SparseImageAugmenter) is given, it transforms
+  each batch of sparse images and labels before the images are made.
+  """
+
+  def input_fn():
+    with tf.name_scope(prefix + '_data'):
+      filenames = sorted(tf.gfile.Glob(os.path.join(flags_obj.data_dir, prefix + '-*.tfrecord')))
+      if not filenames:
+        raise ValueError('Could not find {0} records in data_dir: {1}'.format(prefix, flags_obj.data_dir))
+
+      # Read several shards concurrently. In training, the order of the shards
+      # and of their records is not deterministic.
+      dataset = tf.data.Dataset.from_tensor_slices(filenames)
+      if training:
+        dataset = dataset.shuffle(buffer_size=len(filenames))
+      dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+          tf.data.TFRecordDataset, cycle_length=min(flags_obj.num_parallel_reads, len(filenames)), sloppy=training))
+
+      # Shuffle the serialized records, they are much smaller than the images
+      if training and flags_obj.shuffle:
+        dataset = dataset.shuffle(buffer_size=flags_obj.shuffle_buffer_size)
+      if training:
+        dataset = dataset.repeat(flags_obj.epochs_between_evals)
+      # Parse the records in parallel, then make the images of the whole batch
+      dataset = dataset.map(map_func=parse_sparse_record_fn, num_parallel_calls=flags_obj.num_parallel_calls)
+      dataset = dataset.batch(batch_size=batch_size)
+      if augmenter is not None:
+        dataset = dataset.map(map_func=get_augment_fn(augmenter), num_parallel_calls=flags_obj.num_parallel_calls)
+      dataset = dataset.map(map_func=lambda pixels, channels, labels: (parse_image_batch_fn(pixels, channels), labels[:,0]),
+                            num_parallel_calls=flags_obj.num_parallel_calls)
+      if flags_obj.prefetch:
+        dataset = dataset.prefetch(buffer_size=flags_obj.prefetch_buffer_size)
+      return dataset
+  return input_fn
+
 
 # ______________________________________________________________________________
 def model_fn(features, labels, mode, params):
@@ -135,63 +213,6 @@ def model_fn(features, labels, mode, params):
         eval_metric_ops=eval_metric_ops)
 
 
-# ______________________________________________________________________________
-# Patch the function _get_features_and_labels_from_input_fn()
-
-# from tensorflow/python/training/basic_session_run_hooks.py
-class FeedFnHook(tf.train.SessionRunHook):
-  """Runs `feed_fn` and sets the `feed_dict` accordingly."""
-
-  def __init__(self, feed_fn):
-    """Initializes a `FeedFnHook`.
-    Args:
-      feed_fn: function that takes no arguments and returns `dict` of `Tensor`
-        to feed.
-    """
-    self.feed_fn = feed_fn
-
-  def before_run(self, run_context):  # pylint: disable=unused-argument
-    return tf.train.SessionRunArgs(
-        fetches=None, feed_dict=self.feed_fn())
-
-# from tensorflow/python/estimator/estimator.py
-#      tensorflow/python/estimator/util.py
-class _DatasetInitializerHook(tf.train.SessionRunHook):
-  """Creates a SessionRunHook that initializes the passed iterator."""
-
-  def __init__(self, iterator, feed_fn):
-    self._iterator = iterator
-    self._feed_fn = feed_fn
-
-  def begin(self):
-    self._initializer = self._iterator.initializer
-
-  def after_create_session(self, session, coord):
-    del coord
-    session.run(self._initializer, feed_dict=self._feed_fn())
-
-# from tensorflow/python/estimator/estimator.py
-#      tensorflow/python/estimator/util.py
-def _get_features_and_labels_from_input_fn(self, input_fn, mode):
-  """Extracts the `features` and labels from return values of `input_fn`."""
-  result = self._call_input_fn(input_fn, mode)
-  input_hooks = []
-  if isinstance(result, tf.data.Dataset):
-    iterator = result.make_initializable_iterator()
-    #input_hooks.append(_DatasetInitializerHook(iterator))
-    if mode == tf.estimator.ModeKeys.TRAIN:
-      input_hooks.append(_DatasetInitializerHook(iterator, self.train_input_hook.feed_fn))
-    else:  # mode == tf.estimator.ModeKeys.EVAL
-      input_hooks.append(_DatasetInitializerHook(iterator, self.eval_input_hook.feed_fn))
-    result = iterator.get_next()
-  if isinstance(result, (list, tuple)):
-    if len(result) != 2:
-      raise ValueError(
-          'input_fn should return (feautures, labels) as a len 2 tuple.')
-    return result[0], result[1], input_hooks
-  return result, None, input_hooks
-
-
 # ______________________________________________________________________________
 def define_reiam_flags():
   """Define flags which will be used for MNIST models."""
@@ -239,13 +260,28 @@ def save_keras_model(reiam_classifier, model_name='model_cnn'):
 
 
 # ______________________________________________________________________________
-def run_reiam(flags_obj, data):
+def run_reiam(flags_obj, data=None, augmenter=None):
   """Run MNIST training and eval loop.
   Args:
     flags_obj: An object containing parsed flag values.
+    data: The arrays returned by cnn_data_split. If given, they are written to
+      sharded records in data_dir, unless the records there were made from
+      the same data (see the manifest in cnn_data.py).
+      The training and evaluation data are streamed from these records.
+    augmenter: If given, e.g. cnn_data.SparseImageAugmenter(), it transforms
+      the training batches.
   """
 
-  (images_px_train, images_px_test, images_ch_train, images_ch_test, labels_train, labels_test, parameters_train, parameters_test) = data
+  if data is not None:
+    from cnn_data import write_cnn_data_records, check_records_manifest
+    if check_records_manifest(data, flags_obj.data_dir):
+      tf.logging.info('Using the existing records in data_dir: {}'.format(flags_obj.data_dir))
+    elif (tf.gfile.Glob(os.path.join(flags_obj.data_dir, '*.tfrecord')) and
+          not flags_obj.overwrite_records):
+      raise ValueError('The records in data_dir: {} were not made from the '
+                       'given data. Remove them, or set --overwrite_records.'.format(flags_obj.data_dir))
+    else:
+      write_cnn_data_records(data, flags_obj.data_dir)
 
   # ____________________________________________________________________________
   class ModelHelpers(object):
@@ -322,65 +358,9 @@ def run_reiam(flags_obj, data):
   reiam_classifier._keras_model = create_model(params, training=True) #FIXME
 
   # Set up training and evaluation input functions.
-  def get_train_input_fn_and_hook():
-    feed_fn_hook = tf.train.FeedFnHook(feed_fn=None)
-
-    def input_fn():
-      with tf.name_scope('train_data'):
-        get_shape_ph = lambda x: [None] + list(x[1:])
-        images_px_ph         = tf.placeholder(images_px_train.dtype, get_shape_ph(images_px_train.shape))
-        images_ch_ph         = tf.placeholder(images_ch_train.dtype, get_shape_ph(images_ch_train.shape))
-        labels_ph            = tf.placeholder(labels_train.dtype, get_shape_ph(labels_train.shape))
-        parameters_ph        = tf.placeholder(parameters_train.dtype, get_shape_ph(parameters_train.shape))
-        feed_dict            = {images_px_ph: images_px_train, images_ch_ph: images_ch_train, labels_ph: labels_train}
-        feed_fn_hook.feed_fn = lambda: feed_dict
-
-        dataset1 = tf.data.Dataset.from_tensor_slices((images_px_ph, images_ch_ph))
-        dataset1 = dataset1.map(map_func=parse_image_fn)
-        dataset2 = tf.data.Dataset.from_tensor_slices((labels_ph))
-        dataset2 = dataset2.map(map_func=parse_label_fn)
-        dataset = tf.data.Dataset.zip((dataset1, dataset2))
-
-        if flags_obj.shuffle:
-          dataset = dataset.shuffle(buffer_size=flags_obj.shuffle_buffer_size)
-        dataset = dataset.batch(batch_size=flags_obj.batch_size)
-        if flags_obj.prefetch:
-          dataset = dataset.prefetch(buffer_size=flags_obj.prefetch_buffer_size)
-        dataset = dataset.repeat(flags_obj.epochs_between_evals)
-        return dataset
-    return input_fn, feed_fn_hook
-
-  def get_eval_input_fn_and_hook():
-    feed_fn_hook = tf.train.FeedFnHook(feed_fn=None)
-
-    def input_fn():
-      with tf.name_scope('eval_data'):
-        get_shape_ph = lambda x: [None] + list(x[1:])
-        images_px_ph         = tf.placeholder(images_px_test.dtype, get_shape_ph(images_px_test.shape))
-        images_ch_ph         = tf.placeholder(images_ch_test.dtype, get_shape_ph(images_ch_test.shape))
-        labels_ph            = tf.placeholder(labels_test.dtype, get_shape_ph(labels_test.shape))
-        parameters_ph        = tf.placeholder(parameters_test.dtype, get_shape_ph(parameters_test.shape))
-        feed_dict            = {images_px_ph: images_px_test, images_ch_ph: images_ch_test, labels_ph: labels_test}
-        feed_fn_hook.feed_fn = lambda: feed_dict
-
-        dataset1 = tf.data.Dataset.from_tensor_slices((images_px_ph, images_ch_ph))
-        dataset1 = dataset1.map(map_func=parse_image_fn)
-        dataset2 = tf.data.Dataset.from_tensor_slices((labels_ph))
-        dataset2 = dataset2.map(map_func=parse_label_fn)
-        dataset = tf.data.Dataset.zip((dataset1, dataset2))
-
-        if flags_obj.shuffle:
-          dataset = dataset.shuffle(buffer_size=flags_obj.shuffle_buffer_size)
-        dataset = dataset.batch(batch_size=flags_obj.batch_size*20)
-        if flags_obj.prefetch:
-          dataset = dataset.prefetch(buffer_size=flags_obj.prefetch_buffer_size)
-        dataset = dataset.repeat(flags_obj.epochs_between_evals)
-        return dataset
-    return input_fn, feed_fn_hook
+  train_input_fn = get_input_fn(flags_obj, 'train', batch_size=flags_obj.batch_size, training=True, augmenter=augmenter)
 
-  train_input_fn, train_input_hook = get_train_input_fn_and_hook()
-
-  eval_input_fn, eval_input_hook = get_eval_input_fn_and_hook()
+  eval_input_fn = get_input_fn(flags_obj, 'eval', batch_size=flags_obj.batch_size*20, training=False)
 
   # Set up hook that outputs training logs every 100 steps.
   train_hooks = hooks_helper.get_train_hooks(
@@ -389,14 +369,6 @@ def run_reiam(flags_obj, data):
 
   eval_hooks = []
 
-  # Patch the function _get_features_and_labels_from_input_fn()
-  import types
-  reiam_classifier.train_input_fn = train_input_fn
-  reiam_classifier.train_input_hook = train_input_hook
-  reiam_classifier.eval_input_fn = eval_input_fn
-  reiam_classifier.eval_input_hook = eval_input_hook
-  reiam_classifier._get_features_and_labels_from_input_fn = types.MethodType(_get_features_and_labels_from_input_fn, reiam_classifier)
-
   train_spec = tf.estimator.TrainSpec(input_fn=train_input_fn, hooks=train_hooks, max_steps=None)
   eval_spec = tf.estimator.EvalSpec(input_fn=eval_input_fn, hooks=eval_hooks, steps=None)
 
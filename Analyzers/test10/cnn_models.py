@@ -13,10 +13,11 @@ from keras.callbacks import LearningRateScheduler, TerminateOnNaN, ModelCheckpoi
 from keras.regularizers import Regularizer
 from keras.constraints import Constraint
 from keras import initializers, regularizers, optimizers, losses, metrics
+from keras.engine import Layer
 
 from keras.applications.mobilenet import relu6, DepthwiseConv2D
 
-from cnn_globals import (superstrip_size, n_zones, rows_per_zone, n_rows, n_columns, n_channels, n_classes)
+from cnn_globals import (superstrip_size, n_zones, rows_per_zone, n_rows, n_columns, n_channels, n_classes, sector_hits_capacity)
 
 
 def create_model(nvariables=None, lr=0.001, clipnorm=10., dropout=0.2, use_bn=True, use_dropout=False):
@@ -53,6 +54,14 @@ def create_model(nvariables=None, lr=0.001, clipnorm=10., dropout=0.2, use_bn=Tr
   x_zone5 = _conv_block_one(x_zone5)
   x_zone6 = _conv_block_one(x_zone6)
 
+  x_zones = [x_zone0, x_zone1, x_zone2, x_zone3, x_zone4, x_zone5, x_zone6]
+  return _create_model_from_zones(inputs, x_zones, lr=lr, clipnorm=clipnorm)
+
+
+def _create_model_from_zones(inputs, x_zones, lr=0.001, clipnorm=10.):
+  # Common part of create_model and create_model_sparse, after the first conv block
+  (x_zone0, x_zone1, x_zone2, x_zone3, x_zone4, x_zone5, x_zone6) = x_zones
+
   def _conv_block_two(x):
     filters = 16
     x = DepthwiseConv2D(
@@ -234,6 +243,102 @@ def create_model(nvariables=None, lr=0.001, clipnorm=10., dropout=0.2, use_bn=Tr
   return model
 
 
+# ______________________________________________________________________________
+# Sparse input
+
+class SparseZoneConv2D(Layer):
+  """First conv block of create_model, computed from the sparse images.
+
+  Takes [image_pixels, image_channels] as stored in the npz files: the
+  (row, column) and the channels of up to 'sector_hits_capacity' hits, with
+  row = -99 for the empty entries. It is equivalent to the zone split and the
+  Conv2D (kernel (rows_per_zone, kernel_width), strides (rows_per_zone,
+  stride_width), 'valid', no bias) of each zone in create_model, applied to
+  the image made by parse_image_fn, but only the products with the occupied
+  pixels are computed: each pixel contributes to the
+  ceil(kernel_width/stride_width) output columns whose window covers it.
+
+  Output shape: (batch, n_zones, output columns, filters)
+  """
+
+  def __init__(self, filters, kernel_width=63, stride_width=7, kernel_initializer='he_normal', **kwargs):
+    super(SparseZoneConv2D, self).__init__(**kwargs)
+    self.filters = filters
+    self.kernel_width = kernel_width
+    self.stride_width = stride_width
+    self.kernel_initializer = initializers.get(kernel_initializer)
+    self.output_columns = (n_columns - kernel_width) // stride_width + 1
+    self.num_taps = -(-kernel_width // stride_width)
+
+  def build(self, input_shape):
+    # One kernel per zone, same shape as the Conv2D kernels in create_model
+    self.kernel = self.add_weight(name='kernel',
+                                  shape=(n_zones, rows_per_zone, self.kernel_width, n_channels, self.filters),
+                                  initializer=self.kernel_initializer)
+    super(SparseZoneConv2D, self).build(input_shape)
+
+  def call(self, inputs):
+    pixels, channels = inputs
+    pixels = K.cast(pixels, 'int32')
+    rows, cols = pixels[:,:,0], pixels[:,:,1]
+    valid = K.greater_equal(rows, 0)
+    rows = tf.where(valid, rows, tf.zeros_like(rows))
+    cols = tf.where(valid, cols, tf.zeros_like(cols))
+
+    # Same channels as parse_image_fn, zero for the empty entries (stored as NaN)
+    ch0 = tf.where(valid, channels[:,:,0], tf.zeros_like(channels[:,:,0]))
+    features = K.stack([ch0, 1-ch0], axis=-1) * K.expand_dims(K.cast(valid, K.floatx()), -1)
+
+    # Output columns j covered by each pixel, and the kernel column dc = col - j*stride
+    taps = K.arange(self.num_taps, dtype='int32')
+    j = K.expand_dims(cols // self.stride_width, -1) - taps
+    dc = K.expand_dims(cols, -1) - j * self.stride_width
+    ok = K.expand_dims(valid, -1) & K.greater_equal(j, 0) & K.less(j, self.output_columns) & K.less(dc, self.kernel_width)
+
+    # rows = zone * rows_per_zone + row in zone, so it indexes the (n_zones*rows_per_zone) kernel rows
+    kernel = K.reshape(self.kernel, (-1, n_channels, self.filters))
+    index = tf.where(ok, K.expand_dims(rows, -1) * self.kernel_width + dc, tf.zeros_like(dc))
+    weights = K.gather(kernel, index)  # (batch, pixels, taps, channels, filters)
+    contrib = K.sum(K.expand_dims(K.expand_dims(features, 2), -1) * weights, axis=-2)
+
+    # Sum the contributions to each (sample, zone, column). The others go to an extra segment
+    batch_size = K.shape(pixels)[0]
+    num_segments = batch_size * n_zones * self.output_columns
+    sample = K.reshape(K.arange(batch_size, dtype='int32'), (-1,1,1))
+    segment = (sample * n_zones + K.expand_dims(rows // rows_per_zone, -1)) * self.output_columns + j
+    segment = tf.where(ok, segment, tf.fill(K.shape(segment), num_segments))
+    outputs = tf.unsorted_segment_sum(K.reshape(contrib, (-1, self.filters)), K.reshape(segment, (-1,)), num_segments + 1)
+    return K.reshape(outputs[:-1], (-1, n_zones, self.output_columns, self.filters))
+
+  def compute_output_shape(self, input_shape):
+    return (input_shape[0][0], n_zones, self.output_columns, self.filters)
+
+  def get_config(self):
+    config = {'filters': self.filters,
+              'kernel_width': self.kernel_width,
+              'stride_width': self.stride_width,
+              'kernel_initializer': initializers.serialize(self.kernel_initializer)}
+    base_config = super(SparseZoneConv2D, self).get_config()
+    return dict(list(base_config.items()) + list(config.items()))
+
+
+def create_model_sparse(nvariables=None, lr=0.001, clipnorm=10., dropout=0.2, use_bn=True, use_dropout=False):
+  # Same as create_model, but the inputs are [image_pixels, image_channels] instead of the images
+  inputs_px = Input(shape=(sector_hits_capacity, 2), dtype='int32')
+  inputs_ch = Input(shape=(sector_hits_capacity, n_channels), dtype='float32')
+
+  x = SparseZoneConv2D(8, kernel_width=63, stride_width=7, kernel_initializer='he_normal')([inputs_px, inputs_ch])
+
+  def _conv_block_one(x, zone):
+    x = Lambda(lambda x, zone: x[:, zone:zone+1], arguments={'zone': zone})(x)
+    x = BatchNormalization(epsilon=1e-3, momentum=0.999)(x)
+    x = Activation(relu6)(x)
+    return x
+
+  x_zones = [_conv_block_one(x, zone) for zone in range(n_zones)]
+  return _create_model_from_zones([inputs_px, inputs_ch], x_zones, lr=lr, clipnorm=clipnorm)
+
+
 # ______________________________________________________________________________
 # Save/Load models
 
@@ -253,7 +358,7 @@ def save_my_model(model, name='model'):
 def load_my_model(name='model', weights_name='model_weights'):
   with open(name + '.json', 'r') as f:
     json_string = json.dumps(json.load(f))
-    model = model_from_json(json_string)
+    model = model_from_json(json_string, custom_objects={'SparseZoneConv2D': SparseZoneConv2D})
   #model = load_model(name + '.h5')
   model.load_weights(weights_name + '.h5')
   return model
@@ -0,0 +1,138 @@
+"""
+Compare the dense create_model and the sparse-input create_model_sparse on CPU:
+training and inference examples/s, and the test accuracy.
+
+The dense model is fed with the images made by parse_image_batch_fn for each
+batch, the sparse model with the image_pixels and image_channels arrays as
+stored in the npz file. Both models are trained from scratch with the same
+data and settings.
+
+Usage: python cnn_sparse_benchmark.py [--nentries N] [--epochs N] [--batch-size N] [--nthreads N]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from cnn_globals import (n_classes, learning_rate, gradient_clip_norm, infile_images)
+from cnn_data import cnn_data_split, parse_image_batch_fn
+from nn_imports import setup_session
+
+from nn_logging import getLogger
+logger = getLogger()
+
+
+# ______________________________________________________________________________
+# Settings
+
+nentries = 100000
+
+test_size = 0.3
+
+epochs = 3
+
+batch_size = 200
+
+nthreads = 4
+
+
+# ______________________________________________________________________________
+def get_image_sequence(images_px, images_ch, labels, batch_size):
+  from keras.utils import Sequence
+
+  class DenseImageSequence(Sequence):
+    # Batches of dense images, made on the fly to keep the memory low
+    def __len__(self):
+      return (len(images_px) + batch_size - 1) // batch_size
+
+    def __getitem__(self, index):
+      s = slice(index * batch_size, (index+1) * batch_size)
+      images = parse_image_batch_fn(images_px[s], images_ch[s])
+      if labels is None:
+        return images
+      return images, labels[s]
+
+  return DenseImageSequence()
+
+class EpochTimer(object):
+  def __init__(self):
+    from keras.callbacks import LambdaCallback
+    self.times = []
+    self.callback = LambdaCallback(on_epoch_begin=self.on_epoch_begin, on_epoch_end=self.on_epoch_end)
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self.start = time.time()
+
+  def on_epoch_end(self, epoch, logs=None):
+    self.times.append(time.time() - self.start)
+
+  def seconds(self):
+    # Skip the first epoch, which includes the graph setup
+    return np.median(self.times[1:] if len(self.times) > 1 else self.times)
+
+def get_accuracy(y_true, y_pred, k=1):
+  top_k = np.argsort(y_pred, axis=1)[:,-k:]
+  return np.mean(np.any(top_k == y_true[:,np.newaxis], axis=1))
+
+def run_benchmark(name, model, fit_fn, predict_fn, ntrain, ntest, y_test):
+  timer = EpochTimer()
+  fit_fn(model, timer.callback)
+  train_rate = ntrain / timer.seconds()
+
+  t0 = time.time()
+  y_pred = predict_fn(model)
+  test_rate = ntest / (time.time() - t0)
+
+  acc1, acc2 = get_accuracy(y_test, y_pred, k=1), get_accuracy(y_test, y_pred, k=2)
+  logger.info('{0}: training {1:.0f} examples/s, inference {2:.0f} examples/s, accuracy {3:.4f}, accuracy_at_k {4:.4f}'.format(
+      name, train_rate, test_rate, acc1, acc2))
+  return (train_rate, test_rate, acc1, acc2)
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compare the dense and sparse-input CNN models')
+  parser.add_argument('--infile', default=infile_images)
+  parser.add_argument('--nentries', type=int, default=nentries)
+  parser.add_argument('--epochs', type=int, default=epochs)
+  parser.add_argument('--batch-size', type=int, default=batch_size)
+  parser.add_argument('--nthreads', type=int, default=nthreads)
+  args = parser.parse_args()
+
+  setup_session(intra_op_parallelism_threads=args.nthreads, inter_op_parallelism_threads=1)
+  from keras.utils import to_categorical
+  from cnn_models import create_model, create_model_sparse
+
+  data = cnn_data_split(args.infile, test_size=test_size, shuffle=True, nentries=args.nentries)
+  (images_px_train, images_px_test, images_ch_train, images_ch_test, labels_train, labels_test, parameters_train, parameters_test) = data
+  y_train = to_categorical(labels_train[:,0], num_classes=n_classes)
+  y_test = labels_test[:,0]
+  ntrain, ntest = len(images_px_train), len(images_px_test)
+
+  results = []
+
+  # Dense
+  model = create_model(lr=learning_rate, clipnorm=gradient_clip_norm)
+  def fit_fn(model, callback):
+    model.fit_generator(get_image_sequence(images_px_train, images_ch_train, y_train, args.batch_size),
+                        epochs=args.epochs, workers=1, callbacks=[callback], verbose=0)
+  def predict_fn(model):
+    return model.predict_generator(get_image_sequence(images_px_test, images_ch_test, None, args.batch_size), workers=1)
+  results.append(run_benchmark('dense', model, fit_fn, predict_fn, ntrain, ntest, y_test))
+
+  # Sparse
+  model = create_model_sparse(lr=learning_rate, clipnorm=gradient_clip_norm)
+  def fit_fn(model, callback):
+    model.fit([images_px_train, images_ch_train], y_train, batch_size=args.batch_size,
+              epochs=args.epochs, callbacks=[callback], verbose=0)
+  def predict_fn(model):
+    return model.predict([images_px_test, images_ch_test], batch_size=args.batch_size)
+  results.append(run_benchmark('sparse', model, fit_fn, predict_fn, ntrain, ntest, y_test))
+
+  results = np.array(results, dtype=np.float64)
+  logger.info('Speedup: training {0:.1f}x, inference {1:.1f}x'.format(results[1,0]/results[0,0], results[1,1]/results[0,1]))
+
+  outfile = 'benchmark_cnn_sparse.npz'
+  print('[INFO] Creating file: %s' % outfile)
+  np.savez_compressed(outfile, names=['dense', 'sparse'], results=results, columns=['train_rate', 'test_rate', 'accuracy', 'accuracy_at_k'])
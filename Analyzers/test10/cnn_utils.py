@@ -155,6 +155,25 @@ def define_reiam_base_flags():
                      "of batches consumed per training step."))
   key_flags.append("prefetch_buffer_size")
 
+  flags.DEFINE_integer(
+      name="num_parallel_reads", short_name="npr", default=4,
+      help=help_wrap("Number of record files to read concurrently in the "
+                     "input pipeline."))
+  key_flags.append("num_parallel_reads")
+
+  flags.DEFINE_integer(
+      name="num_parallel_calls", short_name="npc", default=4,
+      help=help_wrap("Number of records to parse in parallel in the input "
+                     "pipeline."))
+  key_flags.append("num_parallel_calls")
+
+  flags.DEFINE_boolean(
+      name="overwrite_records", default=False,
+      help=help_wrap("If set, the records in data_dir are rewritten when "
+                     "they were not made from the given data. Otherwise, "
+                     "this is an error."))
+  key_flags.append("overwrite_records")
+
   tf.app.flags.DEFINE_boolean(
       name="log_device_placement", default=False,
       help=help_wrap("Whether to log device placement."))
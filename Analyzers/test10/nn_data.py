@@ -1,13 +1,14 @@
 import numpy as np
 
 #from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
 
 from nn_logging import getLogger
 logger = getLogger()
 
 from nn_encode import Encoder
 
+# sklearn and keras are imported on first use, so that importing nn_data is fast
+
 
 # ______________________________________________________________________________
 def muon_data(filename, adjust_scale=0, reg_pt_scale=1.0, correct_for_eta=False):
@@ -35,6 +36,7 @@ def muon_data(filename, adjust_scale=0, reg_pt_scale=1.0, correct_for_eta=False)
 
 
 def muon_data_split(filename, adjust_scale=0, reg_pt_scale=1.0, test_size=0.5, correct_for_eta=False):
+  from sklearn.model_selection import train_test_split
   x, y, w, x_mask = muon_data(filename, adjust_scale=adjust_scale, reg_pt_scale=reg_pt_scale, correct_for_eta=correct_for_eta)
   # Split dataset in training and testing
   x_train, x_test, y_train, y_test, w_train, w_test, x_mask_train, x_mask_test = train_test_split(x, y, w, x_mask, test_size=test_size)  
@@ -140,3 +142,93 @@ def mix_training_inputs(x_train, y_train, pu_x_train, pu_y_train, pu_aux_train,
 
   logger.info('Mixed muon data with pileup data. x_train_new has shape {0}, y_train_new has shape {1},{2}'.format(x_train_new.shape, y_train_new[0].shape, y_train_new[1].shape))
   return x_train_new, y_train_new
+
+
+# ______________________________________________________________________________
+# Same mixing as mix_training_inputs(), but the batches are assembled on the fly.
+# Each batch has batch_size/2 muon rows followed by batch_size/2 pileup rows,
+# drawn by index from the input arrays, which are not copied. The pileup rows
+# that fail the veto (aux[:,2] > discr_pt_cut) are never drawn. Every epoch, the
+# muons are reshuffled (if shuffle) and paired with a new permutation of the
+# pileup rows, repeated as needed.
+# The batches are written into a ring of nbuffers preallocated buffers, so a
+# batch stays valid until nbuffers-1 more batches are produced. With threaded
+# workers, nbuffers must be at least max_queue_size + 2 (see train_model_sequence).
+# MixingSequenceBase only depends on numpy. The keras.utils.Sequence subclass,
+# MixingSequence, is in nn_training, so that keras is not imported with nn_data.
+class MixingSequenceBase(object):
+  def __init__(self, x, y, pu_x, pu_y, pu_aux, discr_pt_cut=14., batch_size=256, shuffle=True,
+               muon_index=None, pu_index=None, nbuffers=12, seed=None):
+    assert(len(y) == 2)
+    assert(len(pu_y) == 2)
+    assert(x.shape[0] == y[0].shape[0] == y[1].shape[0])
+    assert(pu_x.shape[0] == pu_y[0].shape[0] == pu_y[1].shape[0] == pu_aux.shape[0])
+    assert(batch_size % 2 == 0)
+    self.x, self.y = x, y
+    self.pu_x, self.pu_y = pu_x, pu_y
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.rng = np.random.RandomState(seed)
+
+    self.muon_index = np.arange(x.shape[0]) if muon_index is None else np.asarray(muon_index)
+    if pu_index is None:
+      pu_index = np.arange(pu_x.shape[0])
+    # Apply veto on PU events with a muon with pT > discr_pt_cut
+    pu_index = np.asarray(pu_index)
+    self.pu_index = pu_index[~(pu_aux[pu_index, 2] > discr_pt_cut)]
+    if len(self.pu_index) == 0:
+      raise Exception('No pileup rows left after the veto (discr_pt_cut={0})'.format(discr_pt_cut))
+
+    half = batch_size // 2
+    self.buffers = [(np.zeros((batch_size, x.shape[1]), dtype=np.float32),
+                     [np.zeros((batch_size,), dtype=np.float32), np.zeros((batch_size,), dtype=np.float32)]) for _ in range(nbuffers)]
+    self.on_epoch_end()
+    logger.info('Mixing {0} muon rows with {1} pileup rows in {2} batches of {3}+{3}'.format(
+        len(self.muon_index), len(self.pu_index), len(self), half))
+
+  def __len__(self):
+    half = self.batch_size // 2
+    return (len(self.muon_index) + half - 1) // half
+
+  def on_epoch_end(self):
+    n = len(self.muon_index)
+    if self.shuffle:
+      self.muon_order = self.muon_index[self.rng.permutation(n)]
+      self.pu_order = np.resize(self.pu_index[self.rng.permutation(len(self.pu_index))], n)
+    else:
+      self.muon_order = self.muon_index
+      self.pu_order = np.resize(self.pu_index, n)
+
+  def __getitem__(self, idx):
+    half = self.batch_size // 2
+    muon_ids = self.muon_order[idx*half:(idx+1)*half]
+    pu_ids = self.pu_order[idx*half:(idx+1)*half]
+    k = len(muon_ids)
+    x_batch, y_batch = self.buffers[idx % len(self.buffers)]
+    np.take(self.x, muon_ids, axis=0, out=x_batch[:k])
+    np.take(self.pu_x, pu_ids, axis=0, out=x_batch[k:2*k])
+    for i in range(2):
+      np.take(self.y[i], muon_ids, out=y_batch[i][:k])
+      np.take(self.pu_y[i], pu_ids, out=y_batch[i][k:2*k])
+    return x_batch[:2*k], [y_batch[0][:2*k], y_batch[1][:2*k]]
+
+
+def mix_training_sequences(x_train, y_train, pu_x_train, pu_y_train, pu_aux_train, discr_pt_cut=14., batch_size=256,
+                           validation_split=0., nbuffers=12, seed=None, sequence_cls=MixingSequenceBase):
+  # Same as validation_split in keras: the last fraction of the muon and pileup rows is used for validation
+  # Use sequence_cls=nn_training.MixingSequence to get keras sequences
+  def split(n):
+    n_val = int(n * validation_split)
+    return np.arange(n - n_val), np.arange(n - n_val, n)
+
+  muon_train, muon_val = split(x_train.shape[0])
+  pu_train, pu_val = split(pu_x_train.shape[0])
+  train_seq = sequence_cls(x_train, y_train, pu_x_train, pu_y_train, pu_aux_train, discr_pt_cut=discr_pt_cut,
+                          batch_size=batch_size, shuffle=True, muon_index=muon_train, pu_index=pu_train,
+                          nbuffers=nbuffers, seed=seed)
+  val_seq = None
+  if validation_split > 0.:
+    val_seq = sequence_cls(x_train, y_train, pu_x_train, pu_y_train, pu_aux_train, discr_pt_cut=discr_pt_cut,
+                          batch_size=batch_size, shuffle=False, muon_index=muon_val, pu_index=pu_val,
+                          nbuffers=nbuffers, seed=seed)
+  return train_seq, val_seq
@@ -51,23 +51,20 @@ import numpy as np
 np.random.seed(2023)
 logger.info('Using numpy {0}'.format(np.__version__))
 
-import tensorflow as tf
-logger.info('Using tensorflow {0}'.format(tf.__version__))
+# tensorflow, keras, scipy, sklearn and matplotlib are imported on first use,
+# and the TF session is created by setup_session() (see nn_imports.py)
+from nn_imports import lazy_import, setup_session
 
-import keras
-from keras import backend as K
+tf = lazy_import('tensorflow', log_version='tensorflow')
+
+keras = lazy_import('keras', log_version='keras')
+K = lazy_import('keras.backend')
 #K.set_epsilon(1e-08)
-#K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=4, inter_op_parallelism_threads=4, allow_soft_placement=True)))
-logger.info('Using keras {0}'.format(keras.__version__))
-#logger.info('.. list devices: {0}'.format(K.get_session().list_devices()))
 
-import scipy
-logger.info('Using scipy {0}'.format(scipy.__version__))
+scipy = lazy_import('scipy', log_version='scipy')
 
-import sklearn
-logger.info('Using sklearn {0}'.format(sklearn.__version__))
+sklearn = lazy_import('sklearn', log_version='sklearn')
 
-import matplotlib.pyplot as plt
+plt = lazy_import('matplotlib.pyplot', log_version='matplotlib')
 #from matplotlib import colors
 #%matplotlib inline
-
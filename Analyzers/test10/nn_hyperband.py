@@ -0,0 +1,323 @@
+"""
+Hyperband search over the create_model_sequential_bn parameters.
+
+The configurations are drawn from 'param_grid' (same format as in
+nn_gridsearch.py) and trained by a pool of processes. Each process loads the
+muon data once and runs its own TF session with 'nthreads' threads.
+
+Each Hyperband bracket is a successive halving: n configurations are trained
+for r epochs, the best 1/eta of them continue to eta*r epochs, and so on up to
+'max_epochs'. A configuration that continues resumes from the weights saved
+at the previous budget. The brackets run concurrently: the next rung of a
+bracket is submitted as soon as its previous rung is done, so the processes
+are kept busy.
+
+The results are stored in a sqlite database, keyed by (configuration, budget).
+If the search is interrupted, running it again draws the same configurations
+and only trains what is missing. The failed trials are stored too, but they
+are trained again when the search is resumed.
+
+The search aborts if a process fails to load the data, or if no trial
+finishes within 'timeout' seconds.
+
+Usage: python nn_hyperband.py [--nprocs N] [--nthreads N] [--max-epochs R] [--eta 3] [--db hyperband.db] [--timeout T]
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import sqlite3
+import time
+
+from multiprocessing import Pool
+
+import numpy as np
+from six.moves import queue
+
+from nn_logging import getLogger
+logger = getLogger()
+
+# tensorflow must only be imported in the worker processes, after the thread
+# limits are set (nn_globals imports it lazily).
+
+
+# ______________________________________________________________________________
+# Settings
+
+nodes1 = [30,40,60,80]
+nodes2 = [20,30,40]
+nodes3 = [10,20,30]
+lr = [0.001, 0.01]
+param_grid = dict(lr=lr, nodes1=nodes1, nodes2=nodes2, nodes3=nodes3)
+
+max_epochs = 81
+
+eta = 3
+
+nprocs = 4
+
+nthreads = 2
+
+batch_size = 4096
+
+test_size = 0.31
+
+seed = 2023
+
+dbfile = 'hyperband.db'
+
+weightsdir = 'hyperband_weights'
+
+timeout = 4 * 3600  # seconds to wait for any trial to finish
+
+
+# ______________________________________________________________________________
+# Trial database
+
+class TrialDB(object):
+  def __init__(self, filename):
+    self.conn = sqlite3.connect(filename)
+    self.conn.execute('CREATE TABLE IF NOT EXISTS trials ('
+                      'key TEXT, budget INTEGER, params TEXT, val_loss REAL, seconds REAL, error TEXT, '
+                      'PRIMARY KEY (key, budget))')
+    self.conn.commit()
+    self.failed = set()  # (key, budget) of the trials that failed in this session
+
+  def get(self, key, budget):
+    # A failed trial only counts in the session that ran it, so it is retried on resume
+    if (key, budget) in self.failed:
+      return float('inf')
+    row = self.conn.execute('SELECT val_loss FROM trials WHERE key=? AND budget=? AND error IS NULL', (key, budget)).fetchone()
+    return None if row is None else row[0]
+
+  def put(self, key, budget, params, val_loss, seconds, error):
+    # sqlite stores inf as a REAL
+    if error is not None:
+      self.failed.add((key, budget))
+    else:
+      self.failed.discard((key, budget))
+    self.conn.execute('INSERT OR REPLACE INTO trials VALUES (?,?,?,?,?,?)',
+                      (key, budget, json.dumps(params, sort_keys=True), val_loss, seconds, error))
+    self.conn.commit()
+
+  def results(self):
+    rows = self.conn.execute('SELECT key, budget, params, val_loss, seconds, error FROM trials ORDER BY budget DESC, val_loss ASC')
+    return [(key, budget, json.loads(params), val_loss, seconds, error) for (key, budget, params, val_loss, seconds, error) in rows]
+
+  def close(self):
+    self.conn.close()
+
+
+def get_key(params):
+  return hashlib.md5(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+def get_weights_file(key, budget):
+  return os.path.join(weightsdir, '%s_e%i.h5' % (key, budget))
+
+
+# ______________________________________________________________________________
+# Workers
+
+_worker = {}
+
+def init_worker(nthreads, infile_muon):
+  # An exception raised by the pool initializer only makes the pool start a new
+  # process, forever. Keep the error instead, it is returned by run_trial.
+  try:
+    load_worker_data(nthreads, infile_muon)
+  except Exception as e:
+    _worker['init_error'] = repr(e)
+
+def load_worker_data(nthreads, infile_muon):
+  # Limit the threads before tensorflow is imported
+  os.environ['OMP_NUM_THREADS'] = str(nthreads)
+
+  import nn_globals
+  from nn_encode import nvariables
+  from nn_data import muon_data
+  from sklearn.model_selection import ShuffleSplit
+
+  x, y, w, x_mask = muon_data(infile_muon or nn_globals.infile_muon, adjust_scale=nn_globals.adjust_scale,
+                              reg_pt_scale=nn_globals.reg_pt_scale, correct_for_eta=False)
+  train_index, test_index = next(ShuffleSplit(n_splits=1, test_size=test_size, random_state=seed).split(x))
+
+  _worker.update(nthreads=nthreads, x_train=x[train_index], y_train=y[train_index], x_test=x[test_index], y_test=y[test_index],
+                 defaults=dict(nvariables=nvariables, lr=nn_globals.learning_rate, clipnorm=nn_globals.gradient_clip_norm,
+                               l1_reg=nn_globals.l1_reg, l2_reg=nn_globals.l2_reg))
+
+def new_session(nthreads):
+  from keras import backend as K
+  from nn_imports import setup_session
+  K.clear_session()
+  setup_session(intra_op_parallelism_threads=nthreads, inter_op_parallelism_threads=1, allow_growth=True)
+
+def run_trial(task):
+  # Train one configuration up to 'budget' epochs, starting from the weights at 'resume_budget'
+  # Returns (key, budget, val_loss, seconds, error), val_loss is None if the worker failed to initialize
+  (key, params, budget, resume_budget) = task
+
+  start = time.time()
+  if 'init_error' in _worker:
+    return (key, budget, None, 0., _worker['init_error'])
+  try:
+    from nn_models import create_model_sequential_bn, terminate_on_nan
+    new_session(_worker['nthreads'])
+    kwargs = dict(_worker['defaults'])
+    kwargs.update(params)
+    trial_batch_size = kwargs.pop('batch_size', batch_size)
+    model = create_model_sequential_bn(**kwargs)
+    if resume_budget:
+      model.load_weights(get_weights_file(key, resume_budget))
+
+    history = model.fit(_worker['x_train'], _worker['y_train'], batch_size=trial_batch_size,
+                        epochs=budget, initial_epoch=resume_budget,
+                        validation_data=(_worker['x_test'], _worker['y_test']),
+                        callbacks=[terminate_on_nan], verbose=0)
+    val_loss = float(history.history['val_loss'][-1])
+    if not np.isfinite(val_loss):
+      val_loss = float('inf')
+    else:
+      model.save_weights(get_weights_file(key, budget))
+    error = None
+  except Exception as e:
+    val_loss = float('inf')
+    error = repr(e)
+  return (key, budget, val_loss, time.time() - start, error)
+
+
+# ______________________________________________________________________________
+# Hyperband
+
+def get_configs(param_grid, n, rng):
+  # n distinct configurations drawn from the grid (all of them if the grid is smaller)
+  names = sorted(param_grid.keys())
+  grid = list(itertools.product(*[param_grid[k] for k in names]))
+  index = rng.permutation(len(grid))[:n]
+  return [dict(zip(names, grid[i])) for i in index]
+
+class Bracket(object):
+  def __init__(self, s, configs, min_budget):
+    self.s = s
+    self.configs = configs  # the configurations in the current rung
+    self.min_budget = min_budget
+    self.rung = 0
+
+  def budget(self):
+    return int(round(self.min_budget * eta**self.rung))
+
+  def done(self):
+    return self.rung > self.s or not self.configs
+
+  def advance(self, db):
+    # Keep the best 1/eta configurations when the current rung is complete. Returns True if advanced.
+    budget = self.budget()
+    losses = [db.get(get_key(params), budget) for params in self.configs]
+    if any(loss is None for loss in losses):
+      return False
+    logger.info('Bracket {0} rung {1}: {2} configurations at {3} epochs, best val_loss {4:.6f}'.format(
+        self.s, self.rung, len(self.configs), budget, min(losses)))
+    order = np.argsort(losses, kind='mergesort')
+    nkeep = max(1, len(self.configs) // eta)
+    self.configs = [self.configs[i] for i in order[:nkeep] if np.isfinite(losses[i])]
+    self.rung += 1
+    return True
+
+def make_brackets(param_grid, max_epochs, seed):
+  s_max = int(math.floor(math.log(max_epochs) / math.log(eta) + 1e-9))
+  brackets = []
+  for s in range(s_max, -1, -1):
+    n = int(math.ceil(float(s_max + 1) / (s + 1) * eta**s))
+    configs = get_configs(param_grid, n, np.random.RandomState(seed + s))
+    brackets.append(Bracket(s, configs, float(max_epochs) / eta**s))
+  return brackets
+
+def get_resume_budget(key, budget):
+  # Largest budget below 'budget' with saved weights
+  resume_budget = 0
+  for b in range(1, budget):
+    if os.path.isfile(get_weights_file(key, b)):
+      resume_budget = b
+  return resume_budget
+
+def run_search(db, pool, brackets, timeout=None):
+  finished = queue.Queue()
+  pending = {}  # (key, budget) -> params
+  while True:
+    # Advance the brackets, and submit the trials not yet in the database
+    for bracket in brackets:
+      while not bracket.done() and bracket.advance(db):
+        pass
+      if bracket.done():
+        continue
+      budget = bracket.budget()
+      for params in bracket.configs:
+        key = get_key(params)
+        if (key, budget) in pending or db.get(key, budget) is not None:
+          continue
+        task = (key, params, budget, get_resume_budget(key, budget))
+        pool.apply_async(run_trial, (task,), callback=finished.put)
+        pending[(key, budget)] = params
+
+    if not pending:
+      break
+
+    # Wait for a trial
+    try:
+      (key, budget, val_loss, seconds, error) = finished.get(timeout=timeout)
+    except queue.Empty:
+      raise RuntimeError('No trial finished in {0} seconds, {1} pending'.format(timeout, len(pending)))
+    if val_loss is None:
+      raise RuntimeError('Worker initialization failed: {0}'.format(error))
+    params = pending.pop((key, budget))
+    db.put(key, budget, params, val_loss, seconds, error)
+    if error is not None:
+      logger.warning('Trial {0} at {1} epochs failed: {2}'.format(params, budget, error))
+    else:
+      logger.info('Trial {0} at {1} epochs: val_loss {2:.6f} ({3:.0f} s)'.format(params, budget, val_loss, seconds))
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Hyperband search over the create_model_sequential_bn parameters')
+  parser.add_argument('--infile', default=None, help='muon data (default: infile_muon in nn_globals)')
+  parser.add_argument('--nprocs', type=int, default=nprocs)
+  parser.add_argument('--nthreads', type=int, default=nthreads, help='threads per process')
+  parser.add_argument('--max-epochs', type=int, default=max_epochs)
+  parser.add_argument('--eta', type=int, default=eta)
+  parser.add_argument('--db', default=dbfile)
+  parser.add_argument('--seed', type=int, default=seed)
+  parser.add_argument('--timeout', type=float, default=timeout, help='seconds to wait for any trial to finish')
+  args = parser.parse_args()
+  eta = max(2, args.eta)
+  seed = args.seed
+
+  logger.info('Using parameter grid: %r' % param_grid)
+  if not os.path.isdir(weightsdir):
+    os.makedirs(weightsdir)
+
+  db = TrialDB(args.db)
+  brackets = make_brackets(param_grid, args.max_epochs, seed)
+  for bracket in brackets:
+    logger.info('Bracket {0}: {1} configurations from {2} epochs'.format(bracket.s, len(bracket.configs), bracket.budget()))
+
+  pool = Pool(processes=args.nprocs, initializer=init_worker, initargs=(args.nthreads, args.infile))
+  try:
+    run_search(db, pool, brackets, timeout=args.timeout)
+  finally:
+    pool.terminate()
+    pool.join()
+
+  # Results
+  results = db.results()
+  if not results:
+    raise RuntimeError('No trials in the database: {0}'.format(args.db))
+  (key, budget, params, val_loss, seconds, error) = results[0]
+  print('Best: %f using %s at %i epochs' % (val_loss, params, budget))
+  for (key, budget, params, val_loss, seconds, error) in results:
+    print('%f at %i epochs (%.0f s) with: %r' % (val_loss, budget, seconds, params))
+  db.close()
+
+  logger.info('DONE')
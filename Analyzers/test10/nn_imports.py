@@ -0,0 +1,160 @@
+"""
+Lazy imports of the heavy libraries, and the explicit setup of the TF session.
+
+nn_globals and cnn_globals export tf, keras, K, scipy, sklearn and plt as
+LazyModule objects: the library is imported on the first attribute access,
+e.g. tf.Session or plt.figure, so the constants can be imported by any script
+or Condor worker without paying for tensorflow.
+
+The TF session is no longer created at import time. Call setup_session() to
+create it with the wanted thread pools, before building a model.
+
+Running this module measures the import time and the peak memory (max RSS) of
+the entry points, each in a fresh interpreter.
+
+Usage: python nn_imports.py [--repeat N] [module ...]
+"""
+
+import importlib
+import types
+
+from nn_logging import getLogger
+logger = getLogger()
+
+
+# ______________________________________________________________________________
+class LazyModule(types.ModuleType):
+  def __init__(self, name, on_load=None):
+    super(LazyModule, self).__init__(name)
+    self.__dict__['_lazy_name'] = name
+    self.__dict__['_lazy_on_load'] = on_load
+    self.__dict__['_lazy_module'] = None
+
+  def _load(self):
+    module = self.__dict__['_lazy_module']
+    if module is None:
+      module = importlib.import_module(self.__dict__['_lazy_name'])
+      self.__dict__['_lazy_module'] = module
+      on_load = self.__dict__['_lazy_on_load']
+      if on_load is not None:
+        on_load(module)
+    return module
+
+  def __getattr__(self, attr):
+    # Only called for the attributes not found in the proxy itself
+    return getattr(self._load(), attr)
+
+  def __setattr__(self, attr, value):
+    setattr(self._load(), attr, value)
+
+  def __dir__(self):
+    return dir(self._load())
+
+  def __repr__(self):
+    if self.__dict__['_lazy_module'] is None:
+      return '<lazy module {0!r} (not loaded)>'.format(self.__dict__['_lazy_name'])
+    return repr(self.__dict__['_lazy_module'])
+
+  def is_loaded(self):
+    return self.__dict__['_lazy_module'] is not None
+
+
+def lazy_import(name, log_version=None):
+  # log_version: logs 'Using <log_version> <version>' when the library is loaded
+  on_load = None
+  if log_version is not None:
+    def on_load(module):
+      import sys
+      logger.info('Using {0} {1}'.format(log_version, getattr(sys.modules[name.split('.')[0]], '__version__', 'n/a')))
+  return LazyModule(name, on_load)
+
+
+# ______________________________________________________________________________
+def setup_session(intra_op_parallelism_threads=0, inter_op_parallelism_threads=0, allow_soft_placement=True,
+                  allow_growth=False, list_devices=False):
+  # Create the TF session used by keras. 0 threads means the TF default (number of cores)
+  import tensorflow as tf
+  from keras import backend as K
+  config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_parallelism_threads,
+                          inter_op_parallelism_threads=inter_op_parallelism_threads,
+                          allow_soft_placement=allow_soft_placement)
+  config.gpu_options.allow_growth = allow_growth
+  sess = tf.Session(config=config)
+  K.set_session(sess)
+  logger.info('Using TF session with intra_op_parallelism_threads={0}, inter_op_parallelism_threads={1}'.format(
+      intra_op_parallelism_threads, inter_op_parallelism_threads))
+  if list_devices:
+    logger.info('.. list devices: {0}'.format(sess.list_devices()))
+  return sess
+
+
+# ______________________________________________________________________________
+# Startup benchmark
+
+# Modules to import, with the extra sys.path entries
+startup_modules = [
+  ('nn_encode', []),
+  ('nn_data', []),
+  ('nn_globals', []),
+  ('cnn_globals', []),
+  ('nn_models', []),
+  ('rootpy_trackbuilding8', ['../test7']),
+]
+
+_startup_code = """
+import resource, sys, time
+sys.path[:0] = {path!r}
+t0 = time.time()
+import {name}
+t1 = time.time()
+print('%f %i' % (t1 - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+"""
+
+def time_import(name, path=(), repeat=5):
+  # Returns (median seconds, max RSS in kB), or None if the import fails
+  import os
+  import subprocess
+  import sys
+  import numpy as np
+
+  # Run from this directory, the paths are relative to it
+  cwd = os.path.dirname(os.path.abspath(__file__))
+
+  times, rss = [], []
+  for i in range(repeat):
+    code = _startup_code.format(name=name, path=list(path))
+    proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+      logger.warning('Failed to import {0}: {1}'.format(name, err.decode('utf-8', 'replace').strip().splitlines()[-1:]))
+      return None
+    t, r = out.decode('utf-8').strip().splitlines()[-1].split()
+    times.append(float(t))
+    rss.append(int(r))
+  return (float(np.median(times)), max(rss))
+
+
+if __name__ == '__main__':
+  import argparse
+  import numpy as np
+
+  parser = argparse.ArgumentParser(description='Measure the import time and memory of the entry points')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('modules', nargs='*', help='modules to import (default: %s)' % ' '.join(name for (name, path) in startup_modules))
+  args = parser.parse_args()
+
+  modules = [(name, []) for name in args.modules] if args.modules else startup_modules
+  names, results = [], []
+  for (name, path) in modules:
+    result = time_import(name, path, repeat=args.repeat)
+    if result is None:
+      print('{0:<24s} FAILED'.format(name))
+      result = (np.nan, 0)
+    else:
+      print('{0:<24s} {1:7.3f} s {2:9d} kB'.format(name, result[0], result[1]))
+    names.append(name)
+    results.append(result)
+
+  outfile = 'benchmark_imports.npz'
+  print('[INFO] Creating file: %s' % outfile)
+  np.savez_compressed(outfile, names=names, results=np.array(results, dtype=np.float64))
@@ -3,10 +3,6 @@ os.environ['KERAS_BACKEND'] = 'tensorflow'
 
 import numpy as np
 
-import tensorflow as tf
-
-from keras import backend as K
-
 from nn_logging import getLogger
 logger = getLogger()
 
@@ -14,98 +10,141 @@ logger = getLogger()
 # ______________________________________________________________________________
 # The following codes are taken from hls4ml/Javier:
 #   https://github.com/hls-fpga-machine-learning/keras-training/blob/muon/train/prune.py
+# The weights are ranked by their magnitude relative to the L2 norm of the
+# kernel of their layer. Only the kernels of the hidden layers ('dense_*') are
+# pruned, the biases and the output layers are kept.
 
-def prune_model(model, percentile=50.):
-  sess = K.get_session()
+def get_kernel(layer):
+  # Kernel of a Dense/Conv1D layer, None for the other layers
+  if layer.__class__.__name__ in ['Dense', 'Conv1D']:
+    for my_weights in layer.get_weights():
+      if len(my_weights.shape) >= 2:  # ignore the bias term
+        return my_weights
+  return None
 
-  # Find weights
-  allWeights = []
-  allWeightsNonRel = []
+def is_prunable(layer):
+  return layer.name.startswith('dense_')  # only apply to hidden layers
+
+def prune_model(model, percentile=50., masks=None):
+  # Drop the weights with relative magnitude below the given percentile of all the kernels.
+  # If 'masks' is given (the binary tensors of a previous call), the dropped weights stay dropped.
+  weightsPerLayer = {}
+  droppedPerLayer = {}
+  binaryTensorPerLayer = {}
   allWeightsByLayer = {}
-  allWeightsByLayerNonRel = {}
-  tensorMaxByLayer = {}
   for layer in model.layers:
-    if layer.__class__.__name__ in ['Dense', 'Conv1D']:
-      original_w = layer.get_weights()
-      weightsByLayer = []
-      weightsByLayerNonRel = []
-      for my_weights in original_w:
-        if len(my_weights.shape) < 2: # bias term, ignore for now
-          continue
-        #l1norm = tf.norm(my_weights,ord=1)
-        elif len(my_weights.shape) == 2: # Dense
-          # (n_inputs, n_outputs)
-          #tensor_abs = tf.abs(my_weights)
-          #tensor_reduce_max_1 = tf.reduce_max(tensor_abs,axis=-1)
-          #tensor_reduce_max_2 = tf.reduce_max(tensor_reduce_max_1,axis=-1)
-          tensor_sq = tf.square(my_weights)
-          tensor_reduce_sum_1 = tf.reduce_sum(tensor_sq,axis=-1)
-          tensor_reduce_sum_2 = tf.reduce_sum(tensor_reduce_sum_1,axis=-1)
-        elif len(my_weights.shape) == 3: # Conv1D
-          # (filter_width, n_inputs, n_filters)
-          #tensor_abs = tf.abs(my_weights)
-          #tensor_reduce_max_0 = tf.reduce_max(tensor_abs,axis=-1)
-          #tensor_reduce_max_1 = tf.reduce_max(tensor_reduce_max_0,axis=-1)
-          #tensor_reduce_max_2 = tf.reduce_max(tensor_reduce_max_1,axis=-1)
-          tensor_sq = tf.square(my_weights)
-          tensor_reduce_sum_0 = tf.reduce_sum(tensor_sq,axis=-1)
-          tensor_reduce_sum_1 = tf.reduce_sum(tensor_reduce_sum_0,axis=-1)
-          tensor_reduce_sum_2 = tf.reduce_sum(tensor_reduce_sum_1,axis=-1)
-
-        #l1norm_val = float(l1norm.eval(session=sess))
-        #tensor_max = float(tensor_reduce_max_2.eval(session=sess))
-        tensor_max = float(tf.sqrt(tensor_reduce_sum_2).eval(session=sess))
-        it = np.nditer(my_weights, flags=['multi_index'], op_flags=['readonly'])
-        while not it.finished:
-          w = it[0]
-          allWeights.append(abs(w)/tensor_max)
-          allWeightsNonRel.append(abs(w))
-          weightsByLayer.append(abs(w)/tensor_max)
-          weightsByLayerNonRel.append(abs(w))
-          it.iternext()
-      if len(weightsByLayer):
-        allWeightsByLayer[layer.name] = np.asarray(weightsByLayer)
-        allWeightsByLayerNonRel[layer.name] = np.asarray(weightsByLayerNonRel)
-        tensorMaxByLayer[layer.name] = tensor_max
-
-  allWeightsArray = np.asarray(allWeights)
-  allWeightsArrayNonRel = np.asarray(allWeightsNonRel)
+    droppedPerLayer[layer.name] = []
+    my_weights = get_kernel(layer)
+    if my_weights is None:
+      continue
+    weightsPerLayer[layer.name] = layer.get_weights()
+    if masks is not None and layer.name in masks:
+      my_weights = my_weights * masks[layer.name]
+    tensor_max = np.sqrt(np.square(my_weights, dtype=np.float64).sum())
+    allWeightsByLayer[layer.name] = np.abs(my_weights).ravel() / max(tensor_max, 1e-30)
+
+  allWeightsArray = np.concatenate([allWeightsByLayer[layer.name] for layer in model.layers if layer.name in allWeightsByLayer])
 
   # Set pruning criteria
   relative_weight_max = np.percentile(allWeightsArray, percentile, axis=-1)
 
   # Find weights that can be pruned
-  weightsPerLayer = {}
-  droppedPerLayer = {}
-  binaryTensorPerLayer = {}
   for layer in model.layers:
-    droppedPerLayer[layer.name] = []
-    if layer.__class__.__name__ in ['Dense', 'Conv1D']:
-      original_w = layer.get_weights()
-      weightsPerLayer[layer.name] = original_w
-      for my_weights in original_w:
-        if len(my_weights.shape) < 2: # bias term, ignore for now
-          continue
-
-        tensor_max = tensorMaxByLayer[layer.name]
-        binaryTensorPerLayer[layer.name] = np.ones(my_weights.shape, dtype=np.bool)
-        it = np.nditer(my_weights, flags=['multi_index'], op_flags=['readonly'])
-        while not it.finished:
-          w = it[0]
-          if abs(w)/tensor_max < relative_weight_max and layer.name.startswith('dense_'):  # only apply to hidden layers
-            #print "small relative weight %e/%e = %e -> 0"%(abs(w), tensor_max, abs(w)/tensor_max)
-            #w[...] = 0
-            droppedPerLayer[layer.name].append((it.multi_index, abs(w)))
-            binaryTensorPerLayer[layer.name][it.multi_index] = 0
-          it.iternext()
-      #print '%i weights dropped from %s out of %i weights'%(len(droppedPerLayer[layer.name]),layer.name,layer.count_params())
-      #converted_w = convert_kernel(original_w)
-      #converted_w = original_w
-      #layer.set_weights(converted_w)
+    if layer.name not in allWeightsByLayer:
+      continue
+    shape = get_kernel(layer).shape
+    relative_weights = allWeightsByLayer[layer.name].reshape(shape)
+    binary_tensor = np.ones(shape, dtype=bool)
+    if is_prunable(layer):
+      binary_tensor = relative_weights >= relative_weight_max
+      if masks is not None and layer.name in masks:
+        binary_tensor &= masks[layer.name].astype(bool)
+      dropped = np.argwhere(~binary_tensor)
+      abs_weights = np.abs(get_kernel(layer))
+      droppedPerLayer[layer.name] = [(tuple(index), abs_weights[tuple(index)]) for index in dropped]
+    binaryTensorPerLayer[layer.name] = binary_tensor
 
   for layer in model.layers:
     logger.info('{0} weights dropped from {1} out of {2} weights.'.format(len(droppedPerLayer[layer.name]), layer.name, layer.count_params()))
-  totalDropped = sum(len(k) for v, k in droppedPerLayer.iteritems())
+  totalDropped = sum(len(v) for v in droppedPerLayer.values())
   logger.info('{0} total weights dropped out of {1} total weights.'.format(totalDropped, model.count_params()))
   logger.info('{0} was pruned with {1:.1f}% compression.'.format(model.name, 100.*totalDropped/model.count_params()))
   return weightsPerLayer, droppedPerLayer, binaryTensorPerLayer, allWeightsByLayer, allWeightsArray
+
+
+# ______________________________________________________________________________
+# Sparsity report
+
+def count_macs(model):
+  # Returns [(layer name, kernel shape, nonzero weights, total weights, MACs, dense MACs)]
+  # The MACs are the multiplications by nonzero weights per inference, the bias additions are not counted
+  rows = []
+  for layer in model.layers:
+    my_weights = get_kernel(layer)
+    if my_weights is None:
+      continue
+    nonzero = int(np.count_nonzero(my_weights))
+    total = int(my_weights.size)
+    nsteps = 1
+    if layer.__class__.__name__ == 'Conv1D':
+      nsteps = int(layer.output_shape[1])  # the kernel is applied at each output step
+    rows.append((layer.name, my_weights.shape, nonzero, total, nonzero * nsteps, total * nsteps))
+  return rows
+
+def report_sparsity(model):
+  rows = count_macs(model)
+  for (name, shape, nonzero, total, macs, dense_macs) in rows:
+    logger.info('{0:<12s} {1!s:<12s} nonzero: {2:6d}/{3:6d} sparsity: {4:5.1f}% MACs: {5:6d}'.format(
+        name, shape, nonzero, total, 100.*(total-nonzero)/total, macs))
+  macs = sum(row[4] for row in rows)
+  dense_macs = sum(row[5] for row in rows)
+  logger.info('{0} has {1} MACs per inference, {2} without pruning ({3:.1f}% saved).'.format(
+      model.name, macs, dense_macs, 100.*(dense_macs-macs)/max(dense_macs, 1)))
+  return rows
+
+
+# ______________________________________________________________________________
+# Gradual pruning
+
+def get_pruning_schedule(percentile=50., nsteps=5, initial_percentile=0.):
+  # Polynomial schedule from Zhu & Gupta (arXiv:1710.01878): prune fast at first, then slowly
+  steps = np.arange(1, nsteps+1, dtype=np.float64)
+  return percentile + (initial_percentile - percentile) * (1. - steps/nsteps)**3
+
+def rebuild_pruned_model(model, build_fn, masks):
+  # Build a model with ZeroSomeWeights constraints on the hidden layers, with the weights of 'model'.
+  # 'build_fn' takes constraint1, constraint2, ... e.g. functools.partial(create_model_pruned, nvariables=nvariables, ...)
+  # Returns the new model and the masks keyed by the new layer names.
+  from nn_models import ZeroSomeWeights
+
+  constraints = {}
+  for layer in model.layers:
+    if is_prunable(layer) and layer.name in masks:
+      constraints['constraint%i' % (len(constraints)+1)] = ZeroSomeWeights(masks[layer.name])
+  new_model = build_fn(**constraints)
+
+  new_masks = {}
+  assert(len(new_model.layers) == len(model.layers))
+  for layer, new_layer in zip(model.layers, new_model.layers):
+    weights = layer.get_weights()
+    if layer.name in masks:
+      new_masks[new_layer.name] = masks[layer.name]
+      # The constraint is only applied after an update, so zero the weights now
+      weights = [w * masks[layer.name] if w.shape == masks[layer.name].shape else w for w in weights]
+    new_layer.set_weights(weights)
+  return new_model, new_masks
+
+def prune_model_gradually(model, build_fn, x, y, percentile=50., nsteps=5, epochs_per_step=10, initial_percentile=0., **kwargs):
+  # Prune to the percentile of the schedule, then fine-tune with the dropped weights fixed at zero, and repeat.
+  # The other arguments (batch_size, callbacks, validation_split, ...) are passed to model.fit
+  masks = None
+  history = None
+  for step, p in enumerate(get_pruning_schedule(percentile, nsteps, initial_percentile)):
+    logger.info('Pruning step {0}/{1}: percentile {2:.1f}'.format(step+1, nsteps, p))
+    pruned = prune_model(model, percentile=p, masks=masks)
+    binaryTensorPerLayer = pruned[2]
+    masks = dict((layer.name, binaryTensorPerLayer[layer.name]) for layer in model.layers if is_prunable(layer) and layer.name in binaryTensorPerLayer)
+    model, masks = rebuild_pruned_model(model, build_fn, masks)
+    history = model.fit(x, y, epochs=epochs_per_step, **kwargs)
+    report_sparsity(model)
+  return model, masks, history
@@ -4,7 +4,10 @@ import sys
 from nn_logging import getLogger
 logger = getLogger()
 
+from keras.utils import Sequence
+
 from nn_models import save_my_model
+from nn_data import MixingSequenceBase
 
 
 # ______________________________________________________________________________
@@ -31,6 +34,14 @@ class TrainingLog(object):
     self.file.flush()
 
 
+# ______________________________________________________________________________
+# Muon/pileup mixing sequence (see nn_data.MixingSequenceBase), e.g.
+# mix_training_sequences(..., sequence_cls=MixingSequence)
+
+class MixingSequence(MixingSequenceBase, Sequence):
+  pass
+
+
 # ______________________________________________________________________________
 def train_model(model, x, y, model_name='model', batch_size=None, epochs=1, verbose=1, callbacks=None,
                 validation_split=0., shuffle=True, class_weight=None, sample_weight=None):
@@ -45,3 +56,24 @@ def train_model(model, x, y, model_name='model', batch_size=None, epochs=1, verb
 
   save_my_model(model, name=model_name)
   return history
+
+
+def train_model_sequence(model, sequence, validation_data=None, model_name='model', epochs=1, verbose=1, callbacks=None,
+                         workers=4, use_multiprocessing=False, max_queue_size=10):
+  # sequence is a keras.utils.Sequence, e.g. MixingSequence
+  nbuffers = len(getattr(sequence, 'buffers', ()))
+  if nbuffers and not use_multiprocessing and workers > 0:
+    assert(nbuffers >= max_queue_size + 2), 'Need at least {0} batch buffers, got {1}'.format(max_queue_size + 2, nbuffers)
+
+  start_time = datetime.datetime.now()
+  logger.info('Begin training ...')
+
+  with TrainingLog() as tlog:  # redirect sys.stdout
+    history = model.fit_generator(sequence, steps_per_epoch=len(sequence), epochs=epochs, verbose=verbose, callbacks=callbacks,
+                                  validation_data=validation_data, validation_steps=(len(validation_data) if validation_data is not None else None),
+                                  max_queue_size=max_queue_size, workers=workers, use_multiprocessing=use_multiprocessing, shuffle=False)
+
+  logger.info('Done training. Time elapsed: {0} sec'.format(str(datetime.datetime.now() - start_time)))
+
+  save_my_model(model, name=model_name)
+  return history
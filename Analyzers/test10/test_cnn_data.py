@@ -0,0 +1,121 @@
+"""Tests of the batched SparseImageAugmenter in cnn_data.py against the same
+translations and mirror flips done on the dense images.
+
+Usage: python -m pytest test_cnn_data.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+if 'CMSSW_VERSION' not in os.environ:
+  pytest.skip('cnn_globals needs a CMSSW environment', allow_module_level=True)
+
+from cnn_globals import n_rows, n_columns, n_channels, n_classes, sector_hits_capacity
+from cnn_data import SparseImageAugmenter, parse_image_batch_fn
+
+
+# ______________________________________________________________________________
+# Fixtures
+
+@pytest.fixture
+def batch():
+  # Random sparse images (image_pixels, image_channels, labels, parameters), as stored in the npz files
+  rng = np.random.RandomState(2026)
+  n = 200
+  pixels = np.full((n, sector_hits_capacity, 2), -99, dtype=np.int32)
+  channels = np.full((n, sector_hits_capacity, n_channels), np.nan, dtype=np.float32)
+  for i in range(n):
+    k = rng.randint(0, sector_hits_capacity+1)
+    flat = rng.choice(n_rows * n_columns, size=k, replace=False)
+    pixels[i,:k,0], pixels[i,:k,1] = flat // n_columns, flat % n_columns
+    channels[i,:k] = rng.uniform(size=(k, n_channels))
+  sector = rng.randint(0, 12, size=n)
+  glob = rng.uniform(-10., 50., size=n) + 15. + 60. * (sector % 6)
+  parameters = np.stack((rng.uniform(-0.5, 0.5, size=n), np.deg2rad((glob + 180.) % 360. - 180.),
+                         rng.uniform(1.2, 2.4, size=n), sector), axis=1).astype(np.float32)
+  labels = np.stack((rng.randint(0, n_classes, size=n), rng.randint(0, 128, size=n), rng.randint(0, 4, size=n)), axis=1).astype(np.int32)
+  shifts = rng.randint(-14, 14+1, size=n)
+  flips = rng.uniform(size=n) < 0.5
+  return (pixels, channels, labels, parameters, shifts, flips)
+
+def transform_dense(images, shifts, flips):
+  # Mirror and translate the dense images, one image at a time
+  out = np.zeros_like(images)
+  for i, (image, shift, flip) in enumerate(zip(images, shifts, flips)):
+    if flip:
+      image = image[:,::-1,::-1]  # the bend channel becomes 1 - bend, i.e. the two channels are swapped
+    if shift >= 0:
+      out[i,:,shift:] = image[:,:n_columns-shift]
+    else:
+      out[i,:,:shift] = image[:,-shift:]
+  return out
+
+
+# ______________________________________________________________________________
+# Tests
+
+def test_same_as_dense(batch):
+  (pixels, channels, labels, parameters, shifts, flips) = batch
+  augmenter = SparseImageAugmenter()
+  new_pixels, new_channels, new_labels = augmenter.augment(pixels, channels, labels, shifts=shifts, flips=flips)
+  images = transform_dense(parse_image_batch_fn(pixels, channels), shifts, flips)
+  # 1 - (1 - bend) is not exact in float32
+  assert np.allclose(parse_image_batch_fn(new_pixels, new_channels), images, rtol=0., atol=1e-6)
+
+  # The pixels shifted out of the image are masked
+  masked = (new_pixels[:,:,0] == -99)
+  assert np.isnan(new_channels[masked]).all()
+  assert not np.isnan(new_channels[~masked]).any()
+
+def test_inputs_unchanged(batch):
+  (pixels, channels, labels, parameters, shifts, flips) = batch
+  copies = [x.copy() for x in (pixels, channels, labels, parameters)]
+  SparseImageAugmenter().augment(pixels, channels, labels, parameters, shifts=shifts, flips=flips)
+  for x, y in zip((pixels, channels, labels, parameters), copies):
+    assert np.array_equal(x, y, equal_nan=True)
+
+def test_mirror_twice(batch):
+  (pixels, channels, labels, parameters, shifts, flips) = batch
+  augmenter = SparseImageAugmenter()
+  zeros, ones = np.zeros_like(shifts), np.ones_like(flips)
+  mirrored = augmenter.augment(pixels, channels, labels, parameters, shifts=zeros, flips=ones)
+  outputs = augmenter.augment(*mirrored, shifts=zeros, flips=ones)
+  assert np.array_equal(outputs[0], pixels)
+  assert np.allclose(outputs[1], channels, rtol=0., atol=1e-6, equal_nan=True)
+  assert np.array_equal(outputs[2][:,0::2], labels[:,0::2])
+  # The sector phi class is clipped to [0, 127], and is only restored if it stays inside
+  inside = (0 < mirrored[2][:,1]) & (mirrored[2][:,1] < 127)
+  assert inside.any()
+  assert np.array_equal(outputs[2][inside,1], labels[inside,1])
+  assert np.allclose(outputs[3], parameters, atol=1e-5)
+
+def test_mirror_labels(batch):
+  (pixels, channels, labels, parameters, shifts, flips) = batch
+  augmenter = SparseImageAugmenter()
+  new_pixels, new_channels, new_labels, new_parameters = augmenter.augment(pixels, channels, labels, parameters, shifts=shifts, flips=flips)
+  assert np.array_equal(new_labels[:,0], np.where(flips, (n_classes-1) - labels[:,0], labels[:,0]))
+  assert np.array_equal(new_parameters[:,0], np.where(flips, -parameters[:,0], parameters[:,0]))
+  assert np.array_equal(new_labels[:,2], labels[:,2])
+  assert np.array_equal(new_parameters[:,2:], parameters[:,2:])
+
+def test_shift_back(batch):
+  (pixels, channels, labels, parameters, shifts, flips) = batch
+  augmenter = SparseImageAugmenter()
+  no_flips = np.zeros_like(flips)
+  outputs = augmenter.augment(pixels, channels, labels, parameters, shifts=shifts, flips=no_flips)
+  outputs = augmenter.augment(*outputs, shifts=-shifts, flips=no_flips)
+  # The pixels that stay in the image are restored
+  kept = (outputs[0][:,:,0] != -99)
+  assert np.array_equal(outputs[0][kept], pixels[kept])
+  assert np.array_equal(outputs[1][kept], channels[kept])
+  assert np.array_equal(outputs[2][:,0], labels[:,0])
+  assert np.allclose(outputs[3], parameters, atol=1e-5)
+
+def test_call(batch):
+  (pixels, channels, labels, parameters, shifts, flips) = batch
+  x_misc, y = SparseImageAugmenter(seed=1)([pixels, channels], labels)
+  outputs = SparseImageAugmenter(seed=1).augment(pixels, channels, labels)
+  for x, y_ref in zip(x_misc + [y], outputs):
+    assert np.array_equal(x, y_ref, equal_nan=True)
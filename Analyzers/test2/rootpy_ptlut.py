@@ -19,6 +19,56 @@ kDT, kCSC, kRPC, kGEM, kTT = 0, 1, 2, 3, 20
 import mmap
 import struct
 
+# Non-linear dPhi bins, from L1Trigger/L1TMuonEndCap/src/PtAssignmentEngineAux2017.cc
+dPhiNLBMap_4bit_256Max = (
+  0, 1, 2, 3, 4, 6, 8, 10, 12, 16, 20, 25, 31, 46, 68, 136
+)
+assert(len(dPhiNLBMap_4bit_256Max) == 16)
+
+dPhiNLBMap_5bit_256Max = (
+   0,  1,  2,  3,  4,  5,  6,  7,  8,  9, 10, 11, 12, 13, 14, 15,
+  16, 17, 19, 20, 21, 23, 25, 28, 31, 34, 39, 46, 55, 68, 91, 136
+)
+assert(len(dPhiNLBMap_5bit_256Max) == 32)
+
+dPhiNLBMap_7bit_512Max = (
+    0,   1,   2,   3,   4,   5,   6,   7,   8,   9,  10,  11,  12,  13,  14,  15,
+   16,  17,  18,  19,  20,  21,  22,  23,  24,  25,  26,  27,  28,  29,  30,  31,
+   32,  33,  34,  35,  36,  37,  38,  39,  40,  41,  42,  43,  44,  45,  46,  47,
+   48,  49,  50,  51,  52,  53,  54,  55,  56,  57,  58,  59,  60,  61,  62,  63,
+   64,  65,  66,  67,  68,  69,  71,  72,  73,  74,  75,  76,  77,  79,  80,  81,
+   83,  84,  86,  87,  89,  91,  92,  94,  96,  98, 100, 102, 105, 107, 110, 112,
+  115, 118, 121, 124, 127, 131, 135, 138, 143, 147, 152, 157, 162, 168, 174, 181,
+  188, 196, 204, 214, 224, 235, 247, 261, 276, 294, 313, 336, 361, 391, 427, 470
+)
+assert(len(dPhiNLBMap_7bit_512Max) == 128)
+
+# Compressed CLCT pattern words, indexed by CLCT pattern (0-10), for sign > 0 and sign < 0
+CLCTMap_2bit = (
+  (0, 0, 3, 0, 3, 0, 3, 0, 2, 1, 1),
+  (0, 3, 0, 3, 0, 3, 0, 3, 1, 2, 1),
+)
+CLCTMap_3bit = (
+  (0, 1, 7, 1, 7, 1, 6, 2, 5, 3, 4),
+  (0, 7, 1, 7, 1, 7, 2, 6, 3, 5, 4),
+)
+
+# Station indices and mode ID, by mode: (mode_ID, iA, iB, iC, iD)
+# 'A' is first station in the track, 'B' the second, etc
+ptlut_mode_stations = {
+  15: (0b001, 0, 1, 2, 3),
+  14: (0b011, 0, 1, 2, 99),
+  13: (0b010, 0, 1, 3, 99),
+  11: (0b001, 0, 2, 3, 99),
+   7: (0b001, 1, 2, 3, 99),
+  12: (0b111, 0, 1, 99, 99),
+  10: (0b110, 0, 2, 99, 99),
+   9: (0b101, 0, 3, 99, 99),
+   6: (0b100, 1, 2, 99, 99),
+   5: (0b011, 1, 3, 99, 99),
+   3: (0b010, 2, 3, 99, 99),
+}
+
 class EMTFTrack(object):
   def __init__(self):
     pass
@@ -38,8 +88,11 @@ class EMTFPtAssignment(object):
     self.ptlut_path = "LUT_v07_07June17.dat"
     self.ptlut_file = open(self.ptlut_path, "rb")
     self.ptlut_mmap = mmap.mmap(self.ptlut_file.fileno(), 0, prot=mmap.PROT_READ)
+    # Same file viewed as an array of 32-bit words, used for bulk lookups
+    self.ptlut_words = np.memmap(self.ptlut_path, dtype='<u4', mode='r')
 
   def _unload_ptlut(self):
+    self.ptlut_words = None
     self.ptlut_mmap.close()
     self.ptlut_file.close
 
@@ -78,6 +131,31 @@ class EMTFPtAssignment(object):
     xml_pt *= pt_unscale
     return xml_pt
 
+  def convert_to_gmt_pt_array(self, xml_pt):
+    # Same as convert_to_gmt_pt(), vectorized
+    pt = np.asarray(xml_pt, dtype=np.float64)
+    pt = np.where(pt < 0., 1., pt)
+    #
+    max_pt = np.minimum(20., pt)
+    pt_scale = 1.2 / (1 - 0.015*max_pt)
+    pt = pt * pt_scale
+    #
+    gmt_pt = (pt * 2) + 1
+    gmt_pt = gmt_pt.astype(np.int32)
+    gmt_pt = np.minimum(gmt_pt, 511)
+    return gmt_pt
+
+  def convert_to_xml_pt_array(self, gmt_pt):
+    # Same as convert_to_xml_pt(), vectorized
+    gmt_pt = np.asarray(gmt_pt)
+    pt = np.where(gmt_pt <= 0, 0., (gmt_pt-1) * 0.5)
+    #
+    pt_unscale = 1 / (1.2 + 0.015*pt)
+    pt_unscale = np.maximum(pt_unscale, (1 - 0.015*20)/1.2)
+    #
+    xml_pt = pt * pt_unscale
+    return xml_pt
+
   # ____________________________________________________________________________
   def lookup(self, ptlut_addr):
     mm = self.ptlut_mmap
@@ -92,6 +170,17 @@ class EMTFPtAssignment(object):
     xml_pt = self.convert_to_xml_pt(pt_value)
     return xml_pt
 
+  def lookup_array(self, ptlut_addr):
+    # Same as lookup(), but for an array of addresses
+    ptlut_addr = np.asarray(ptlut_addr, dtype=np.int64)
+    if ptlut_addr.size and (ptlut_addr.min() < 0 or (ptlut_addr.max()//2) >= len(self.ptlut_words)):
+      raise IndexError('pT LUT address out of range')
+    pt_word = self.ptlut_words[ptlut_addr//2]  # each address contains two pt values, stored as 32-bit (4-byte)
+    shift = (ptlut_addr % 2) * 9                # low bit of address selects value (stored in 9 bits)
+    pt_value = (pt_word >> shift.astype(np.uint32)) & 0x1FF
+    xml_pt = self.convert_to_xml_pt_array(pt_value.astype(np.int32))
+    return xml_pt
+
   # ____________________________________________________________________________
   def make_track(self, hits):
     track = None
@@ -201,28 +290,11 @@ class EMTFPtAssignment(object):
 
   def getNLBdPhiBin(self, dPhi, bits, max_):
     if not hasattr(self, 'dPhiNLBMap_4bit_256Max'):
-      self.dPhiNLBMap_4bit_256Max = (
-        0, 1, 2, 3, 4, 6, 8, 10, 12, 16, 20, 25, 31, 46, 68, 136
-      )
-      assert(len(self.dPhiNLBMap_4bit_256Max) == 16)
+      self.dPhiNLBMap_4bit_256Max = dPhiNLBMap_4bit_256Max
     if not hasattr(self, 'dPhiNLBMap_5bit_256Max'):
-      self.dPhiNLBMap_5bit_256Max = (
-         0,  1,  2,  3,  4,  5,  6,  7,  8,  9, 10, 11, 12, 13, 14, 15,
-        16, 17, 19, 20, 21, 23, 25, 28, 31, 34, 39, 46, 55, 68, 91, 136
-      )
-      assert(len(self.dPhiNLBMap_5bit_256Max) == 32)
+      self.dPhiNLBMap_5bit_256Max = dPhiNLBMap_5bit_256Max
     if not hasattr(self, 'dPhiNLBMap_7bit_512Max'):
-      self.dPhiNLBMap_7bit_512Max = (
-          0,   1,   2,   3,   4,   5,   6,   7,   8,   9,  10,  11,  12,  13,  14,  15,
-         16,  17,  18,  19,  20,  21,  22,  23,  24,  25,  26,  27,  28,  29,  30,  31,
-         32,  33,  34,  35,  36,  37,  38,  39,  40,  41,  42,  43,  44,  45,  46,  47,
-         48,  49,  50,  51,  52,  53,  54,  55,  56,  57,  58,  59,  60,  61,  62,  63,
-         64,  65,  66,  67,  68,  69,  71,  72,  73,  74,  75,  76,  77,  79,  80,  81,
-         83,  84,  86,  87,  89,  91,  92,  94,  96,  98, 100, 102, 105, 107, 110, 112,
-        115, 118, 121, 124, 127, 131, 135, 138, 143, 147, 152, 157, 162, 168, 174, 181,
-        188, 196, 204, 214, 224, 235, 247, 261, 276, 294, 313, 336, 361, 391, 427, 470
-      )
-      assert(len(self.dPhiNLBMap_7bit_512Max) == 128)
+      self.dPhiNLBMap_7bit_512Max = dPhiNLBMap_7bit_512Max
 
     assert((bits == 4 and max_ == 256) or (bits == 5 and max_ == 256) or (bits == 7 and max_ == 512))
     dPhiBin_ = (1 << bits) - 1
@@ -534,6 +606,227 @@ class EMTFPtAssignment(object):
     xml_pt = self.lookup(address)
     return xml_pt
 
+  def calculate_pt_array(self, addresses):
+    xml_pt = self.lookup_array(addresses)
+    return xml_pt
+
+  # ____________________________________________________________________________
+  # Vectorized address calculation, for many tracks at once. The station arrays
+  # have shape (ntracks, 4); entries of stations not in the track mode are ignored.
+
+  def get_station_arrays(self, tracks):
+    ntracks = len(tracks)
+    mode = np.zeros(ntracks, dtype=np.int32)
+    theta = np.zeros(ntracks, dtype=np.int32)
+    endcap = np.zeros(ntracks, dtype=np.int32)
+    st1_ring2 = np.zeros(ntracks, dtype=np.int32)
+    emtf_phi = np.zeros((ntracks, 4), dtype=np.int32)
+    emtf_theta = np.zeros((ntracks, 4), dtype=np.int32)
+    cpattern = np.zeros((ntracks, 4), dtype=np.int32)
+    fr = np.zeros((ntracks, 4), dtype=np.int32)
+
+    for itrk, track in enumerate(tracks):
+      mode[itrk] = track.mode
+      theta[itrk] = track.theta
+      endcap[itrk] = track.hits[0].endcap
+      st1_ring2[itrk] = track.ptlut_data.st1_ring2
+      for hit in track.hits:
+        ist = hit.station - 1
+        emtf_phi[itrk, ist] = hit.emtf_phi
+        emtf_theta[itrk, ist] = hit.emtf_theta
+        cpattern[itrk, ist] = hit.pattern
+        fr[itrk, ist] = hit.fr
+    return (mode, theta, endcap, st1_ring2, emtf_phi, emtf_theta, cpattern, fr)
+
+  def getNLBdPhiBin_array(self, dPhi, bits, max_):
+    assert((bits == 4 and max_ == 256) or (bits == 5 and max_ == 256) or (bits == 7 and max_ == 512))
+    if bits == 4:
+      nlb_map = dPhiNLBMap_4bit_256Max
+    elif bits == 5:
+      nlb_map = dPhiNLBMap_5bit_256Max
+    elif bits == 7:
+      nlb_map = dPhiNLBMap_7bit_512Max
+
+    # Values beyond the last edge go to the last bin, same as getNLBdPhiBin()
+    dPhiBin_ = np.searchsorted(nlb_map, np.abs(dPhi), side='right') - 1
+    return dPhiBin_
+
+  def getdTheta_array(self, dTheta, bits):
+    assert(bits == 2 or bits == 3)
+
+    if bits == 2:
+      dTheta_ = np.select([np.abs(dTheta) <= 1, np.abs(dTheta) <= 2, dTheta <= -3], [2, 1, 0], 3)
+    elif bits == 3:
+      dTheta_ = np.clip(dTheta, -4, 3) + 4
+    return dTheta_
+
+  def get8bMode15_array(self, theta, st1_ring2, endcap, sPhiAB, clctA, clctB, clctC, clctD):
+    theta = np.where(st1_ring2, (np.clip(theta, 46, 87) - 46) // 7, (np.clip(theta, 5, 52) - 5) // 6)
+
+    clctA_2b = self.getCLCT_array(clctA, endcap, sPhiAB, 2)
+    nRPC = (clctA == 0).astype(np.int32) + (clctB == 0) + (clctC == 0) + (clctD == 0)
+
+    rpc_word = np.select([
+        (nRPC >= 2) & (clctA == 0) & (clctB == 0),
+        (nRPC >= 2) & (clctA == 0) & (clctC == 0),
+        (nRPC >= 2) & (clctA == 0) & (clctD == 0),
+        (nRPC == 1) & (clctA == 0),
+        (nRPC >= 2) & (clctD == 0) & (clctB == 0),
+        (nRPC >= 2) & (clctD == 0) & (clctC == 0),
+        (nRPC >= 2) & (clctB == 0) & (clctC == 0),
+        (nRPC == 1) & (clctD == 0),
+        (nRPC == 1) & (clctB == 0),
+        (nRPC == 1) & (clctC == 0),
+      ], [0, 1, 2, 3, 4, 8, 12, 16, 20, 24], 28)
+    mode15_8b_ring2 = (theta*32) + rpc_word + clctA_2b + 64
+
+    rpc_word = np.select([
+        (theta >= 4) & (clctD == 0),
+        (theta >= 4) & (clctC == 0),
+        (theta >= 4),
+      ], [0, 1, 2], 3)
+    mode15_8b_ring1 = ((theta % 4)*16) + rpc_word*4 + clctA_2b
+
+    mode15_8b = np.where(st1_ring2, mode15_8b_ring2, mode15_8b_ring1)
+    return mode15_8b
+
+  def get2bRPC_array(self, clctA, clctB, clctC):
+    rpc_2b = np.select([clctA == 0, clctC == 0, clctB == 0], [0, 1, 2], 3)
+    return rpc_2b
+
+  def getCLCT_array(self, clct, endcap, dPhiSign, bits):
+    assert(np.all((0 <= clct) & (clct <= 10)) and (bits == 2 or bits == 3))
+
+    if bits == 2:
+      clct_map = np.array(CLCTMap_2bit, dtype=np.int32)
+    elif bits == 3:
+      clct_map = np.array(CLCTMap_3bit, dtype=np.int32)
+
+    sign_ = -1 * endcap * dPhiSign
+    clct_ = np.where(sign_ > 0, clct_map[0][clct], clct_map[1][clct])
+    return clct_
+
+  def getTheta_array(self, theta, st1_ring2, bits):
+    assert(np.all((5 <= theta) & (theta < 128)) and (bits == 4 or bits == 5))
+
+    if bits == 4:
+      theta_ = np.where(st1_ring2, ((np.clip(theta, 46, 87) - 46) // 7) + 8, (np.clip(theta, 5, 52) - 5) // 6)
+    elif bits == 5:
+      theta_ = np.where(st1_ring2, ((np.minimum(theta, 104) - 1) // 4) + 6, (np.maximum(theta, 1) - 1) // 4)
+    return theta_
+
+  def calculate_address_array(self, mode, theta, endcap, st1_ring2, emtf_phi, emtf_theta, cpattern, fr):
+    # Same as calculate_address(), vectorized. The tracks are processed in groups of the same mode.
+    mode = np.asarray(mode, dtype=np.int32)
+    address = np.zeros(mode.shape, dtype=np.int64)
+
+    for m in np.unique(mode):
+      if m not in ptlut_mode_stations:
+        raise ValueError('Unexpected mode: %i' % m)
+      sel = (mode == m)
+      address[sel] = self._calculate_address_array_in_mode(
+          int(m), np.asarray(theta)[sel], np.asarray(endcap)[sel], np.asarray(st1_ring2)[sel],
+          np.asarray(emtf_phi, dtype=np.int64)[sel], np.asarray(emtf_theta, dtype=np.int64)[sel],
+          np.asarray(cpattern, dtype=np.int64)[sel], np.asarray(fr, dtype=np.int64)[sel])
+    return address
+
+  def _calculate_address_array_in_mode(self, mode, theta, endcap, st1_ring2, emtf_phi, emtf_theta, cpattern, fr):
+    address = np.zeros(len(theta), dtype=np.int64)
+    mode_ID, iA, iB, iC, iD = ptlut_mode_stations[mode]
+    nhits = bin(mode).count('1')
+
+    def get_dPhi(i, j):
+      return np.abs(emtf_phi[:, i] - emtf_phi[:, j])
+
+    def get_sPhi(i, j):
+      return (emtf_phi[:, i] <= emtf_phi[:, j])
+
+    def get_dTheta(i, j):
+      return np.abs(emtf_theta[:, i] - emtf_theta[:, j]) * np.where(emtf_theta[:, i] <= emtf_theta[:, j], 1, -1)
+
+    # Fill variables from station hits, and convert to words for pT LUT address
+    sPhiAB = get_sPhi(iA, iB)
+    sPhiAB_sign = np.where(sPhiAB, 1, -1)
+    frA    = fr      [:, iA]
+    clctA  = cpattern[:, iA]
+    clctB  = cpattern[:, iB]
+
+    if nhits == 4:
+      clctC  = cpattern[:, iC]
+      clctD  = cpattern[:, iD]
+      dPhiAB = self.getNLBdPhiBin_array( get_dPhi(iA, iB), 7, 512 )
+      dPhiBC = self.getNLBdPhiBin_array( get_dPhi(iB, iC), 5, 256 )
+      dPhiCD = self.getNLBdPhiBin_array( get_dPhi(iC, iD), 4, 256 )
+      sPhiBC = (get_sPhi(iB, iC) == sPhiAB).astype(np.int64)
+      sPhiCD = (get_sPhi(iC, iD) == sPhiAB).astype(np.int64)
+      dTheta = self.getdTheta_array    ( get_dTheta(iA, iD), 2 )
+      mode15_8b = self.get8bMode15_array( theta, st1_ring2, endcap, sPhiAB_sign, clctA, clctB, clctC, clctD )
+    elif nhits == 3:
+      clctC  = cpattern[:, iC]
+      frB    = fr      [:, iB]
+      dPhiAB = self.getNLBdPhiBin_array( get_dPhi(iA, iB), 7, 512 )
+      dPhiBC = self.getNLBdPhiBin_array( get_dPhi(iB, iC), 5, 256 )
+      sPhiBC = (get_sPhi(iB, iC) == sPhiAB).astype(np.int64)
+      dTheta = self.getdTheta_array    ( get_dTheta(iA, iC), 3 )
+      rpc_2b = self.get2bRPC_array     ( clctA, clctB, clctC ) # Have to use un-compressed CLCT words
+      clctA  = self.getCLCT_array      ( clctA, endcap, sPhiAB_sign, 2 )
+      theta  = self.getTheta_array     ( theta, st1_ring2, 5 )
+    elif nhits == 2:
+      frB    = fr      [:, iB]
+      dPhiAB = self.getNLBdPhiBin_array( get_dPhi(iA, iB), 7, 512 )
+      dTheta = self.getdTheta_array    ( get_dTheta(iA, iB), 3 )
+      clctA  = self.getCLCT_array      ( clctA, endcap, sPhiAB_sign, 3 )
+      clctB  = self.getCLCT_array      ( clctB, endcap, sPhiAB_sign, 3 )
+      theta  = self.getTheta_array     ( theta, st1_ring2, 5 )
+    else:
+      raise ValueError('Unexpected nhits: %i' % nhits)
+
+    # Form the pT LUT address
+    if nhits == 4:
+      address |= (dPhiAB    & ((1<<7)-1)) << (0)
+      address |= (dPhiBC    & ((1<<5)-1)) << (0+7)
+      address |= (dPhiCD    & ((1<<4)-1)) << (0+7+5)
+      address |= (sPhiBC    & ((1<<1)-1)) << (0+7+5+4)
+      address |= (sPhiCD    & ((1<<1)-1)) << (0+7+5+4+1)
+      address |= (dTheta    & ((1<<2)-1)) << (0+7+5+4+1+1)
+      address |= (frA       & ((1<<1)-1)) << (0+7+5+4+1+1+2)
+      address |= (mode15_8b & ((1<<8)-1)) << (0+7+5+4+1+1+2+1)
+      address |= (mode_ID   & ((1<<1)-1)) << (0+7+5+4+1+1+2+1+8)
+      assert(np.all(((1 << 29) <= address) & (address < (1 << 30))))
+    elif nhits == 3:
+      address |= (dPhiAB    & ((1<<7)-1)) << (0)
+      address |= (dPhiBC    & ((1<<5)-1)) << (0+7)
+      address |= (sPhiBC    & ((1<<1)-1)) << (0+7+5)
+      address |= (dTheta    & ((1<<3)-1)) << (0+7+5+1)
+      address |= (frA       & ((1<<1)-1)) << (0+7+5+1+3)
+
+      bit = 0
+      if mode != 7:
+        address |= (frB     & ((1<<1)-1)) << (0+7+5+1+3+1)
+        bit = 1
+
+      address |= (clctA     & ((1<<2)-1)) << (0+7+5+1+3+1+bit)
+      address |= (rpc_2b    & ((1<<2)-1)) << (0+7+5+1+3+1+bit+2)
+      address |= (theta     & ((1<<5)-1)) << (0+7+5+1+3+1+bit+2+2)
+
+      if mode != 7:
+        address |= (mode_ID & ((1<<2)-1)) << (0+7+5+1+3+1+bit+2+2+5)
+        assert(np.all(((1 << 27) <= address) & (address < (1 << 29))))
+      else:
+        address |= (mode_ID & ((1<<1)-1)) << (0+7+5+1+3+1+bit+2+2+5)
+        assert(np.all(((1 << 26) <= address) & (address < (1 << 27))))
+    elif nhits == 2:
+      address |= (dPhiAB    & ((1<<7)-1)) << (0)
+      address |= (dTheta    & ((1<<3)-1)) << (0+7)
+      address |= (frA       & ((1<<1)-1)) << (0+7+3)
+      address |= (frB       & ((1<<1)-1)) << (0+7+3+1)
+      address |= (clctA     & ((1<<3)-1)) << (0+7+3+1+1)
+      address |= (clctB     & ((1<<3)-1)) << (0+7+3+1+1+3)
+      address |= (theta     & ((1<<5)-1)) << (0+7+3+1+1+3+3)
+      address |= (mode_ID   & ((1<<3)-1)) << (0+7+3+1+1+3+3+5)
+      assert(np.all(((1 << 24) <= address) & (address < (1 << 26))))
+    return address
+
 
 # ______________________________________________________________________________
 # Settings
@@ -546,6 +839,7 @@ maxEvents = 20
 use_condor = False
 
 analysis = "verbose"
+#analysis = "check_address"
 
 infile_r = None  # input file handle
 
@@ -621,3 +915,75 @@ if analysis == "verbose":
 
   # Close workers
   emtfptassign.close()
+
+
+# ______________________________________________________________________________
+# Analysis: check_address
+# Check that calculate_address_array() gives the same addresses as calculate_address()
+elif analysis == "check_address":
+
+  class EMTFHit(object):
+    def __init__(self, **kwargs):
+      self.__dict__.update(kwargs)
+
+  def make_random_track(dPhis=None, dTheta=None):
+    endcap = np.random.choice((-1, 1))
+    theta = np.random.randint(5, 128)
+    phi = np.random.randint(1000, 4000)
+    hits = []
+    for station in (1,2,3,4):
+      if dPhis is None and np.random.random() < 0.3:
+        continue
+      hit_type = np.random.choice((kCSC, kCSC, kRPC, kGEM))
+      ring = np.random.choice((1,2,3,4)) if station == 1 else np.random.choice((1,2))
+      if dPhis is not None:
+        phi += np.random.choice((-1, 1)) * dPhis[station-1]
+      else:
+        phi += np.random.randint(-600, 600)
+      if dTheta is not None:
+        theta_ = theta + (station-1) * dTheta
+      else:
+        theta_ = theta + np.random.randint(-8, 9)
+      hits.append(EMTFHit(type=hit_type, station=station, ring=ring, endcap=endcap,
+                          emtf_phi=phi, emtf_theta=int(np.clip(theta_, 5, 127)),
+                          pattern=(np.random.randint(0, 11) if hit_type == kCSC else 0),
+                          fr=np.random.randint(0, 2)))
+    return emtfptassign.make_track(hits)
+
+  # Workers
+  emtfptassign = EMTFPtAssignment()
+
+  # Random tracks of all modes
+  tracks = []
+  for i in xrange(100000):
+    track = make_random_track()
+    if len(track.hits) >= 2:
+      tracks.append(track)
+
+  # Edge bins: dPhi on and around the NLB edges and beyond the last edge, dTheta on
+  # the 2- and 3-bit boundaries. Theta is random, which covers the getTheta() clipping.
+  dPhi_edges = set()
+  for nlb_map in (dPhiNLBMap_4bit_256Max, dPhiNLBMap_5bit_256Max, dPhiNLBMap_7bit_512Max):
+    for edge in nlb_map:
+      dPhi_edges.update((max(edge - 1, 0), edge, edge + 1))
+  dPhi_edges.update((511, 512, 513, 1000))
+  for dPhi in sorted(dPhi_edges):
+    for dTheta in (-5, -4, -3, -2, -1, 0, 1, 2, 3, 4, 5):
+      track = make_random_track(dPhis=(0, dPhi, dPhi, dPhi), dTheta=dTheta)
+      tracks.append(track)
+      # Drop one station to get the 3-station modes
+      for station in (1,2,3,4):
+        tracks.append(emtfptassign.make_track([hit for hit in track.hits if hit.station != station]))
+
+  addresses = np.array([emtfptassign.calculate_address(track) for track in tracks], dtype=np.int64)
+  addresses_array = emtfptassign.calculate_address_array(*emtfptassign.get_station_arrays(tracks))
+
+  modes = np.array([track.mode for track in tracks])
+  print('[INFO] Checked %i tracks, modes: %s' % (len(tracks), np.unique(modes)))
+  for itrk in np.nonzero(addresses != addresses_array)[0][:10]:
+    track = tracks[itrk]
+    print('[ERROR] mode {0} theta {1} st1_ring2 {2} address {3:030b} {4:030b}'.format(track.mode, track.theta, track.ptlut_data.st1_ring2, addresses[itrk], addresses_array[itrk]))
+  assert(np.array_equal(addresses, addresses_array))
+
+  # Close workers
+  emtfptassign.close()
@@ -32,7 +32,7 @@ print('[INFO] Using sklearn {0}'.format(sklearn.__version__))
 
 # Misc
 from encoder import Encoder, NewLeakyReLU, huber_loss, masked_huber_loss, lr_decay
-from utils import slice_arrays, merge_arrays, make_batches
+from utils import slice_arrays, merge_arrays, NoiseBatchProducer
 
 
 # ______________________________________________________________________________
@@ -45,6 +45,8 @@ do_skim = True
 
 add_noise = True
 
+do_benchmark = False
+
 
 # ______________________________________________________________________________
 # Functions
@@ -141,8 +143,12 @@ def save_model(model):
 
 
 # Training routine
+# The train function is compiled once. The batches (muon rows followed by the
+# same number of noise rows from x_adv) are assembled by a background thread
+# into preallocated buffers, see utils.NoiseBatchProducer. The callbacks are
+# called as in model.fit, and the throughput is reported in samples/s.
 def train(model, x, y, x_adv, aux_adv, batch_size=None, epochs=1, verbose=1, callbacks=None,
-          validation_split=0., shuffle=True, class_weight=None, sample_weight=None):
+          validation_split=0., shuffle=True, class_weight=None, sample_weight=None, queue_size=4):
 
   # Validate user data.
   x, y, sample_weights = model._standardize_user_data(
@@ -151,6 +157,15 @@ def train(model, x, y, x_adv, aux_adv, batch_size=None, epochs=1, verbose=1, cal
     class_weight=class_weight,
     batch_size=batch_size)
   ins = x + y + sample_weights
+  nx, ny = len(x), len(y)
+
+  # Noise: x from x_adv, the regression target is masked (mask_value is set to 100),
+  # the discriminator target is 0, and the sample weights are 1
+  if add_noise:
+    assert nx == 1 and ny == 2
+    noise_ins = [x_adv, 100., 0., 1., 1.]
+  else:
+    noise_ins = None
 
   # Prepare validation data.
   do_validation = False
@@ -160,60 +175,105 @@ def train(model, x, y, x_adv, aux_adv, batch_size=None, epochs=1, verbose=1, cal
       split_at = int(x[0].shape[0] * (1. - validation_split))
     else:
       split_at = int(len(x[0]) * (1. - validation_split))
-    x, val_x = (slice_arrays(x, 0, split_at),
-                slice_arrays(x, split_at))
-    y, val_y = (slice_arrays(y, 0, split_at),
-                slice_arrays(y, split_at))
-    sample_weights, val_sample_weights = (
-      slice_arrays(sample_weights, 0, split_at),
-      slice_arrays(sample_weights, split_at))
-    val_ins = val_x + val_y + val_sample_weights
+    ins, val_ins = (slice_arrays(ins, 0, split_at),
+                    slice_arrays(ins, split_at))
+    if add_noise:
+      # Fixed noise rows for validation
+      noise_ids = np.random.RandomState(2023).randint(0, x_adv.shape[0], val_ins[0].shape[0])
+      val_noise = [x_adv[noise_ids] if isinstance(noise, np.ndarray) else np.full_like(val, noise) for (val, noise) in zip(val_ins, noise_ins)]
+      val_ins = merge_arrays(val_ins, val_noise)
   else:
     val_ins = []
 
+  producer = NoiseBatchProducer(ins, noise_ins, batch_size, shuffle=shuffle, queue_size=queue_size)
+  num_train_samples = ins[0].shape[0] * (2 if add_noise else 1)
+
+  # Compile the train function once
+  model._make_train_function()
+  f = model.train_function
+
+  # Callbacks, as in model.fit
+  model.history = keras.callbacks.History()
+  _callbacks = [keras.callbacks.BaseLogger()]
+  if verbose:
+    _callbacks.append(keras.callbacks.ProgbarLogger(count_mode='samples'))
+  _callbacks += (callbacks or []) + [model.history]
+  callbacks = keras.callbacks.CallbackList(_callbacks)
+  out_labels = model.metrics_names
+  if do_validation:
+    callback_metrics = out_labels + ['val_' + n for n in out_labels]
+  else:
+    callback_metrics = list(out_labels)
+  callbacks.set_model(model)
+  callbacks.set_params({
+    'batch_size': batch_size,
+    'epochs': epochs,
+    'steps': None,
+    'samples': num_train_samples,
+    'verbose': verbose,
+    'do_validation': do_validation,
+    'metrics': callback_metrics,
+  })
+  model.stop_training = False
+
 
   # ____________________________________________________________________________
   # Fit
 
-  num_train_samples = x[0].shape[0]
-  index_array = np.arange(num_train_samples)
-
-  #sess = K.get_session()
-  #tf_x = K.placeholder(shape=(None, x[0].shape[1]))
-  #tf_y = K.placeholder(shape=(None, y[0].shape[1]))
-  #sess.run(tf.initialize_all_variables())
+  total_samples, total_time = 0, 0.
+  callbacks.on_train_begin()
 
   # Loop over epochs
-  for epoch in xrange(epochs):
-    print('Epoch {0}'.format(epoch))
-
-    if shuffle:
-      np.random.shuffle(index_array)
-
-    batches = make_batches(num_train_samples, batch_size)
+  for epoch in range(epochs):
+    callbacks.on_epoch_begin(epoch)
+    epoch_logs = {}
+    epoch_samples = 0
+    t0 = time.time()
 
     # Loop over batches
-    for batch_index, (batch_start, batch_end) in enumerate(batches):
-      print('.. batch {0}'.format(batch_index))
-
-      batch_ids = index_array[batch_start:batch_end]
-      ins_batch = slice_arrays(ins, batch_ids)
-      assert isinstance(ins_batch, list) and len(ins_batch) == 1 + 2 + 2
-
-      # Add noise
-      if add_noise:
-        noise = x_adv[np.random.randint(0, x_adv.shape[0], ins_batch[0].shape[0])]
-        noise_reg = np.zeros_like(ins_batch[1]) + 100.  # mask_value is set to 100
-        noise_discr = np.zeros_like(ins_batch[2])
-        noise_reg_w = np.ones_like(ins_batch[3])
-        noise_discr_w = np.ones_like(ins_batch[3])
-        ins_noise = [noise, noise_reg, noise_discr, noise_reg_w, noise_discr_w]
-        ins_batch = merge_arrays(ins_batch, ins_noise)
-
-      model._make_train_function()
-      f = model.train_function
+    for batch_index, ins_batch in enumerate(producer.iterate_epoch()):
+      batch_size_noise = ins_batch[0].shape[0]
+      batch_logs = {'batch': batch_index, 'size': batch_size_noise}
+      callbacks.on_batch_begin(batch_index, batch_logs)
       outs = f(ins_batch)
-
+      if not isinstance(outs, list):
+        outs = [outs]
+      for l, o in zip(out_labels, outs):
+        batch_logs[l] = o
+      callbacks.on_batch_end(batch_index, batch_logs)
+      epoch_samples += batch_size_noise
+      if model.stop_training:
+        break
+
+    dt = time.time() - t0
+    total_samples += epoch_samples
+    total_time += dt
+    epoch_logs['samples_per_sec'] = epoch_samples / dt
+
+    if do_validation:
+      val_outs = model.evaluate(val_ins[:nx], val_ins[nx:nx+ny], sample_weight=val_ins[nx+ny:], batch_size=batch_size, verbose=0)
+      if not isinstance(val_outs, list):
+        val_outs = [val_outs]
+      for l, o in zip(out_labels, val_outs):
+        epoch_logs['val_' + l] = o
+
+    callbacks.on_epoch_end(epoch, epoch_logs)
+    if model.stop_training:
+      break
+
+  callbacks.on_train_end()
+  print('[INFO] Trained on {0} samples in {1:.1f} sec: {2:.0f} samples/s'.format(total_samples, total_time, total_samples / max(total_time, 1e-9)))
+  return model.history
+
+# Same training with model.fit on the mixed arrays materialized once, to compare the throughput
+def benchmark_fit(model, x, y, x_adv, batch_size=None, epochs=1):
+  noise_ids = np.random.randint(0, x_adv.shape[0], x.shape[0])
+  x_new = np.concatenate((x, x_adv[noise_ids]))
+  y_new = [np.concatenate((y[0], np.zeros_like(y[0]) + 100.)), np.concatenate((y[1], np.zeros_like(y[1])))]
+  t0 = time.time()
+  model.fit(x_new, y_new, batch_size=batch_size*2, epochs=epochs, verbose=0, shuffle=True)
+  dt = time.time() - t0
+  print('[INFO] model.fit: trained on {0} samples in {1:.1f} sec: {2:.0f} samples/s'.format(x_new.shape[0] * epochs, dt, x_new.shape[0] * epochs / dt))
 
 
 # ______________________________________________________________________________
@@ -236,3 +296,6 @@ if __name__ == '__main__':
   train(model, x_train, y_train, x_adv, aux_adv, epochs=5, validation_split=0.1, batch_size=256, verbose=1)
   save_model(model)
 
+  if do_benchmark:
+    benchmark_fit(create_model(), x_train, y_train, x_adv, epochs=5, batch_size=256)
+
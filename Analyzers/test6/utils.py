@@ -1,4 +1,7 @@
+import threading
+
 import numpy as np
+from six.moves import queue
 
 # from https://github.com/keras-team/keras/blob/master/keras/utils/generic_utils.py
 def slice_arrays(arrays, start=None, stop=None):
@@ -56,3 +59,104 @@ def make_batches(size, batch_size):
     num_batches = (size + batch_size - 1) // batch_size  # round up
     return [(i * batch_size, min(size, (i + 1) * batch_size))
             for i in range(num_batches)]
+
+
+# Assembles the training batches in a background thread, for noise-augmented training.
+# Each batch has the rows of 'ins' (list of arrays, e.g. x, y and sample weights)
+# selected by the shuffled index, followed by the same number of noise rows. For
+# each array in 'ins', the noise is either an array (rows drawn at random) or a
+# constant (e.g. the mask value for the regression target). The noise rows are
+# drawn in bulk once per epoch. The batches are written into preallocated
+# buffers: the producer fills a free buffer, and a buffer is freed when the
+# consumer asks for the next batch. At most 'queue_size' batches are ready.
+class NoiseBatchProducer(object):
+    def __init__(self, ins, noise_ins, batch_size, shuffle=True, queue_size=4, seed=None):
+        assert noise_ins is None or len(noise_ins) == len(ins)
+        self.ins = ins
+        self.noise_ins = noise_ins
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.queue_size = queue_size
+        self.rng = np.random.RandomState(seed)
+        self.num_samples = ins[0].shape[0]
+
+        # Number of rows in the noise arrays
+        self.num_noise = None
+        if noise_ins is not None:
+            for noise in noise_ins:
+                if isinstance(noise, np.ndarray):
+                    self.num_noise = noise.shape[0]
+            assert self.num_noise is not None and self.num_noise > 0
+
+        # One buffer being consumed, one being filled, queue_size ready
+        nrows = batch_size * (2 if noise_ins is not None else 1)
+        self.buffers = [[np.zeros((nrows,) + x.shape[1:], dtype=x.dtype) for x in ins]
+                        for _ in range(queue_size + 2)]
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def _fill(self, buf, ids, noise_ids):
+        k = len(ids)
+        for i, x in enumerate(self.ins):
+            np.take(x, ids, axis=0, out=buf[i][:k])
+            if self.noise_ins is not None:
+                noise = self.noise_ins[i]
+                if isinstance(noise, np.ndarray):
+                    np.take(noise, noise_ids, axis=0, out=buf[i][k:2*k])
+                else:
+                    buf[i][k:2*k] = noise
+        return 2*k if self.noise_ins is not None else k
+
+    def iterate_epoch(self):
+        # Yields the list of arrays of each batch, valid until the next batch is requested
+        index_array = np.arange(self.num_samples)
+        if self.shuffle:
+            self.rng.shuffle(index_array)
+        noise_index_array = None
+        if self.noise_ins is not None:
+            noise_index_array = self.rng.randint(0, self.num_noise, self.num_samples)
+        batches = make_batches(self.num_samples, self.batch_size)
+
+        free = queue.Queue()
+        for b in range(len(self.buffers)):
+            free.put(b)
+        ready = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for (batch_start, batch_end) in batches:
+                    b = free.get()
+                    if stop.is_set():
+                        return
+                    ids = index_array[batch_start:batch_end]
+                    noise_ids = noise_index_array[batch_start:batch_end] if noise_index_array is not None else None
+                    size = self._fill(self.buffers[b], ids, noise_ids)
+                    ready.put((b, size))
+                ready.put(None)
+            except Exception as e:
+                ready.put(e)
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                b, size = item
+                yield [buf[:size] for buf in self.buffers[b]]
+                free.put(b)
+        finally:
+            stop.set()
+            free.put(0)  # unblock the producer
+            while thread.is_alive():
+                try:
+                    ready.get_nowait()
+                except queue.Empty:
+                    pass
+                thread.join(0.01)
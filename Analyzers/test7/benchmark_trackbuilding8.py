@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""Micro-benchmarks for the stages of rootpy_trackbuilding8.py.
+
+Each stage (PatternRecognition, RoadCleaning, RoadSlimming, PtAssignment,
+TrackProducer, GhostBusting) is timed on synthetic events at several pileup
+levels, without access to the remote ntuples. If the Keras model cannot be
+loaded, PtAssignment is replaced by a stand-in that returns random predictions,
+so that the downstream stages can still be timed.
+
+The pattern recognition engine is either 'default' or 'bitmap'. With 'compare',
+the two engines are run on the same events and their roads are compared.
+
+Usage: python benchmark_trackbuilding8.py [nevents] [default|bitmap|compare]
+"""
+
+import copy
+import sys
+import time
+
+import numpy as np
+
+import rootpy_trackbuilding8 as tb
+from synthetic_events import SyntheticEventGenerator, make_synthetic_bank
+
+
+# ______________________________________________________________________________
+# Settings
+
+nevents = 200
+if len(sys.argv) > 1:
+  nevents = int(sys.argv[1])
+
+engine = 'default'
+if len(sys.argv) > 2:
+  engine = sys.argv[2]
+assert(engine in ('default', 'bitmap', 'compare'))
+
+pileups = (140, 200, 250, 300)
+
+hits_per_sector_pu200 = 40.
+
+stages = ('PatternRecognition', 'RoadCleaning', 'RoadSlimming', 'PtAssignment', 'TrackProducer', 'GhostBusting')
+
+bankfile = 'pattern_bank_synthetic.npz'
+
+
+# ______________________________________________________________________________
+# Stand-in for PtAssignment when the Keras model is not available
+
+class RandomPtAssignment(object):
+  def __init__(self, seed=2026):
+    self.rng = np.random.RandomState(seed)
+
+  def run(self, x):
+    x_new = np.array([], dtype=np.float32)
+    y = np.array([], dtype=np.float32)
+    z = np.array([], dtype=np.float32)
+    t = np.array([], dtype=np.float32)
+    if len(x) == 0:
+      return (x_new, y, z, t)
+
+    nlayers = tb.nlayers
+    n = len(x)
+    x_vars = x[:, :tb.ROAD_LAYER_NVARS*nlayers].reshape(n, tb.ROAD_LAYER_NVARS, nlayers)
+    x_new = x
+    y = np.zeros((n, 1, 2), dtype=np.float32)
+    y[:, 0, 0] = self.rng.uniform(-0.5, 0.5, size=n)  # q/pT
+    y[:, 0, 1] = self.rng.uniform(0., 1., size=n)     # discriminator
+    z = x[:, tb.ROAD_LAYER_NVARS*nlayers:tb.ROAD_LAYER_NVARS_P1*nlayers].astype(np.bool)
+    t = np.zeros((n, 3), dtype=np.float32)
+    t[:, 0:2] = x[:, tb.ROAD_LAYER_NVARS_P1*nlayers:tb.ROAD_LAYER_NVARS_P1*nlayers+2]  # ipt, ieta
+    t[:, 2] = np.nan_to_num(np.nanmedian(np.where(z[:, :5], np.nan, x_vars[:, 1, :5]), axis=1))  # theta median (CSC only)
+    return (x_new, y, z, t)
+
+
+# ______________________________________________________________________________
+# Functions
+
+def make_workers(bitmap=False):
+  bank = tb.PatternBank(bankfile)
+  recog = tb.PatternRecognition(bank, bitmap=bitmap)
+  clean = tb.RoadCleaning()
+  slim = tb.RoadSlimming(bank)
+  try:
+    ptassig = tb.PtAssignment(tb.kerasfile)
+  except Exception as e:
+    print('[WARNING] Cannot load Keras model ({0}), using random predictions'.format(e))
+    ptassig = RandomPtAssignment()
+  trkprod = tb.TrackProducer()
+  ghost = tb.GhostBusting()
+  return (recog, clean, slim, ptassig, trkprod, ghost)
+
+def run_benchmark(pileup, workers):
+  (recog, clean, slim, ptassig, trkprod, ghost) = workers
+  gen = SyntheticEventGenerator(pileup=pileup, hits_per_sector_pu200=hits_per_sector_pu200, add_muon=True)
+  events = gen.take(nevents)
+
+  timing = dict((s, 0.) for s in stages)
+  counts = dict(hits=0, roads=0, clean_roads=0, tracks=0)
+
+  for evt in events:
+    t0 = time.time()
+    roads = recog.run(evt.hits)
+    t1 = time.time()
+    clean_roads = clean.run(roads)
+    t2 = time.time()
+    slim_roads = slim.run(clean_roads)
+    variables = tb.roads_to_variables(slim_roads)
+    t3 = time.time()
+    variables, predictions, x_mask_vars, x_road_vars = ptassig.run(variables)
+    t4 = time.time()
+    tracks = trkprod.run(slim_roads, variables, predictions, x_mask_vars, x_road_vars)
+    t5 = time.time()
+    tracks = ghost.run(tracks)
+    t6 = time.time()
+
+    for s, dt in zip(stages, (t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5)):
+      timing[s] += dt
+    counts['hits'] += len(evt.hits)
+    counts['roads'] += len(roads)
+    counts['clean_roads'] += len(clean_roads)
+    counts['tracks'] += len(tracks)
+  return timing, counts
+
+def compare_engines(pileup):
+  bank = tb.PatternBank(bankfile)
+  gen = SyntheticEventGenerator(pileup=pileup, hits_per_sector_pu200=hits_per_sector_pu200, add_muon=True)
+  events = gen.take(nevents)
+
+  def summarize(roads):
+    return sorted((road.id, road.mode, road.quality, road.sort_code, road.theta_median,
+                   [(hit.id, hit.emtf_layer, hit.emtf_phi, hit.emtf_theta, hit.emtf_bend) for hit in road.hits]) for road in roads)
+
+  nroads = 0
+  nmismatches = 0
+  for omtf_input in (False, True):
+    recog1 = tb.PatternRecognition(bank, omtf_input=omtf_input)
+    recog2 = tb.PatternRecognition(bank, omtf_input=omtf_input, bitmap=True)
+    for evt in events:
+      # The input hits are modified by PatternRecognition, so use copies
+      roads1 = summarize(recog1.run(copy.deepcopy(evt.hits)))
+      roads2 = summarize(recog2.run(copy.deepcopy(evt.hits)))
+      nroads += len(roads1)
+      if roads1 != roads2:
+        nmismatches += 1
+  return nroads, nmismatches
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  print('[INFO] Creating file: %s' % bankfile)
+  make_synthetic_bank(bankfile, nlayers=tb.nlayers, npt=len(tb.pt_bins)-1, neta=len(tb.eta_bins)-1)
+
+  if engine == 'compare':
+    for pileup in pileups:
+      nroads, nmismatches = compare_engines(pileup)
+      print('[INFO] PU{0}: {1} roads, {2} events with different roads (default vs bitmap)'.format(pileup, nroads, nmismatches))
+    sys.exit(0)
+
+  print('[INFO] Using pattern recognition engine: %s' % engine)
+  workers = make_workers(bitmap=(engine == 'bitmap'))
+
+  results = np.zeros((len(pileups), len(stages)), dtype=np.float64)  # ms/event
+  multiplicities = np.zeros((len(pileups), 4), dtype=np.float64)
+
+  for i, pileup in enumerate(pileups):
+    timing, counts = run_benchmark(pileup, workers)
+    results[i] = [1e3 * timing[s] / nevents for s in stages]
+    multiplicities[i] = [float(counts[k]) / nevents for k in ('hits', 'roads', 'clean_roads', 'tracks')]
+
+    total = results[i].sum()
+    print('[INFO] PU{0}: {1} events, {2:.1f} hits/evt, {3:.1f} roads/evt, {4:.1f} clean roads/evt, {5:.2f} tracks/evt'.format(
+        pileup, nevents, *multiplicities[i]))
+    for s, t in zip(stages, results[i]):
+      evts_per_sec = 1e3 / t if t > 0. else float('inf')
+      print('  {0:<20s} {1:9.3f} ms/evt {2:10.1f} evt/s'.format(s, t, evts_per_sec))
+    print('  {0:<20s} {1:9.3f} ms/evt {2:10.1f} evt/s'.format('Total', total, 1e3 / total))
+
+  # Scaling curves, relative to the lowest pileup
+  print('[INFO] Scaling relative to PU{0}:'.format(pileups[0]))
+  print('  {0:<20s} '.format('Stage') + ' '.join(['{0:>8s}'.format('PU%i' % pu) for pu in pileups]))
+  for j, s in enumerate(stages + ('Total',)):
+    t = results[:, j] if j < len(stages) else results.sum(axis=1)
+    ratio = t / t[0] if t[0] > 0. else np.zeros_like(t)
+    print('  {0:<20s} '.format(s) + ' '.join(['{0:8.2f}'.format(r) for r in ratio]))
+
+  outfile = 'benchmark_trackbuilding8_%s.npz' % engine
+  print('[INFO] Creating file: %s' % outfile)
+  np.savez_compressed(outfile, pileups=pileups, stages=stages, results=results, multiplicities=multiplicities)
@@ -0,0 +1,9 @@
+import pytest
+
+from synthetic_events import make_synthetic_bank
+
+
+@pytest.fixture(scope='session')
+def bankfile(tmpdir_factory):
+  # Synthetic pattern bank, readable by rootpy_trackbuilding8.PatternBank
+  return make_synthetic_bank(str(tmpdir_factory.mktemp('bank').join('pattern_bank_synthetic.npz')))
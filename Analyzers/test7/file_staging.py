@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""Stage remote input files to a local cache in background threads.
+
+StagingCache keeps the staged files in a local directory, bounded in size.
+When the total size exceeds the limit, the least recently used files are
+removed, except those in use. The files left by a previous job in the same
+directory are reused, and its partial copies (.part) are removed.
+
+Prefetcher iterates over a list of input files and yields the local copies,
+while the next 'nahead' files are copied by background threads. If a file
+cannot be staged, the original name is yielded instead, so that it is read
+remotely.
+
+The xrootd files (root://...) are copied with xrdcp, the other files with
+shutil. For offline tests, redirect_file() maps the xrootd files to a local
+directory standing in for the remote store, e.g. REMOTE_STORE=/data/mirror
+maps root://host//store/group/... to /data/mirror/store/group/...
+
+This module does not depend on ROOT.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+
+from six.moves import range, queue
+
+
+# ______________________________________________________________________________
+# Functions
+
+def redirect_file(infile, remote_store=None):
+  # Map root://host//path to remote_store/path
+  if remote_store is None or not infile.startswith('root://'):
+    return infile
+  path = infile[len('root://'):]
+  path = path[path.index('/'):].lstrip('/')
+  return os.path.join(remote_store, path)
+
+def copy_file(src, dst):
+  if src.startswith('root://'):
+    with open(os.devnull, 'w') as devnull:
+      status = subprocess.call(['xrdcp', '--nopbar', '--force', src, dst], stdout=devnull, stderr=subprocess.STDOUT)
+    if status != 0:
+      raise IOError('xrdcp failed with status {0}: {1}'.format(status, src))
+  else:
+    if src.startswith('file://'):
+      src = src[len('file://'):]
+    shutil.copyfile(src, dst)
+
+
+# ______________________________________________________________________________
+# Classes
+
+class StagingCache(object):
+  def __init__(self, cachedir, max_bytes):
+    self.cachedir = cachedir
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.files = OrderedDict()  # local path -> size, least recently used first
+    self.pinned = {}  # local path -> number of users
+    self.staging = {}  # local path -> threading.Event, set when done
+    if not os.path.isdir(cachedir):
+      os.makedirs(cachedir)
+    # Remove the partial copies left by a previous job that was killed
+    for f in os.listdir(cachedir):
+      if f.endswith('.part'):
+        try:
+          os.remove(os.path.join(cachedir, f))
+        except OSError:
+          pass
+    # Reuse the files from a previous job, oldest first
+    fnames = [os.path.join(cachedir, f) for f in os.listdir(cachedir)]
+    for fname in sorted(fnames, key=os.path.getmtime):
+      self.files[fname] = os.path.getsize(fname)
+
+  def local_path(self, src):
+    h = hashlib.md5(src.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(self.cachedir, '%s_%s' % (h, os.path.basename(src)))
+
+  def total_bytes(self):
+    with self.lock:
+      return sum(self.files.values())
+
+  def stage(self, src):
+    # Returns the local path, pinned. Blocks while another thread stages the same file.
+    dst = self.local_path(src)
+    while True:
+      with self.lock:
+        if dst in self.files:
+          self.files[dst] = self.files.pop(dst)  # most recently used
+          self.pinned[dst] = self.pinned.get(dst, 0) + 1
+          return dst
+        event = self.staging.get(dst)
+        if event is None:
+          event = self.staging[dst] = threading.Event()
+          break
+      event.wait()
+      with self.lock:
+        if dst not in self.files:
+          raise IOError('Cannot stage file: {0}'.format(src))
+
+    try:
+      tmpfile = dst + '.part'
+      copy_file(src, tmpfile)
+      os.rename(tmpfile, dst)
+      with self.lock:
+        self.files[dst] = os.path.getsize(dst)
+        self.pinned[dst] = self.pinned.get(dst, 0) + 1
+        self._evict()
+    except Exception:
+      if os.path.isfile(tmpfile):
+        os.remove(tmpfile)
+      raise
+    finally:
+      with self.lock:
+        self.staging.pop(dst).set()
+    return dst
+
+  def release(self, dst):
+    with self.lock:
+      if dst in self.pinned:
+        self.pinned[dst] -= 1
+        if self.pinned[dst] <= 0:
+          del self.pinned[dst]
+      self._evict()
+
+  def _evict(self):
+    # Must be called with the lock held
+    total = sum(self.files.values())
+    for fname in list(self.files.keys()):
+      if total <= self.max_bytes:
+        break
+      if fname in self.pinned:
+        continue
+      total -= self.files.pop(fname)
+      try:
+        os.remove(fname)
+      except OSError:
+        pass
+
+
+class Prefetcher(object):
+  def __init__(self, infiles, cache, nahead=2, nthreads=2):
+    self.infiles = list(infiles)
+    self.cache = cache
+    self.nahead = nahead
+    self.nthreads = nthreads
+
+  def __iter__(self):
+    n = len(self.infiles)
+    results = [None] * n  # local path, or the exception
+    done = [threading.Event() for _ in range(n)]
+    tasks = queue.Queue()
+    stop = threading.Event()
+    lock = threading.Lock()  # orders the stop with the results of the workers
+
+    def worker():
+      while not stop.is_set():
+        try:
+          i = tasks.get(timeout=0.5)
+        except queue.Empty:
+          continue
+        if i is None or stop.is_set():
+          return
+        try:
+          result = self.cache.stage(self.infiles[i])
+        except Exception as e:
+          result = e
+        with lock:
+          if stop.is_set():
+            # The loop is gone, so unpin the file here
+            if not isinstance(result, Exception):
+              self.cache.release(result)
+            return
+          results[i] = result
+          done[i].set()
+
+    threads = [threading.Thread(target=worker) for _ in range(self.nthreads)]
+    for t in threads:
+      t.daemon = True
+      t.start()
+
+    submitted = 0
+    released = [False] * n
+    try:
+      for i in range(n):
+        # Keep the next nahead files in flight
+        while submitted < min(n, i + 1 + self.nahead):
+          tasks.put(submitted)
+          submitted += 1
+        done[i].wait()
+        if isinstance(results[i], Exception):
+          print('[WARNING] Cannot stage file: {0} ({1}), reading it remotely'.format(self.infiles[i], results[i]))
+          yield self.infiles[i]
+        else:
+          yield results[i]
+          self.cache.release(results[i])
+          released[i] = True
+    finally:
+      # The loop can be interrupted, so unpin the file in use and the files staged ahead.
+      # The workers are not joined, as they can be in the middle of a copy; the files
+      # they stage after the stop are unpinned by the workers.
+      with lock:
+        stop.set()
+      for i in range(n):
+        if done[i].is_set() and not isinstance(results[i], Exception) and not released[i]:
+          self.cache.release(results[i])
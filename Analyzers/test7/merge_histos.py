@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""Merge the histos_tb* job outputs.
+
+ROOT files (histos_tbb_<jobid>.root, histos_tbc_<jobid>.root): the histograms
+are added by name. The shards are merged in groups of 'fanin' files by a pool
+of processes, then the partial sums are merged again, until one file is left
+(tree reduction). Each process holds one running sum and one shard at a time.
+
+npz files (histos_tba_<jobid>.npz, histos_tbd_<jobid>.npz): the arrays are
+concatenated along the first axis, 0-d arrays must be equal in all the shards.
+The shards are checked in parallel (array headers and zip CRCs). Then, for each
+array, the shards are streamed one at a time into a memory-mapped .npy file,
+which is added to the output zip. Only one array of one shard is held in memory.
+
+The first readable shard defines the schema: histogram names, classes and
+binning for ROOT, array names, dtypes and trailing shapes for npz. The shards
+that cannot be read or that do not match the schema are skipped and reported.
+
+Usage: python merge_histos.py outfile infile1 [infile2 ...]
+  e.g. python merge_histos.py histos_tbb_add.root 'histos_tbb_*.root'
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+import numpy as np
+
+
+# ______________________________________________________________________________
+# Settings
+
+# Number of files merged by a task
+fanin = 16
+
+# Number of processes
+nprocs = 8
+
+
+# ______________________________________________________________________________
+# ROOT files
+
+def get_root_schema(infile):
+  # Returns {name: (class name, nbinsx, xmin, xmax, nbinsy, nbinsz)} of the histograms
+  from ROOT import TFile
+  tfile = TFile.Open(infile)
+  if not tfile or tfile.IsZombie() or tfile.TestBit(TFile.kRecovered):
+    raise IOError('cannot open file')
+  try:
+    schema = {}
+    for key in tfile.GetListOfKeys():
+      obj = key.ReadObj()
+      if obj.InheritsFrom('TH1'):
+        xaxis = obj.GetXaxis()
+        schema[obj.GetName()] = (obj.ClassName(), obj.GetNbinsX(), xaxis.GetXmin(), xaxis.GetXmax(), obj.GetNbinsY(), obj.GetNbinsZ())
+  finally:
+    tfile.Close()
+  if not schema:
+    raise IOError('no histograms')
+  return schema
+
+def merge_root_group(args):
+  # Add the histograms of infiles into outfile. Returns (outfile, number of merged files, bad files)
+  (infiles, outfile, schema) = args
+  from ROOT import TFile, TH1
+  TH1.AddDirectory(False)
+
+  histograms = {}
+  nmerged = 0
+  bad = []
+  for infile in infiles:
+    try:
+      if schema is not None and get_root_schema(infile) != schema:
+        raise IOError('schema mismatch')
+      tfile = TFile.Open(infile)
+      try:
+        for key in tfile.GetListOfKeys():
+          obj = key.ReadObj()
+          if not obj.InheritsFrom('TH1'):
+            continue
+          name = obj.GetName()
+          if name in histograms:
+            histograms[name].Add(obj)
+          else:
+            obj.SetDirectory(0)
+            histograms[name] = obj
+      finally:
+        tfile.Close()
+      nmerged += 1
+    except Exception as e:
+      bad.append((infile, str(e)))
+
+  if histograms:
+    tfile = TFile.Open(outfile, 'RECREATE')
+    for name in sorted(histograms):
+      histograms[name].Write()
+    tfile.Close()
+  return (outfile, nmerged, bad)
+
+def merge_root(outfile, infiles, pool):
+  # Schema from the first readable shard
+  schema = None
+  bad = []
+  for infile in infiles:
+    try:
+      schema = pool.apply(get_root_schema, (infile,))
+      break
+    except Exception as e:
+      bad.append((infile, str(e)))
+  if schema is None:
+    raise RuntimeError('Cannot read any of the input files')
+  infiles = infiles[len(bad):]
+  print('[INFO] Schema: {0} histograms'.format(len(schema)))
+
+  tmpdir = tempfile.mkdtemp(prefix='merge_', dir=os.path.dirname(os.path.abspath(outfile)))
+  try:
+    level = 0
+    nmerged = 0
+    current = infiles
+    while True:
+      groups = [current[i:i+fanin] for i in range(0, len(current), fanin)]
+      tasks = [(group, os.path.join(tmpdir, 'level%i_%i.root' % (level, i)), schema if level == 0 else None) for i, group in enumerate(groups)]
+      results = pool.map(merge_root_group, tasks, chunksize=1)
+      current = [r[0] for r in results if r[1] > 0]
+      for r in results:
+        bad += r[2]
+        if level == 0:
+          nmerged += r[1]
+      print('[INFO] Level {0}: {1} files -> {2} files'.format(level, sum(len(group) for group in groups), len(current)))
+      level += 1
+      if len(current) <= 1:
+        break
+    if not current:
+      raise RuntimeError('Cannot read any of the input files')
+    shutil.move(current[0], outfile)
+  finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
+  return nmerged, bad
+
+
+# ______________________________________________________________________________
+# npz files
+
+def read_npy_header(fp):
+  version = np.lib.format.read_magic(fp)
+  if version == (1, 0):
+    return np.lib.format.read_array_header_1_0(fp)
+  else:
+    return np.lib.format.read_array_header_2_0(fp)
+
+def get_npz_schema(infile):
+  # Returns ({name: (dtype, trailing shape, ndim)}, {name: length}), checks the zip CRCs
+  schema, lengths = {}, {}
+  with zipfile.ZipFile(infile) as zf:
+    badfile = zf.testzip()
+    if badfile is not None:
+      raise IOError('bad CRC in {0}'.format(badfile))
+    for fname in zf.namelist():
+      if not fname.endswith('.npy'):
+        continue
+      name = fname[:-len('.npy')]
+      fp = zf.open(fname)
+      try:
+        shape, fortran_order, dtype = read_npy_header(fp)
+      finally:
+        fp.close()
+      if dtype.hasobject:
+        raise IOError('object array {0} is not supported'.format(name))
+      schema[name] = (dtype.str, tuple(shape[1:]), len(shape))
+      lengths[name] = shape[0] if len(shape) else 0
+  if not schema:
+    raise IOError('no arrays')
+  return schema, lengths
+
+def check_npz(infile):
+  try:
+    schema, lengths = get_npz_schema(infile)
+    return (infile, schema, lengths, None)
+  except Exception as e:
+    return (infile, None, None, str(e))
+
+def merge_npz(outfile, infiles, pool):
+  # Check the shards in parallel
+  results = pool.map(check_npz, infiles, chunksize=1)
+  bad = [(infile, error) for (infile, schema, lengths, error) in results if error is not None]
+  results = [r for r in results if r[3] is None]
+  if not results:
+    raise RuntimeError('Cannot read any of the input files')
+  schema = results[0][1]
+  bad += [(r[0], 'schema mismatch') for r in results if r[1] != schema]
+  results = [r for r in results if r[1] == schema]
+  infiles = [r[0] for r in results]
+  print('[INFO] Schema: {0}'.format(', '.join('{0} {1}'.format(name, schema[name]) for name in sorted(schema))))
+
+  tmpdir = tempfile.mkdtemp(prefix='merge_', dir=os.path.dirname(os.path.abspath(outfile)))
+  try:
+    tmpfile = outfile + '.tmp'
+    with zipfile.ZipFile(tmpfile, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+      for name in sorted(schema):
+        dtype, trailing_shape, ndim = schema[name]
+        npyfile = os.path.join(tmpdir, name + '.npy')
+        if ndim == 0:
+          # Must be the same in all the shards
+          value = None
+          for infile in infiles:
+            with np.load(infile) as data:
+              if value is None:
+                value = data[name]
+              elif not np.array_equal(value, data[name]):
+                raise RuntimeError('Inconsistent values of {0} in: {1}'.format(name, infile))
+          np.save(npyfile, value)
+        else:
+          total = sum(r[2][name] for r in results)
+          out = np.lib.format.open_memmap(npyfile, mode='w+', dtype=np.dtype(dtype), shape=(total,) + trailing_shape)
+          begin = 0
+          for infile, _, lengths, _ in results:
+            with np.load(infile) as data:
+              out[begin:begin+lengths[name]] = data[name]
+            begin += lengths[name]
+          out.flush()
+          del out
+        zf.write(npyfile, arcname=name + '.npy')
+        os.remove(npyfile)
+    os.rename(tmpfile, outfile)
+  finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
+  return len(infiles), bad
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Merge the histos_tb* job outputs')
+  parser.add_argument('outfile')
+  parser.add_argument('infiles', nargs='+', help='input files or glob patterns')
+  parser.add_argument('--nprocs', type=int, default=nprocs)
+  parser.add_argument('--fanin', type=int, default=fanin)
+  args = parser.parse_args()
+  fanin = max(2, args.fanin)
+
+  infiles = []
+  for pattern in args.infiles:
+    infiles += sorted(glob.glob(pattern)) or [pattern]
+  infiles = [infile for infile in infiles if os.path.abspath(infile) != os.path.abspath(args.outfile)]
+  if not infiles:
+    print(__doc__)
+    sys.exit(1)
+  print('[INFO] Merging {0} files into: {1}'.format(len(infiles), args.outfile))
+
+  pool = multiprocessing.Pool(processes=args.nprocs)
+  try:
+    if args.outfile.endswith('.root'):
+      nmerged, bad = merge_root(args.outfile, infiles, pool)
+    elif args.outfile.endswith('.npz'):
+      nmerged, bad = merge_npz(args.outfile, infiles, pool)
+    else:
+      raise RuntimeError('Cannot recognize file type: {0}'.format(args.outfile))
+  finally:
+    pool.close()
+    pool.join()
+
+  for infile, error in bad:
+    print('[WARNING] Skipped file: {0} ({1})'.format(infile, error))
+  print('[INFO] Merged {0} files, skipped {1} files'.format(nmerged, len(bad)))
+  print('[INFO] Creating file: %s' % args.outfile)
+  sys.exit(1 if bad else 0)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""Fixed-point emulation of the pT assignment networks.
+
+The networks are meant to run in FPGA firmware through hls4ml, where each
+quantity is an ap_fixed<W,I> number: W bits in total, I of them (including
+the sign) before the binary point. FixedPointModel evaluates a SparseModel
+(see nn_sparse.py, with the BatchNormalization layers folded) with per-layer
+fixed-point types for the weights, biases, accumulators and results, and
+tanh/sigmoid read from lookup tables, as in the hls4ml templates:
+ - tanh: 'table_size' entries over [-4, 4)
+ - sigmoid: 'table_size' entries over [-8, 8)
+By default, the values are truncated (AP_TRN) and wrap around on overflow
+(AP_WRAP), like ap_fixed. Set rounding='round' and overflow='saturate' to
+emulate AP_RND and AP_SAT.
+
+Each tensor is held as integer codes (value * 2^F). The products are summed
+with a float matrix product, which is exact as long as the sum stays within
+the float mantissa: float32 is used when the bound on the sum is below 2^24,
+float64 otherwise. (numpy does not use BLAS for integer matrix products, so
+they are several times slower than the float ones.)
+
+The inputs can also be given as integer codes (see quantize_input), e.g. int16
+arrays for large rate studies, which take half the memory of float32.
+
+Running this module compares the fixed-point and float predictions on the
+encoded road variables of a RoadsCache file, for several default precisions.
+
+Usage: python nn_fixed.py model.json model_weights.h5 [roads_cache.npz]
+"""
+
+import json
+import sys
+import time
+
+import numpy as np
+
+from nn_sparse import (SparseModel, DenseOp, BatchNormOp, ActivationOp, load_weights_h5, load_sparse_model,
+                       get_benchmark_batches, activations)
+
+
+# ______________________________________________________________________________
+# Settings
+
+# Default type of all the quantities, as (W, I) of ap_fixed<W,I>
+default_precision = (16, 6)
+
+# Number of entries of the tanh/sigmoid tables
+table_size = 1024
+
+# Default precisions of the benchmark
+precisions = ((8, 3), (10, 4), (12, 5), (14, 6), (16, 6), (18, 8))
+
+# Scale of the regression output (q/pT * reg_pt_scale), for the pT deviation in the benchmark
+reg_pt_scale = 100.
+
+
+# ______________________________________________________________________________
+# Classes
+
+class FixedType(object):
+  def __init__(self, width, integer, rounding='floor', overflow='wrap'):
+    assert rounding in ('floor', 'round') and overflow in ('wrap', 'saturate')
+    self.width = width
+    self.integer = integer
+    self.frac = width - integer
+    self.rounding = rounding
+    self.overflow = overflow
+    self.min_code = -(1 << (width - 1))
+    self.max_code = (1 << (width - 1)) - 1
+
+  def __repr__(self):
+    return 'ap_fixed<{0},{1}>'.format(self.width, self.integer)
+
+  def codes(self, x, frac=0):
+    # Convert values, or codes with 'frac' fractional bits, to codes of this type (as floats)
+    c = np.asarray(x, dtype=np.float64) * 2.**(self.frac - frac)
+    c = np.floor(c) if self.rounding == 'floor' else np.floor(c + 0.5)
+    if self.overflow == 'saturate':
+      c = np.clip(c, self.min_code, self.max_code)
+    else:
+      c = np.mod(c - self.min_code, 2.**self.width) + self.min_code
+    return c
+
+  def int_dtype(self):
+    return np.int8 if self.width <= 8 else np.int16 if self.width <= 16 else np.int32
+
+
+class FixedOp(object):
+  # One layer: optional matrix product (Dense) or scaling (BatchNormalization), then the activation
+  def __init__(self, name, op, types, rounding, overflow):
+    def get_type(k):
+      return FixedType(*types.get(k, types['default']), rounding=rounding, overflow=overflow)
+    self.name = name
+    self.weight_t, self.bias_t, self.accum_t, self.result_t = [get_type(k) for k in ('weight', 'bias', 'accum', 'result')]
+
+    self.kernel = None
+    self.scale = None
+    self.activation = 'linear'
+    if isinstance(op, DenseOp):
+      self.kernel = self.weight_t.codes(op.kernel)
+      self.kernel_bound = np.abs(self.kernel).sum(axis=0).max()
+      self.bias = self.bias_t.codes(op.bias)
+      self.activation = op.activation
+    elif isinstance(op, BatchNormOp):
+      self.scale = self.weight_t.codes(op.scale)
+      self.bias = self.bias_t.codes(op.offset)
+    elif isinstance(op, ActivationOp):
+      self.activation = op.activation
+    else:
+      raise RuntimeError('Layer {0} is not supported'.format(name))
+
+    # Lookup table, indexed by the accumulator value
+    self.table = None
+    if self.activation in ('tanh', 'NewTanh', 'sigmoid'):
+      lo, hi = (-4., 4.) if self.activation != 'sigmoid' else (-8., 8.)
+      f = np.tanh if self.activation != 'sigmoid' else activations['sigmoid']
+      self.table_lo = lo
+      self.table_step = (hi - lo) / table_size
+      self.table = self.result_t.codes(f(lo + self.table_step * np.arange(table_size)))
+    elif self.activation not in ('linear', 'relu', 'NewLeakyReLU'):
+      raise RuntimeError('Activation {0} of layer {1} is not supported'.format(self.activation, name))
+
+  def matmul(self, x):
+    # Codes of x times the kernel codes, exactly
+    bound = np.abs(x).max() * self.kernel_bound if len(x) else 0.
+    dtype = np.float32 if bound < 2.**24 else np.float64
+    return np.dot(x.astype(dtype), self.kernel.astype(dtype)).astype(np.float64)
+
+  def __call__(self, x, frac):
+    # x are codes with 'frac' fractional bits, returns the result codes and their fractional bits
+    if self.kernel is not None:
+      acc = self.matmul(x)
+      acc_frac = frac + self.weight_t.frac
+    elif self.scale is not None:
+      acc = x * self.scale
+      acc_frac = frac + self.weight_t.frac
+    else:
+      acc, acc_frac = x, frac
+    if self.kernel is not None or self.scale is not None:
+      # Align the bias to the products, both are exact in float64
+      acc = acc * 2.**-acc_frac + self.bias * 2.**-self.bias_t.frac
+      acc_frac = 0
+    acc = self.accum_t.codes(acc, acc_frac)
+
+    if self.table is not None:
+      index = np.floor((acc * 2.**-self.accum_t.frac - self.table_lo) / self.table_step)
+      index = np.clip(index, 0, table_size - 1).astype(np.int32)
+      return self.table[index], self.result_t.frac
+    if self.activation in ('relu', 'NewLeakyReLU'):
+      acc = np.maximum(acc, 0)
+    return self.result_t.codes(acc, self.accum_t.frac), self.result_t.frac
+
+
+class FixedPointModel(object):
+  def __init__(self, model, precision=default_precision, layer_precisions=None, input_precision=None,
+               rounding='floor', overflow='wrap'):
+    # 'model' is a SparseModel. 'layer_precisions' is {layer name: {'weight': (W, I), 'bias', 'accum', 'result'}}
+    self.input_name = model.input_name
+    self.outputs = model.outputs
+    self.input_t = FixedType(*(input_precision or precision), rounding=rounding, overflow=overflow)
+    layer_precisions = layer_precisions or {}
+    self.ops = []
+    for (name, op, inbound) in model.ops:
+      types = dict(layer_precisions.get(name, {}))
+      types['default'] = precision
+      self.ops.append((name, FixedOp(name, op, types, rounding, overflow), inbound))
+
+  def quantize_input(self, x):
+    # Integer codes of the inputs, e.g. to store large input arrays
+    return self.input_t.codes(x).astype(self.input_t.int_dtype())
+
+  def predict(self, x, batch_size=None):
+    # Same output as keras predict. x can be floats or the integer codes from quantize_input
+    x = np.asarray(x)
+    if x.dtype.kind in 'iu':
+      codes = x.astype(np.float64)
+    else:
+      codes = self.input_t.codes(x)
+    values = {self.input_name: (codes, self.input_t.frac)}
+    for (name, op, inbound) in self.ops:
+      values[name] = op(*values[inbound])
+    y = [(values[name][0] * 2.**-values[name][1]).astype(np.float32) for name in self.outputs]
+    return y[0] if len(y) == 1 else y
+
+
+def load_fixed_point_model(name='model', weights_name='model_weights', **kwargs):
+  # Same arguments as load_my_model in nn_models.py, the others are passed to FixedPointModel
+  model = load_sparse_model(name=name, weights_name=weights_name, min_sparsity=2.)  # dense
+  return FixedPointModel(model, **kwargs)
+
+def compare_predictions(y_float, y_fixed):
+  # Returns [(mean, rms, max)] of the absolute deviation of each output
+  if not isinstance(y_float, list):
+    y_float, y_fixed = [y_float], [y_fixed]
+  result = []
+  for a, b in zip(y_float, y_fixed):
+    d = np.abs(a.astype(np.float64) - b.astype(np.float64))
+    result.append((d.mean(), np.sqrt(np.square(d).mean()), d.max()))
+  return result
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print(__doc__)
+    sys.exit(1)
+  jsonfile, weightsfile = sys.argv[1], sys.argv[2]
+  roadsfile = sys.argv[3] if len(sys.argv) > 3 else None
+
+  with open(jsonfile, 'r') as f:
+    config = json.load(f)['config']
+  weights = load_weights_h5(weightsfile)
+  model = SparseModel(config, weights, min_sparsity=2.)  # dense
+  nin = model.dense_ops()[0].kernel.shape[0]
+  x = np.concatenate(get_benchmark_batches(nin, roadsfile))
+
+  t0 = time.time()
+  y_float = model.predict(x)
+  t_float = time.time() - t0
+  print('[INFO] Float: {0} roads, {1:.0f} roads/s'.format(len(x), len(x) / t_float))
+
+  # The first output is the regression, the second (if any) the discriminator
+  results = np.zeros((len(precisions), 5), dtype=np.float64)
+  for i, precision in enumerate(precisions):
+    fixed_model = FixedPointModel(model, precision=precision)
+    t0 = time.time()
+    y_fixed = fixed_model.predict(x)
+    t_fixed = time.time() - t0
+    dev = compare_predictions(y_float, y_fixed)
+
+    y0_float = y_float[0] if isinstance(y_float, list) else y_float
+    y0_fixed = y_fixed[0] if isinstance(y_fixed, list) else y_fixed
+    pt_float = reg_pt_scale / np.maximum(np.abs(y0_float), 1e-6)
+    pt_fixed = reg_pt_scale / np.maximum(np.abs(y0_fixed), 1e-6)
+    rel_pt = np.abs(pt_fixed - pt_float) / pt_float
+    results[i] = [len(x) / t_fixed, dev[0][1], np.median(rel_pt), np.percentile(rel_pt, 99), dev[-1][1]]
+    print('[INFO] ap_fixed<{0},{1}>: {2:.0f} roads/s, regr rms dev {3:.4f}, |dpT|/pT median {4:.4f} 99% {5:.4f}, last output rms dev {6:.4f}'.format(
+        precision[0], precision[1], *results[i]))
+
+  outfile = 'benchmark_nn_fixed.npz'
+  print('[INFO] Creating file: %s' % outfile)
+  np.savez_compressed(outfile, precisions=precisions, results=results, float_roads_per_sec=len(x) / t_float)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+"""Inference of the pT assignment networks with sparse weights.
+
+After pruning (see nn_pruning.py), most of the weights of the hidden Dense
+layers are exactly zero. SparseModel evaluates a Keras model (Dense,
+BatchNormalization, Activation, Dropout) with numpy: each BatchNormalization is
+folded into the Dense layer before it, and each Dense kernel with a fraction of
+zeros of at least 'min_sparsity' is stored in compressed form and multiplied
+as a sparse-dense product. The other kernels are multiplied as dense matrices.
+
+The compressed form is a scipy CSR matrix if scipy is available, otherwise a
+list of nonzero (row, col, weight) entries sorted by column, summed with
+np.add.reduceat (only if use_reduceat is set, see below). Even for dense
+kernels, the folding and the evaluation of each batch in one go are faster
+than keras predict on the small per-event batches. The model is read from the json and weights files (with
+h5py), so that keras and tensorflow are not needed.
+
+The benchmark prunes the hidden layers to several sparsities, then compares
+the dense and sparse products on the road batches of a RoadsCache file (one
+batch per event, as in RatesAnalysis), and on a single large batch.
+
+Usage: python nn_sparse.py model.json model_weights.h5 [roads_cache.npz]
+"""
+
+import json
+import sys
+import time
+
+import numpy as np
+
+try:
+  import scipy.sparse
+  has_scipy = True
+except ImportError:
+  has_scipy = False
+
+
+# ______________________________________________________________________________
+# Settings
+
+# Kernels with a fraction of zeros below this are multiplied as dense matrices
+min_sparsity = 0.9
+
+# Without scipy, the sparse product is done with np.add.reduceat. For the layer
+# sizes of the pT assignment networks (up to 64 nodes), it is slower than the
+# dense product at all the sparsities of the benchmark, so it is off by default.
+use_reduceat = False
+
+# Sparsities of the benchmark
+sparsities = (0., 0.5, 0.7, 0.8, 0.9, 0.95)
+
+
+# ______________________________________________________________________________
+# Functions
+
+def sigmoid(x):
+  return 1. / (1. + np.exp(-x))
+
+def elu(x, alpha=1.0):
+  return np.where(x > 0, x, alpha * (np.exp(np.minimum(x, 0)) - 1.))
+
+activations = {
+  'linear': lambda x: x,
+  'tanh': np.tanh,
+  'NewTanh': np.tanh,
+  'sigmoid': sigmoid,
+  'relu': lambda x: np.maximum(x, 0),
+  'NewLeakyReLU': lambda x: np.maximum(x, 0),
+  'elu': elu,
+  'NewElu': lambda x: elu(x) + 1.0 + 1e-15,
+}
+
+def get_layer_specs(config):
+  # Returns [(class name, layer config, inbound layer name)] for a Model or Sequential config
+  if isinstance(config, dict) and 'output_layers' in config:
+    specs = []
+    for layer in config['layers']:
+      inbound = None
+      if layer['inbound_nodes']:
+        nodes = layer['inbound_nodes'][0]
+        assert len(nodes) == 1, 'layers with several inputs are not supported: {0}'.format(layer['name'])
+        inbound = nodes[0][0]
+      specs.append((layer['class_name'], layer['config'], inbound))
+    outputs = [name for (name, _, _) in config['output_layers']]
+    return specs, outputs
+
+  layers = config['layers'] if isinstance(config, dict) else config  # Sequential
+  specs = []
+  inbound = None
+  for layer in layers:
+    specs.append((layer['class_name'], layer['config'], inbound))
+    inbound = layer['config']['name']
+  return specs, [inbound]
+
+def load_weights_h5(filename):
+  # Returns {layer name: [arrays]} from a keras weights file
+  import h5py
+  weights = {}
+  with h5py.File(filename, 'r') as f:
+    g = f['model_weights'] if 'model_weights' in f else f
+    for name in g.attrs['layer_names']:
+      name = name.decode('utf8') if isinstance(name, bytes) else name
+      weight_names = g[name].attrs['weight_names']
+      weights[name] = [np.asarray(g[name][w]) for w in weight_names]
+  return weights
+
+def load_sparse_model(name='model', weights_name='model_weights', min_sparsity=min_sparsity):
+  # Same arguments as load_my_model in nn_models.py
+  with open(name + '.json', 'r') as f:
+    config = json.load(f)
+  weights = load_weights_h5(weights_name + '.h5')
+  return SparseModel(config['config'], weights, min_sparsity=min_sparsity)
+
+
+# ______________________________________________________________________________
+# Classes
+
+class DenseOp(object):
+  def __init__(self, kernel, bias, activation='linear', min_sparsity=min_sparsity):
+    self.kernel = np.asarray(kernel, dtype=np.float32)
+    self.bias = np.asarray(bias, dtype=np.float32) if bias is not None else np.zeros(self.kernel.shape[1], dtype=np.float32)
+    self.activation = activation
+    self.min_sparsity = min_sparsity
+    self.compress()
+
+  def sparsity(self):
+    return 1. - float(np.count_nonzero(self.kernel)) / self.kernel.size
+
+  def compress(self):
+    # Choose dense or sparse product for the current kernel
+    self.is_sparse = self.sparsity() >= self.min_sparsity and (has_scipy or use_reduceat)
+    if not self.is_sparse:
+      return
+    if has_scipy:
+      self.csr = scipy.sparse.csr_matrix(self.kernel.T)  # (nout, nin)
+    else:
+      rows, cols = np.nonzero(self.kernel.T)  # sorted by output column
+      rows, cols = cols, rows
+      self.rows = rows
+      self.values = self.kernel[rows, cols]
+      self.cols, self.starts = np.unique(cols, return_index=True)
+
+  def fold_batchnorm(self, bn):
+    # The zeros of the kernel are kept
+    self.kernel = (self.kernel * bn.scale).astype(np.float32)
+    self.bias = (self.bias * bn.scale + bn.offset).astype(np.float32)
+    self.compress()
+
+  def __call__(self, x):
+    if not self.is_sparse:
+      y = np.dot(x, self.kernel)
+    elif has_scipy:
+      y = self.csr.dot(x.T).T
+    else:
+      # Sum the products of each output column along contiguous rows of x.T
+      yt = np.zeros((self.kernel.shape[1], x.shape[0]), dtype=np.float32)
+      if len(self.values):
+        xt = np.ascontiguousarray(x.T)
+        yt[self.cols] = np.add.reduceat(xt[self.rows] * self.values[:, np.newaxis], self.starts, axis=0)
+      y = yt.T
+    y = y + self.bias
+    return activations[self.activation](y)
+
+class BatchNormOp(object):
+  # BatchNormalization that cannot be folded, e.g. right after the input
+  def __init__(self, weights, layer_config):
+    w = list(weights)
+    n = w[-1].shape[0]
+    gamma = w.pop(0) if layer_config['scale'] else np.ones(n, dtype=np.float32)
+    beta = w.pop(0) if layer_config['center'] else np.zeros(n, dtype=np.float32)
+    mean, variance = w
+    self.scale = (gamma / np.sqrt(variance + layer_config['epsilon'])).astype(np.float32)
+    self.offset = (beta - mean * self.scale).astype(np.float32)
+
+  def __call__(self, x):
+    return x * self.scale + self.offset
+
+class ActivationOp(object):
+  # Activation that cannot be folded
+  def __init__(self, activation):
+    self.activation = activation
+
+  def __call__(self, x):
+    return activations[self.activation](x)
+
+class SparseModel(object):
+  def __init__(self, config, weights, min_sparsity=min_sparsity):
+    # 'config' is model.get_config() (or the 'config' of the json file), 'weights' is {layer name: [arrays]}
+    specs, self.outputs = get_layer_specs(config)
+
+    nconsumers = {}
+    for (class_name, layer_config, inbound) in specs:
+      nconsumers[inbound] = nconsumers.get(inbound, 0) + 1
+
+    self.ops = []  # (name, op, inbound name)
+    self.input_name = None  # the first layer of a Sequential reads the input
+    alias = {}  # name of a folded layer -> name of the op producing its output
+    for (class_name, layer_config, inbound) in specs:
+      name = layer_config['name']
+      inbound = alias.get(inbound, inbound)
+      last = self.ops[-1] if self.ops else None
+      can_fold = (last is not None and last[0] == inbound and isinstance(last[1], DenseOp) and nconsumers.get(inbound, 0) == 1)
+
+      if class_name == 'InputLayer':
+        self.input_name = name
+      elif class_name == 'Dense':
+        w = weights[name]
+        op = DenseOp(w[0], w[1] if layer_config['use_bias'] else None, layer_config['activation'], min_sparsity)
+        self.ops.append((name, op, inbound))
+      elif class_name == 'BatchNormalization' and can_fold and last[1].activation == 'linear':
+        last[1].fold_batchnorm(BatchNormOp(weights[name], layer_config))
+        alias[name] = inbound
+        nconsumers[inbound] = nconsumers.get(name, 0)
+      elif class_name == 'BatchNormalization':
+        self.ops.append((name, BatchNormOp(weights[name], layer_config), inbound))
+      elif class_name == 'Activation' and can_fold and last[1].activation == 'linear':
+        last[1].activation = layer_config['activation']
+        alias[name] = inbound
+        nconsumers[inbound] = nconsumers.get(name, 0)
+      elif class_name == 'Activation':
+        self.ops.append((name, ActivationOp(layer_config['activation']), inbound))
+      elif class_name == 'Dropout':
+        alias[name] = inbound
+      else:
+        raise RuntimeError('Layer {0} ({1}) is not supported'.format(name, class_name))
+    self.outputs = [alias.get(name, name) for name in self.outputs]
+
+  def dense_ops(self):
+    return [op for (name, op, inbound) in self.ops if isinstance(op, DenseOp)]
+
+  def predict(self, x, batch_size=None):
+    # Same output as keras predict: an array, or a list of arrays for several outputs
+    values = {self.input_name: np.asarray(x, dtype=np.float32)}
+    for (name, op, inbound) in self.ops:
+      values[name] = op(values[inbound])
+    y = [values[name] for name in self.outputs]
+    return y[0] if len(y) == 1 else y
+
+
+# ______________________________________________________________________________
+# Benchmark
+
+def prune_kernels(model, sparsity, outputs):
+  # Zero the smallest weights of each hidden layer to the given sparsity
+  for (name, op, inbound) in model.ops:
+    if isinstance(op, DenseOp) and name not in outputs and sparsity > 0.:
+      threshold = np.percentile(np.abs(op.kernel), 100. * sparsity)
+      op.kernel = np.where(np.abs(op.kernel) <= threshold, 0., op.kernel).astype(np.float32)
+      op.compress()
+
+def set_min_sparsity(model, value):
+  for op in model.dense_ops():
+    op.min_sparsity = value
+    op.compress()
+
+def get_benchmark_batches(nin, roadsfile=None, nevents=2000, seed=2026):
+  # Returns the list of per-event input batches
+  rng = np.random.RandomState(seed)
+  if roadsfile is not None:
+    with np.load(roadsfile) as data:
+      road_event = data['road_event_0']
+      variables = data['variables_0']
+    sizes = np.unique(road_event, return_counts=True)[1]
+    print('[INFO] Loaded {0} roads in {1} events from {2}'.format(len(road_event), len(sizes), roadsfile))
+    x = None
+    try:
+      from nn_encode import Encoder
+      x = Encoder(variables, np.zeros((len(variables), 3), dtype=np.float32), reg_pt_scale=100.).get_x()
+      assert x.shape[1] == nin
+    except Exception as e:
+      print('[WARNING] Cannot encode the road variables ({0}), using random inputs'.format(e))
+      x = None
+    if x is None:
+      x = rng.normal(size=(len(road_event), nin))
+  else:
+    print('[WARNING] No roads file, using random inputs with Poisson(20) roads per event')
+    sizes = rng.poisson(20, size=nevents)
+    x = rng.normal(size=(sizes.sum(), nin))
+  x = np.asarray(x, dtype=np.float32)
+  bounds = np.concatenate(([0], np.cumsum(sizes)))
+  return [x[b:e] for (b, e) in zip(bounds[:-1], bounds[1:]) if e > b]
+
+def time_predict(model, batches, repeat=3):
+  # Returns the best time over 'repeat' runs
+  best = float('inf')
+  for _ in range(repeat):
+    t0 = time.time()
+    for x in batches:
+      model.predict(x)
+    best = min(best, time.time() - t0)
+  return best
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print(__doc__)
+    sys.exit(1)
+  jsonfile, weightsfile = sys.argv[1], sys.argv[2]
+  roadsfile = sys.argv[3] if len(sys.argv) > 3 else None
+  print('[INFO] Using scipy: {0}'.format(has_scipy))
+  use_reduceat = True
+
+  with open(jsonfile, 'r') as f:
+    config = json.load(f)['config']
+  weights = load_weights_h5(weightsfile)
+  nin = SparseModel(config, weights).dense_ops()[0].kernel.shape[0]
+  batches = get_benchmark_batches(nin, roadsfile)
+  nroads = sum(len(x) for x in batches)
+  big_batch = [np.concatenate(batches)]
+
+  results = np.zeros((len(sparsities), 4), dtype=np.float64)  # roads/s: dense, sparse per event, dense, sparse one batch
+  print('  {0:>8s} {1:>12s} {2:>12s} {3:>7s} {4:>12s} {5:>12s} {6:>7s}'.format(
+      'sparsity', 'dense/evt', 'sparse/evt', 'ratio', 'dense/all', 'sparse/all', 'ratio'))
+  for i, sparsity in enumerate(sparsities):
+    model = SparseModel(config, weights)
+    prune_kernels(model, sparsity, model.outputs)
+    set_min_sparsity(model, 2.)  # dense
+    y_dense = model.predict(big_batch[0])
+    t_dense = time_predict(model, batches), time_predict(model, big_batch)
+    set_min_sparsity(model, 0.)  # sparse
+    y_sparse = model.predict(big_batch[0])
+    t_sparse = time_predict(model, batches), time_predict(model, big_batch)
+    diff = np.abs(np.asarray(y_dense) - np.asarray(y_sparse)).max()
+    assert diff < 1e-4, 'dense and sparse predictions differ by {0}'.format(diff)
+
+    results[i] = [nroads / t_dense[0], nroads / t_sparse[0], nroads / t_dense[1], nroads / t_sparse[1]]
+    print('  {0:8.2f} {1:12.0f} {2:12.0f} {3:7.2f} {4:12.0f} {5:12.0f} {6:7.2f}'.format(
+        sparsity, results[i,0], results[i,1], results[i,1]/results[i,0], results[i,2], results[i,3], results[i,3]/results[i,2]))
+
+  outfile = 'benchmark_nn_sparse.npz'
+  print('[INFO] Creating file: %s' % outfile)
+  np.savez_compressed(outfile, sparsities=sparsities, results=results, has_scipy=has_scipy)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""Scan the trigger working points over stored road predictions.
+
+The predictions are produced by the 'scan' (minbias PU200) and 'scan_effie'
+(particle gun) analyses in rootpy_trackbuilding8.py. For each point in a grid
+of (discr_pt_cut, discr_pt_cut_high, discr_cut_low, discr_cut_high, pt_scale),
+the rate and the efficiency at a given L1 pT threshold are evaluated with
+numpy, without re-running the jobs. Ghost busting is not applied, as it does
+not change whether an event has a track above threshold in most cases.
+
+Usage: python perf_scan.py [histos_tbf_rates*.npz] [histos_tbf_effie*.npz]
+"""
+
+import glob
+import sys
+
+import numpy as np
+
+from rootpy_trackbuilding8 import TrackProducer, pt_bins, find_emtf_road_quality
+
+
+# ______________________________________________________________________________
+# Settings
+
+l1pt = 20.
+
+# Grid of cut values (the current working point is included)
+grid = {
+  'discr_pt_cut'     : (6., 7., 8., 9., 10.),
+  'discr_pt_cut_high': (12., 14., 16., 18.),
+  'discr_cut_low'    : (0.15, 0.2, 0.2882, 0.35, 0.4),
+  'discr_cut_high'   : (0.6, 0.65, 0.7133, 0.75, 0.8),
+  'pt_scale'         : (0.9, 0.95, 1.0, 1.05, 1.1),
+}
+grid_names = ('discr_pt_cut', 'discr_pt_cut_high', 'discr_cut_low', 'discr_cut_high', 'pt_scale')
+
+# Max number of (grid point x road) entries evaluated at once
+chunk_size = 1 << 24
+
+
+# ______________________________________________________________________________
+# Functions
+
+def load_predictions(pattern):
+  # Concatenate the job outputs, making the event ids unique across jobs
+  roads_list, events_list = [], []
+  offset = 0
+  omtf_input = None
+  for fname in sorted(glob.glob(pattern)):
+    with np.load(fname) as data:
+      roads = data['roads'].astype(np.float64)
+      events = data['events'].astype(np.float64)
+      road_fields = list(data['road_fields'])
+      event_fields = list(data['event_fields'])
+      omtf_input = bool(data['omtf_input'])
+    roads[:, road_fields.index('event_id')] += offset
+    events[:, event_fields.index('event_id')] += offset
+    offset += len(events)
+    roads_list.append(roads)
+    events_list.append(events)
+  if not roads_list:
+    raise RuntimeError('Cannot find input files: {0}'.format(pattern))
+  roads = np.concatenate(roads_list)
+  events = np.concatenate(events_list)
+  roads = {k: roads[:, i] for i, k in enumerate(road_fields)}
+  events = {k: events[:, i] for i, k in enumerate(event_fields)}
+  print('[INFO] Loaded {0} roads, {1} events from {2}'.format(len(roads['event_id']), len(events['event_id']), pattern))
+  return roads, events, omtf_input
+
+def select_roads(roads, omtf_input):
+  # Same road selection as for the emtf2026 tracks in RatesAnalysis and EffieAnalysis
+  theta_deg = roads['theta_median'] * (45.0-8.5)/128. + 8.5  # same as calc_theta_deg_from_int()
+  abseta = -1. * np.log(np.tan(np.deg2rad(theta_deg)/2.))    # same as calc_eta_from_theta_deg()
+  if omtf_input:
+    sel = (roads['algo_mode'] == 1) & (roads['zone'] == 6) & (0.75 <= abseta) & (abseta <= 1.4)
+  else:
+    sel = (roads['algo_mode'] == 0) & (roads['zone'] <= 5) & (1.1 <= abseta) & (abseta <= 2.4)
+  roads = {k: v[sel] for k, v in roads.items()}
+  # Sort by event id, needed by np.maximum.reduceat
+  order = np.argsort(roads['event_id'], kind='mergesort')
+  return {k: v[order] for k, v in roads.items()}
+
+def get_static_quantities(roads, omtf_input, trkprod):
+  # Quantities that do not depend on the cut values
+  y_meas = roads['y_meas']
+  xml_pt = np.abs(1.0/y_meas)
+
+  ipt1 = roads['strg'].astype(np.int32)
+  ipt2 = np.clip(np.digitize(y_meas, pt_bins[1:]), 0, len(pt_bins)-2)
+  quality1 = find_emtf_road_quality(ipt1)
+  quality2 = find_emtf_road_quality(ipt2)
+  strg_ok = quality2 <= (quality1+1)
+
+  mode = roads['mode'].astype(np.int32)
+  mode_ok = np.isin(mode, (11,13,14,15))
+  if omtf_input:
+    mode_ok |= (roads['mode_omtf'] == 3)
+  else:
+    mode_ok |= (roads['mode_me0'] == 3)
+
+  # Same as TrackProducer.get_trigger_pt(), vectorized
+  binx = np.clip(xml_pt, trkprod.s_min, trkprod.s_max-1e-5)
+  binx = ((binx - trkprod.s_min) / (trkprod.s_max - trkprod.s_min) * trkprod.s_nbins).astype(np.int32)
+  binx[binx == trkprod.s_nbins-1] -= 1
+  x0, x1 = binx * trkprod.s_step, (binx+1) * trkprod.s_step
+  y0, y1 = trkprod.s_lut[binx], trkprod.s_lut[binx+1]
+  trigger_pt = (xml_pt - x0) / (x1 - x0) * (y1 - y0) + y0
+  trigger_pt = np.where(xml_pt <= 2., xml_pt, trigger_pt)
+  return xml_pt, strg_ok, mode_ok, trigger_pt
+
+def evaluate(roads, events, omtf_input, trkprod, points, select_event=None):
+  # Returns the fraction of selected events with at least one triggered road above l1pt,
+  # for each grid point. points has shape (npoints, 5).
+  xml_pt, strg_ok, mode_ok, trigger_pt = get_static_quantities(roads, omtf_input, trkprod)
+  y_discr = roads['y_discr']
+
+  all_event_ids = events['event_id']
+  if select_event is None:
+    select_event = np.ones(all_event_ids.shape, dtype=np.bool)
+  nevents = select_event.sum()
+
+  # Segment boundaries of each event in the (sorted) roads
+  uniq_ids, starts = np.unique(roads['event_id'], return_index=True)
+  uniq_selected = np.isin(uniq_ids, all_event_ids[select_event])
+
+  results = np.zeros((len(points),), dtype=np.float64)
+  if len(uniq_ids) == 0:
+    return results, nevents
+
+  nroads = len(y_discr)
+  step = max(1, chunk_size // max(1, nroads))
+  for begin in range(0, len(points), step):
+    p = points[begin:begin+step]
+    cut_lo, cut_hi, discr_lo, discr_hi, pt_scale = [p[:, i:i+1] for i in range(5)]
+    # Shape (nchunk, nroads)
+    trigger = np.where(xml_pt > cut_hi, y_discr > discr_hi,
+                       np.where(xml_pt > cut_lo, y_discr > discr_lo, (y_discr >= 0.) & strg_ok))
+    trigger = np.where(mode_ok, trigger, y_discr < 0.)  # same as TrackProducer.pass_trigger()
+    passed = trigger & (trigger_pt * pt_scale > l1pt)
+    # Any road per event
+    passed_evt = np.maximum.reduceat(passed.astype(np.int8), starts, axis=1).astype(np.bool)
+    results[begin:begin+step] = (passed_evt & uniq_selected).sum(axis=1)
+  return results / max(1, nevents), nevents
+
+def find_pareto_front(rates, effs):
+  # Minimize rate, maximize efficiency
+  order = np.lexsort((-effs, rates))
+  front = []
+  best_eff = -1.
+  for i in order:
+    if effs[i] > best_eff:
+      front.append(i)
+      best_eff = effs[i]
+  return np.array(front, dtype=np.int32)
+
+def make_rate(frac):
+  orbitFreq = 11246.
+  nCollBunches = 2808
+  return frac * orbitFreq * nCollBunches / 1000.  # in kHz
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  rates_pattern = sys.argv[1] if len(sys.argv) > 1 else 'histos_tbf_rates*.npz'
+  effie_pattern = sys.argv[2] if len(sys.argv) > 2 else 'histos_tbf_effie*.npz'
+
+  rates_roads, rates_events, omtf_input = load_predictions(rates_pattern)
+  effie_roads, effie_events, omtf_input_effie = load_predictions(effie_pattern)
+  assert(omtf_input == omtf_input_effie)
+
+  trkprod = TrackProducer(omtf_input=omtf_input)
+  rates_roads = select_roads(rates_roads, omtf_input)
+  effie_roads = select_roads(effie_roads, omtf_input)
+
+  # Efficiency denominator: same gen selection as EffieAnalysis, above the L1 threshold
+  part_abseta = np.abs(effie_events['part_eta'])
+  if omtf_input:
+    select_part = (0.8 <= part_abseta) & (part_abseta <= 1.24)
+  else:
+    select_part = (1.24 <= part_abseta) & (part_abseta <= 2.4)
+  select_part &= (effie_events['part_bx'] == 0) & (effie_events['part_pt'] > l1pt)
+
+  mesh = np.meshgrid(*[np.asarray(grid[k], dtype=np.float64) for k in grid_names], indexing='ij')
+  points = np.stack([m.ravel() for m in mesh], axis=-1)
+  print('[INFO] Scanning {0} grid points'.format(len(points)))
+
+  rates, nevents_rates = evaluate(rates_roads, rates_events, omtf_input, trkprod, points)
+  effs, nevents_effie = evaluate(effie_roads, effie_events, omtf_input, trkprod, points, select_event=select_part)
+  rates = make_rate(rates)
+
+  current = np.array([trkprod.discr_pt_cut, trkprod.discr_pt_cut_high, 0.2882, 0.7133, 1.0])
+  icurrent = np.nonzero(np.all(np.isclose(points, current), axis=1))[0]
+
+  print('[INFO] L1 pT > {0} GeV, minbias events: {1}, gen muons: {2}'.format(l1pt, nevents_rates, nevents_effie))
+  fmt = '{0:>8.1f} {1:>8.1f} {2:>8.4f} {3:>8.4f} {4:>6.2f} | rate: {5:8.3f} kHz  eff: {6:.4f}'
+  if len(icurrent):
+    i = icurrent[0]
+    print('[INFO] Current working point:')
+    print(fmt.format(*(tuple(points[i]) + (rates[i], effs[i]))))
+  print('[INFO] Pareto front ({0}):'.format(', '.join(grid_names)))
+  for i in find_pareto_front(rates, effs):
+    print(fmt.format(*(tuple(points[i]) + (rates[i], effs[i]))))
+
+  outfile = 'perf_scan.npz'
+  print('[INFO] Creating file: %s' % outfile)
+  np.savez_compressed(outfile, points=points, rates=rates, effs=effs, grid_names=grid_names)
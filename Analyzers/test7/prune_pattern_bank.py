@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""Profile the usage of the pattern bank cells and propose a pruned bank.
+
+The inputs are produced by the 'profile' (minbias PU200) and 'profile_effie'
+(particle gun) analyses in rootpy_trackbuilding8.py. For each cell of the
+bank (ipt, zone, layer), the hit offsets of the fired roads, the roads kept
+after cleaning, and the tracks are histogrammed.
+
+The proposed bank narrows each window to the smallest range that contains a
+fraction 'coverage' of the track hits in the particle gun sample. Cells with
+no track hits are disabled. The gain and the loss are projected by checking
+whether the stored roads still have enough layers inside the new windows:
+ - roads in zones 0,1: ME0 and ME1/1, or SingleMu
+ - roads in zone 6: at least 2 layers
+ - other zones: SingleMu (station mode 11,13,14,15 with a CSC MuOpen mode)
+This is a proxy of the requirement in PatternRecognition, so the numbers are
+an estimate; the new bank should be validated by running the jobs again.
+
+Usage: python prune_pattern_bank.py bankfile [histos_tbg_rates*.npz] [histos_tbg_effie*.npz] [outfile]
+"""
+
+import glob
+import sys
+
+import numpy as np
+
+from rootpy_trackbuilding8 import PATTERN_X_CENTRAL, find_emtf_layer_inverse, get_file_hash, nlayers
+
+
+# ______________________________________________________________________________
+# Settings
+
+# Fraction of the track hits to keep in each cell
+coverage = 0.995
+
+# Min number of tracks in an (ipt, zone) to change its windows
+min_tracks = 20
+
+# Number of roads evaluated at once
+chunk_size = 1 << 18
+
+noffsets = 2*PATTERN_X_CENTRAL + 1
+
+
+# ______________________________________________________________________________
+# Functions
+
+def load_profile(pattern):
+  # Concatenate the job outputs, making the event ids unique across jobs
+  roads_list, masks_list = [], []
+  nevents = 0
+  stages = None
+  bank_hash = None
+  for fname in sorted(glob.glob(pattern)):
+    with np.load(fname) as data:
+      roads = data['roads'].astype(np.int64)
+      masks = data['masks'].astype(np.uint64)
+      road_fields = list(data['road_fields'])
+      stages = list(data['stages'])
+      if bank_hash is None:
+        bank_hash = str(data['bank_hash'])
+      elif bank_hash != str(data['bank_hash']):
+        raise RuntimeError('Inconsistent pattern bank in: {0}'.format(fname))
+      n = len(data['events'])
+    roads[:, road_fields.index('event_id')] += nevents
+    nevents += n
+    roads_list.append(roads)
+    masks_list.append(masks)
+  if not roads_list:
+    raise RuntimeError('Cannot find input files: {0}'.format(pattern))
+  roads = np.concatenate(roads_list)
+  roads = {k: roads[:, i] for i, k in enumerate(road_fields)}
+  masks = np.concatenate(masks_list)
+  print('[INFO] Loaded {0} roads, {1} events from {2}'.format(len(masks), nevents, pattern))
+  return roads, masks, nevents, stages, bank_hash
+
+def get_windows(bank_x_array):
+  # Windows (lo, hi) of shape (npt, nzones, nlayers), clipped as in PatternRecognition
+  lo = np.maximum(bank_x_array[..., 0], -PATTERN_X_CENTRAL)
+  hi = np.minimum(bank_x_array[..., 2], PATTERN_X_CENTRAL)
+  return lo, hi
+
+def get_window_masks(lo, hi):
+  # Offset bit masks of the windows, empty if lo > hi
+  offsets = np.arange(-PATTERN_X_CENTRAL, PATTERN_X_CENTRAL+1)
+  inside = (lo[..., np.newaxis] <= offsets) & (offsets <= hi[..., np.newaxis])
+  bits = np.left_shift(np.uint64(1), np.arange(noffsets, dtype=np.uint64))
+  return np.where(inside, bits, np.uint64(0)).sum(axis=-1, dtype=np.uint64)
+
+def fill_offsets(roads, masks, sel, shape):
+  # Histogram of the hit offsets per cell, shape (npt, nzones, nlayers, noffsets)
+  hist = np.zeros(shape + (nlayers, noffsets), dtype=np.int64)
+  index = np.nonzero(sel)[0]
+  bits = np.arange(noffsets, dtype=np.uint64)
+  for begin in range(0, len(index), chunk_size):
+    ind = index[begin:begin+chunk_size]
+    unpacked = (masks[ind, :, np.newaxis] >> bits) & np.uint64(1)  # (n, nlayers, noffsets)
+    for ipt in range(shape[0]):
+      for zone in range(shape[1]):
+        s = (roads['ipt'][ind] == ipt) & (roads['zone'][ind] == zone)
+        if s.any():
+          hist[ipt, zone] += unpacked[s].sum(axis=0).astype(np.int64)
+  return hist
+
+def pass_requirement(roads, masks, window_masks):
+  # Proxy of the road requirement in PatternRecognition (see above)
+  layer_ok = (masks & window_masks[roads['ipt'], roads['zone']]) != 0  # (n, nlayers)
+  stations = find_emtf_layer_inverse.lut[:, 1]
+  is_csc = np.isin(find_emtf_layer_inverse.lut[:, 0], (1, 4))  # CSC or ME0
+  layer_mode = np.left_shift(1, 4 - stations)
+  mode = np.bitwise_or.reduce(np.where(layer_ok, layer_mode, 0), axis=1)
+  mode_csc = np.bitwise_or.reduce(np.where(layer_ok & is_csc, layer_mode, 0), axis=1)
+  singlemu = np.isin(mode, (11,13,14,15)) & np.isin(mode_csc, (3,5,6,9,7,10,12,11,13,14,15))
+  zone = roads['zone']
+  result = singlemu
+  result |= np.isin(zone, (0,1)) & layer_ok[:, 11] & layer_ok[:, 0]  # ME0 and ME1/1
+  result |= (zone == 6) & (layer_ok.sum(axis=1) >= 2)
+  return result
+
+def find_smallest_window(counts, lo, hi):
+  # Smallest range [a, b] within [lo, hi] with a fraction 'coverage' of the counts
+  # counts is indexed by offset + PATTERN_X_CENTRAL
+  cumsum = np.concatenate(([0], np.cumsum(counts)))
+  target = coverage * counts.sum()
+  best = (lo, hi)
+  for a in range(lo, hi+1):
+    for b in range(a, hi+1):
+      if cumsum[b+PATTERN_X_CENTRAL+1] - cumsum[a+PATTERN_X_CENTRAL] >= target:
+        if (b - a) < (best[1] - best[0]):
+          best = (a, b)
+        break
+  return best
+
+def propose_windows(track_hist, lo, hi, ntracks):
+  new_lo, new_hi = lo.copy(), hi.copy()
+  disabled = np.zeros(lo.shape, dtype=np.bool)
+  for ipt, zone, lay in np.ndindex(lo.shape):
+    if lo[ipt, zone, lay] > hi[ipt, zone, lay]:
+      continue  # already empty
+    if ntracks[ipt, zone] < min_tracks:
+      continue  # not enough statistics
+    counts = track_hist[ipt, zone, lay]
+    if counts.sum() == 0:
+      new_lo[ipt, zone, lay], new_hi[ipt, zone, lay] = 1, 0
+      disabled[ipt, zone, lay] = True
+    else:
+      new_lo[ipt, zone, lay], new_hi[ipt, zone, lay] = find_smallest_window(counts, lo[ipt, zone, lay], hi[ipt, zone, lay])
+  return new_lo, new_hi, disabled
+
+def write_bank(bankfile, outfile, lo, hi, new_lo, new_hi):
+  with np.load(bankfile) as data:
+    arrays = {k: data[k] for k in data.files}
+  patterns_phi = arrays['patterns_phi'].copy()
+  changed = (new_lo != lo) | (new_hi != hi)
+  patterns_phi[..., 0] = np.where(changed, new_lo, patterns_phi[..., 0])
+  patterns_phi[..., 2] = np.where(changed, new_hi, patterns_phi[..., 2])
+  arrays['patterns_phi'] = patterns_phi.astype(np.int32)
+  np.savez_compressed(outfile, **arrays)
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print(__doc__)
+    sys.exit(1)
+  bankfile = sys.argv[1]
+  rates_pattern = sys.argv[2] if len(sys.argv) > 2 else 'histos_tbg_rates*.npz'
+  effie_pattern = sys.argv[3] if len(sys.argv) > 3 else 'histos_tbg_effie*.npz'
+  outfile = sys.argv[4] if len(sys.argv) > 4 else bankfile.replace('.npz', '_pruned.npz')
+
+  with np.load(bankfile) as data:
+    bank_x_array = data['patterns_phi']
+  shape = bank_x_array.shape[:2]  # (npt, nzones)
+  lo, hi = get_windows(bank_x_array)
+
+  rates_roads, rates_masks, rates_nevents, stages, rates_bank_hash = load_profile(rates_pattern)
+  effie_roads, effie_masks, effie_nevents, _, effie_bank_hash = load_profile(effie_pattern)
+  if not (rates_bank_hash == effie_bank_hash == get_file_hash(bankfile)):
+    raise RuntimeError('The profiles were not produced with the pattern bank: {0}'.format(bankfile))
+  fired, kept, track = [stages.index(k) for k in ('fired', 'kept', 'track')]
+
+  # Usage per (ipt, zone)
+  print('[INFO] Usage per (ipt, zone): minbias fired/kept/tracks per event, gun tracks')
+  ntracks = np.zeros(shape, dtype=np.int64)
+  for ipt, zone in np.ndindex(shape):
+    s = (rates_roads['ipt'] == ipt) & (rates_roads['zone'] == zone)
+    n1, n2, n3 = [float((s & (rates_roads['stage'] == k)).sum()) / rates_nevents for k in (fired, kept, track)]
+    ntracks[ipt, zone] = ((effie_roads['ipt'] == ipt) & (effie_roads['zone'] == zone) & (effie_roads['stage'] == track)).sum()
+    if n1 > 0 or ntracks[ipt, zone] > 0:
+      print('  ipt {0} zone {1}: {2:9.3f} {3:8.3f} {4:8.4f} | {5:8d}'.format(ipt, zone, n1, n2, n3, ntracks[ipt, zone]))
+
+  # Windows
+  track_hist = fill_offsets(effie_roads, effie_masks, effie_roads['stage'] == track, shape)
+  new_lo, new_hi, disabled = propose_windows(track_hist, lo, hi, ntracks)
+  old_width = np.maximum(hi - lo + 1, 0).sum()
+  new_width = np.maximum(new_hi - new_lo + 1, 0).sum()
+  narrowed = ((new_hi - new_lo) < (hi - lo)) & ~disabled
+  print('[INFO] Proposed bank: {0} cells disabled, {1} cells narrowed, total width {2} -> {3}'.format(
+      disabled.sum(), narrowed.sum(), old_width, new_width))
+
+  # Projections
+  old_masks, new_masks = get_window_masks(lo, hi), get_window_masks(new_lo, new_hi)
+  for k in (fired, kept, track):
+    sel = (rates_roads['stage'] == k)
+    roads = {key: v[sel] for key, v in rates_roads.items()}
+    pass_old = pass_requirement(roads, rates_masks[sel], old_masks)
+    pass_new = pass_requirement(roads, rates_masks[sel], new_masks)
+    n_old, n_new = float(pass_old.sum()) / rates_nevents, float(pass_new.sum()) / rates_nevents
+    print('[INFO] Minbias {0:<6s} roads per event: {1:9.3f} -> {2:9.3f} ({3:+.1f}%)'.format(
+        stages[k], n_old, n_new, 100. * (n_new - n_old) / max(n_old, 1e-9)))
+
+  sel = (effie_roads['stage'] == track)
+  roads = {key: v[sel] for key, v in effie_roads.items()}
+  pass_old = pass_requirement(roads, effie_masks[sel], old_masks)
+  pass_new = pass_requirement(roads, effie_masks[sel], new_masks)
+  n_old = len(np.unique(roads['event_id'][pass_old]))
+  n_new = len(np.unique(roads['event_id'][pass_new]))
+  print('[INFO] Gun events with a track: {0} -> {1} (efficiency loss: {2:.3f}%)'.format(
+      n_old, n_new, 100. * (n_old - n_new) / max(n_old, 1)))
+
+  print('[INFO] Creating file: %s' % outfile)
+  write_bank(bankfile, outfile, lo, hi, new_lo, new_hi)
@@ -2,15 +2,24 @@ import numpy as np
 np.random.seed(2026)
 
 import os, sys
+import heapq
+import time
 from six.moves import range, zip, map, filter
 
-from rootpy.plotting import Hist, Hist2D, Graph, Efficiency
-from rootpy.tree import Tree, TreeChain, TreeModel, FloatCol, IntCol, ShortCol
-from rootpy.io import root_open
-#from rootpy.memory.keepalive import keepalive
-from ROOT import gROOT, TH1
-gROOT.SetBatch(True)
-TH1.AddDirectory(False)
+# ROOT is only needed by the analyses. Without it, the numpy parts (pattern
+# recognition, road keys, NumpyHist, accumulators, checkpoints) can still be
+# imported, e.g. by the tests, perf_scan.py and prune_pattern_bank.py.
+try:
+  from rootpy.plotting import Hist, Hist2D, Graph, Efficiency
+  from rootpy.tree import Tree, TreeChain, TreeModel, FloatCol, IntCol, ShortCol
+  from rootpy.io import root_open
+  #from rootpy.memory.keepalive import keepalive
+  from ROOT import gROOT, TH1
+  gROOT.SetBatch(True)
+  TH1.AddDirectory(False)
+  root_import_error = None
+except ImportError as e:
+  root_import_error = e
 
 import logging
 mpl_logger = logging.getLogger('matplotlib')
@@ -548,6 +557,53 @@ class PatternBank(object):
     #assert(self.y_array.shape == (len(pt_bins)-1, len(eta_bins)-1, nlayers, 3))
     assert(self.z_array.shape == (len(pt_bins)-1, len(eta_bins)-1, nlayers, 3))
 
+# Packed integer keys
+# The road key packs (endcap, sector, ipt, ieta, iphi) into bit fields, in the
+# same order as the tuple, so sorting the keys is the same as sorting the tuples.
+# iphi takes the lowest bits, so adjacent roads in iphi have consecutive keys.
+# The hit key packs (emtf_layer, emtf_phi), which is used to find shared hits.
+# The helpers work with python ints as well as numpy integer arrays.
+ROAD_KEY_IPHI_BITS = 8
+ROAD_KEY_IETA_BITS = 3
+ROAD_KEY_IPT_BITS = 4
+ROAD_KEY_SECTOR_BITS = 3
+ROAD_KEY_ENDSEC_SHIFT = ROAD_KEY_IPHI_BITS + ROAD_KEY_IETA_BITS + ROAD_KEY_IPT_BITS
+HIT_KEY_PHI_BITS = 14  # emtf_phi is signed, in [-8192, 8192)
+
+def encode_road_id(endcap, sector, ipt, ieta, iphi):
+  key = (endcap + 1) // 2  # endcap -1 -> 0, +1 -> 1
+  key = (key << ROAD_KEY_SECTOR_BITS) | sector
+  key = (key << ROAD_KEY_IPT_BITS) | ipt
+  key = (key << ROAD_KEY_IETA_BITS) | ieta
+  key = (key << ROAD_KEY_IPHI_BITS) | iphi
+  return key
+
+def decode_road_id(key):
+  iphi = key & ((1 << ROAD_KEY_IPHI_BITS) - 1)
+  key = key >> ROAD_KEY_IPHI_BITS
+  ieta = key & ((1 << ROAD_KEY_IETA_BITS) - 1)
+  key = key >> ROAD_KEY_IETA_BITS
+  ipt = key & ((1 << ROAD_KEY_IPT_BITS) - 1)
+  key = key >> ROAD_KEY_IPT_BITS
+  sector = key & ((1 << ROAD_KEY_SECTOR_BITS) - 1)
+  key = key >> ROAD_KEY_SECTOR_BITS
+  endcap = (key * 2) - 1
+  return (endcap, sector, ipt, ieta, iphi)
+
+def get_road_key_endsec(key):
+  return key >> ROAD_KEY_ENDSEC_SHIFT  # (endcap, sector) part
+
+def get_road_key_iphi(key):
+  return key & ((1 << ROAD_KEY_IPHI_BITS) - 1)
+
+def encode_hit_key(emtf_layer, emtf_phi):
+  return (emtf_layer << HIT_KEY_PHI_BITS) + emtf_phi
+
+def decode_hit_key(key):
+  emtf_phi = ((key + (1 << (HIT_KEY_PHI_BITS-1))) & ((1 << HIT_KEY_PHI_BITS) - 1)) - (1 << (HIT_KEY_PHI_BITS-1))
+  emtf_layer = (key - emtf_phi) >> HIT_KEY_PHI_BITS
+  return (emtf_layer, emtf_phi)
+
 class Hit(object):
   def __init__(self, _id, emtf_layer, emtf_phi, emtf_theta, emtf_bend,
                emtf_quality, emtf_time, old_emtf_phi, old_emtf_bend,
@@ -563,6 +619,7 @@ class Hit(object):
     self.old_emtf_bend = old_emtf_bend
     self.extra_emtf_theta = extra_emtf_theta
     self.sim_tp = sim_tp
+    self.key = encode_hit_key(emtf_layer, emtf_phi)
 
   def get_ring(self):
     return self.id[2]
@@ -580,6 +637,7 @@ ROAD_INFO_NVARS = 3
 class Road(object):
   def __init__(self, _id, hits, mode, quality, sort_code, theta_median):
     self.id = _id  # (endcap, sector, ipt, ieta, iphi)
+    self.key = encode_road_id(*_id)
     self.hits = hits
     self.mode = mode
     self.quality = quality
@@ -640,6 +698,57 @@ def roads_to_variables(roads):
     variables[i] = road.to_variables()
   return variables
 
+# Histogram with bin contents kept in a numpy array (incl. underflow and overflow)
+# The rootpy Hist is only created at write-out, with identical bin contents.
+class NumpyHist(object):
+  def __init__(self, name, title, *bins):
+    self.name = name
+    self.title = title
+    if len(bins) == 3:  # (nbins, xmin, xmax)
+      self.nbins, self.xmin, self.xmax = int(bins[0]), float(bins[1]), float(bins[2])
+      self.edges = None
+    else:  # (edges,)
+      self.edges = np.asarray(bins[0], dtype=np.float64)
+      self.nbins, self.xmin, self.xmax = len(self.edges)-1, self.edges[0], self.edges[-1]
+    self.counts = np.zeros((self.nbins+2,), dtype=np.float64)
+    self.entries = 0
+
+  def find_bin(self, x):
+    # Same as TAxis::FindFixBin(): 0 is underflow, nbins+1 is overflow
+    x = np.asarray(x, dtype=np.float64)
+    if self.edges is None:
+      binx = 1 + np.floor(self.nbins * (x - self.xmin) / (self.xmax - self.xmin))
+      binx = np.where(x < self.xmin, 0, np.where(x < self.xmax, binx, self.nbins+1))
+      return binx.astype(np.int32)
+    else:
+      return np.searchsorted(self.edges, x, side='right').astype(np.int32)
+
+  def fill(self, x):
+    self.fill_bins(self.find_bin(x))
+
+  def fill_bins(self, binx, w=None):
+    binx = np.atleast_1d(binx)
+    if w is None:
+      np.add.at(self.counts, binx, 1.)
+    else:
+      np.add.at(self.counts, binx, w)
+    self.entries += binx.size
+
+  def add(self, other):
+    assert(self.counts.shape == other.counts.shape)
+    self.counts += other.counts
+    self.entries += other.entries
+
+  def to_hist(self):
+    if self.edges is None:
+      h = Hist(self.nbins, self.xmin, self.xmax, name=self.name, title=self.title, type='F')
+    else:
+      h = Hist(list(self.edges), name=self.name, title=self.title, type='F')
+    for b in xrange(self.nbins+2):
+      h.SetBinContent(b, self.counts[b])
+    h.SetEntries(self.entries)
+    return h
+
 
 # ______________________________________________________________________________
 # Modules
@@ -650,11 +759,18 @@ PATTERN_X_SEARCH_MAX = 154-10
 
 # Pattern recognition module
 class PatternRecognition(object):
-  def __init__(self, bank, omtf_input=False, run2_input=False):
+  def __init__(self, bank, omtf_input=False, run2_input=False, bitmap=False, max_roads=None):
     self.bank = bank
     self.cache = dict()  # cache for pattern results
+    self.cache_keys = dict()  # cache for pattern results, as packed road keys
+    self.cache_windows = dict()  # cache for pattern windows, used by the bitmap engine
     self.omtf_input = omtf_input
     self.run2_input = run2_input
+    self.bitmap = bitmap  # use the bitmap-dilation engine (same roads, firmware-style)
+    self.max_roads = max_roads  # road budget per (sector, zone), None for no limit
+    self.n_zones = 0  # number of (sector, zone) with roads
+    self.n_zones_truncated = 0  # number of (sector, zone) with more roads than the budget
+    self.n_roads_dropped = 0  # number of roads removed by the budget
 
   def _create_road_hit(self, hit):
     hit_id = (hit.type, hit.station, hit.ring, hit.endsec, hit.fr, hit.bx)
@@ -683,8 +799,23 @@ class PatternRecognition(object):
     self.cache[(zone, hit_lay)] = result
     return result
 
+  def _apply_patterns_in_zone_keys(self, zone, hit_lay):
+    result = self.cache_keys.get((zone, hit_lay), None)
+    if result is not None:
+      return result
+
+    # Convert (ipt, iphi) into road key offsets (without endcap, sector) and iphi offsets
+    index = self._apply_patterns_in_zone(zone, hit_lay)
+    ipt, iphi = index[:, 0], index[:, 1]
+    key_offsets = encode_road_id(-1, 0, ipt.astype(np.int64), zone, 0)
+    iphi_offsets = PATTERN_X_CENTRAL - iphi.astype(np.int64)
+    result = (key_offsets, iphi_offsets)
+    self.cache_keys[(zone, hit_lay)] = result
+    return result
+
   def _apply_patterns(self, endcap, sector, sector_hits):
-    amap = {}  # road_id -> road_hits
+    amap = {}  # road_key -> road_hits
+    sector_key = encode_road_id(endcap, sector, 0, 0, 0)
 
     # Loop over hits
     for ihit, hit in enumerate(sector_hits):
@@ -704,24 +835,152 @@ class PatternRecognition(object):
           if zone == 6:  # ignore zone 6
             continue
 
-        result = self._apply_patterns_in_zone(zone, hit_lay)
+        key_offsets, iphi_offsets = self._apply_patterns_in_zone_keys(zone, hit_lay)
+        iphis = hit_x + iphi_offsets  # iphi 0 starts at -23
+
+        # Full range is 0 <= iphi <= 154. but a reduced range is sufficient (27% saving on patterns)
+        sel = (PATTERN_X_SEARCH_MIN <= iphis) & (iphis <= PATTERN_X_SEARCH_MAX)
+        if not sel.any():
+          continue
+
+        # Create and associate 'myhit' to road keys
+        if myhit is None:
+          myhit = self._create_road_hit(hit)
+        road_keys = (sector_key + key_offsets[sel] + iphis[sel]).tolist()
+        for road_key in road_keys:
+          amap.setdefault(road_key, []).append(myhit)  # append hit to road
+
+    # Create roads
+    roads = self._create_roads(amap)
+    return roads
+
+  def _get_windows_in_zone(self, zone, hit_lay):
+    result = self.cache_windows.get((zone, hit_lay), None)
+    if result is not None:
+      return result
+
+    # Retrieve the window (lo, hi) of each ipt, such that a hit at pattern x
+    # belongs to the road at iphi if lo <= (x - iphi) <= hi. The window is
+    # clipped to the pattern range, same as in _apply_patterns_in_zone().
+    # An empty window is set to None.
+    result = []
+    for ipt in xrange(self.bank.x_array.shape[0]):
+      lo = max(self.bank.x_array[ipt, zone, hit_lay, 0], -PATTERN_X_CENTRAL)
+      hi = min(self.bank.x_array[ipt, zone, hit_lay, 2], PATTERN_X_CENTRAL)
+      result.append((int(lo), int(hi)) if lo <= hi else None)
+    self.cache_windows[(zone, hit_lay)] = result
+    return result
+
+  def _apply_patterns_bitmap(self, endcap, sector, sector_hits):
+    # Firmware-style pattern matching. The hits are converted into occupancy
+    # bit rows per (zone, layer), with bit x set if there is a hit at pattern
+    # x (quadstrip column). Each row is dilated by the pattern window with
+    # shift-and-OR, then the roads with hits in at least 2 layers are kept.
+    # Roads with a single layer can never pass the SingleMu requirement, so
+    # this gives the same roads as _apply_patterns().
+    amap = {}  # road_key -> road_hits
+    sector_key = encode_road_id(endcap, sector, 0, 0, 0)
+    search_mask = ((1 << (PATTERN_X_SEARCH_MAX+1)) - 1) ^ ((1 << PATTERN_X_SEARCH_MIN) - 1)
+
+    occupancy = {}  # (zone, hit_lay) -> bit row
+    zone_hits = {}  # (zone, hit_lay) -> [(ihit, hit_x, hit)]
+
+    # Loop over hits
+    for ihit, hit in enumerate(sector_hits):
+      hit_x = int(find_pattern_x(hit.emtf_phi))
+      if hit_x < 0:  # too far from the search range to be used
+        continue
+
+      for zone in hit.zones:
+        if self.omtf_input:
+          if zone != 6:  # only zone 6
+            continue
+        else:
+          if zone == 6:  # ignore zone 6
+            continue
+
+        k = (zone, hit.lay)
+        occupancy[k] = occupancy.get(k, 0) | (1 << hit_x)
+        zone_hits.setdefault(k, []).append((ihit, hit_x, hit))
 
-        for index in result:
-          ipt, iphi = index
-          iphi = hit_x - (iphi - PATTERN_X_CENTRAL)  # iphi 0 starts at -23
-          ieta = zone
+    myhits = {}  # ihit -> myhit, shared by the roads
 
-          # Full range is 0 <= iphi <= 154. but a reduced range is sufficient (27% saving on patterns)
-          if PATTERN_X_SEARCH_MIN <= iphi <= PATTERN_X_SEARCH_MAX:
-            # Create and associate 'myhit' to road ids
+    # Loop over zones and patterns
+    for zone in sorted(set(k[0] for k in occupancy)):
+      layers = [lay for lay in xrange(nlayers) if (zone, lay) in occupancy]
+      windows = [self._get_windows_in_zone(zone, lay) for lay in layers]
+
+      for ipt in xrange(self.bank.x_array.shape[0]):
+        # Dilate the rows, and find the roads with at least 2 layers
+        dilated = []
+        ones = twos = 0
+        for lay, lay_windows in zip(layers, windows):
+          window = lay_windows[ipt]
+          if window is None:
+            continue
+          row = occupancy[(zone, lay)]
+          dilated_row = 0
+          for d in xrange(window[0], window[1]+1):
+            dilated_row |= (row >> d) if d >= 0 else (row << -d)
+          twos |= (ones & dilated_row)
+          ones |= dilated_row
+          dilated.append((lay, window, dilated_row))
+        twos &= search_mask
+
+        # Loop over the roads
+        road_key_base = sector_key + encode_road_id(-1, 0, ipt, zone, 0)
+        while twos:
+          lowest = twos & -twos
+          twos ^= lowest
+          iphi = lowest.bit_length() - 1
+
+          road_hits = []
+          for lay, window, dilated_row in dilated:
+            if dilated_row & lowest:
+              for ihit, hit_x, hit in zone_hits[(zone, lay)]:
+                if window[0] <= (hit_x - iphi) <= window[1]:
+                  road_hits.append((ihit, hit))
+          road_hits.sort(key=lambda x: x[0])  # same hit order as _apply_patterns()
+
+          for i, (ihit, hit) in enumerate(road_hits):
+            myhit = myhits.get(ihit, None)
             if myhit is None:
               myhit = self._create_road_hit(hit)
-            road_id = (endcap, sector, ipt, ieta, iphi)
-            amap.setdefault(road_id, []).append(myhit)  # append hit to road
+              myhits[ihit] = myhit
+            road_hits[i] = myhit
+          amap[road_key_base + iphi] = road_hits
 
     # Create roads
+    roads = self._create_roads(amap)
+    return roads
+
+  def _apply_road_budget(self, sector_roads):
+    # Keep the top-K roads by sort code in each zone. Ties are broken by the
+    # road key (lowest first), so that the result does not depend on the order.
+    zone_roads = {}
+    for road in sector_roads:
+      zone_roads.setdefault(road.id[3], []).append(road)
+
     roads = []
-    for road_id, road_hits in amap.iteritems():
+    for zone, tmp_roads in zone_roads.iteritems():
+      self.n_zones += 1
+      if len(tmp_roads) > self.max_roads:
+        self.n_zones_truncated += 1
+        self.n_roads_dropped += len(tmp_roads) - self.max_roads
+        tmp_roads = heapq.nlargest(self.max_roads, tmp_roads, key=lambda road: (road.sort_code, -road.key))
+      roads += tmp_roads
+    return roads
+
+  def print_road_budget(self):
+    if self.max_roads is None:
+      return
+    print('[INFO] Road budget: {0} per (sector, zone), truncated in {1} out of {2} (sector, zone), {3} roads dropped'.format(
+        self.max_roads, self.n_zones_truncated, self.n_zones, self.n_roads_dropped))
+
+  def _create_roads(self, amap):
+    roads = []
+    for road_key, road_hits in amap.iteritems():
+      road_id = decode_road_id(road_key)
       (endcap, sector, ipt, ieta, iphi) = road_id
       road_mode = 0
       road_mode_csc = 0
@@ -801,7 +1060,7 @@ class PatternRecognition(object):
 
         myroad = Road(road_id, tmp_road_hits, road_mode, road_quality, road_sort_code, tmp_theta)
         roads.append(myroad)
-      continue  # end loop over map of road_id -> road_hits
+      continue  # end loop over map of road_key -> road_hits
     return roads
 
   def run(self, hits):
@@ -856,7 +1115,14 @@ class PatternRecognition(object):
           hit.zones = find_emtf_zones(hit)
 
         # Apply patterns to the sector hits
-        sector_roads = self._apply_patterns(endcap, sector, sector_hits)
+        if self.bitmap:
+          sector_roads = self._apply_patterns_bitmap(endcap, sector, sector_hits)
+        else:
+          sector_roads = self._apply_patterns(endcap, sector, sector_hits)
+
+        # Apply the road budget
+        if self.max_roads is not None:
+          sector_roads = self._apply_road_budget(sector_roads)
         roads += sector_roads
     return roads
 
@@ -879,31 +1145,13 @@ class RoadCleaning(object):
       raise StopIteration
 
   def _groupby(self, data):
-    def is_adjacent(prev, curr, length):
-      # adjacent if (x,y,z) == (x,y,z+length)
-      return prev[:-1] == curr[:-1] and (prev[-1] + length) == curr[-1]
-
+    # adjacent if (x,y,z) == (x,y,z+1). With packed road keys, this means that
+    # the sorted keys differ by 1 (iphi never reaches the top of its bit field).
     if data:
-      data.sort()
-      myiter = iter(data)
-      prev = curr = next(myiter)
-      # Iterate over data
-      while True:
-        group = []
-        stop = False
-        # Iterate until the next value is different
-        while is_adjacent(prev, curr, len(group)):
-          try:
-            group.append(curr)
-            curr = next(myiter)
-          except StopIteration:
-            stop = True
-            break
-        # Output group
-        yield group
-        prev = curr
-        if stop:
-          return
+      data = np.sort(np.asarray(data, dtype=np.int64))
+      splits = np.nonzero(np.diff(data) != 1)[0] + 1
+      for group in np.split(data, splits):
+        yield group.tolist()
 
   def _sortby(self, clean_roads, groupinfo):
     def select_bx_zero(road):
@@ -930,37 +1178,40 @@ class RoadCleaning(object):
       # Sort by 'sort code'
       clean_roads.sort(key=lambda road: road.sort_code, reverse=True)
 
+      # Hit keys of ME1/1, ME1/2, ME0, MB1, MB2
+      shared_hits = [set(hit.key for hit in road.hits if hit.emtf_layer in (0,1,11,12,13)) for road in clean_roads]
+
       # Iterate over clean_roads
       for i, road in enumerate(clean_roads):
         keep = True
-        gi = groupinfo[road.id]
+        gi = groupinfo[road.key]
+        endsec_i = get_road_key_endsec(road.key)
 
         # No intersect between two ranges (x1, x2), (y1, y2): (x2 < y1) || (x1 > y2)
         # Intersect: !((x2 < y1) || (x1 > y2)) = (x2 >= y1) and (x1 <= y2)
         for j, road_to_check in enumerate(clean_roads[:i]):
-          gj = groupinfo[road_to_check.id]
-          _get_endsec = lambda x: x[:2]
+          gj = groupinfo[road_to_check.key]
           # Allow +/-2 due to extrapolation-to-EMTF error
-          if (_get_endsec(road.id) == _get_endsec(road_to_check.id)) and (gi[1]+2 >= gj[0]) and (gi[0]-2 <= gj[1]):
+          if (endsec_i == get_road_key_endsec(road_to_check.key)) and (gi[1]+2 >= gj[0]) and (gi[0]-2 <= gj[1]):
             keep = False
             break
 
         if keep:
           # Do not share ME1/1, ME1/2, ME0, MB1, MB2
-          for j, road_to_check in enumerate(clean_roads[:i]):
-            hits_i = [(hit.emtf_layer, hit.emtf_phi) for hit in road.hits if hit.emtf_layer in (0,1,11,12,13)]
-            hits_j = [(hit.emtf_layer, hit.emtf_phi) for hit in road_to_check.hits if hit.emtf_layer in (0,1,11,12,13)]
-            if set(hits_i).intersection(hits_j):
-              keep = False
-              break
+          hits_i = shared_hits[i]
+          if hits_i:
+            for j in xrange(i):
+              if not hits_i.isdisjoint(shared_hits[j]):
+                keep = False
+                break
 
         if keep:
           yield road
       return
 
   def run(self, roads):
-    # road_id = (endcap, sector, ipt, ieta, iphi)
-    amap = {road.id : road for road in roads}
+    # road_key = packed (endcap, sector, ipt, ieta, iphi)
+    amap = {road.key : road for road in roads}
 
     # pick median in each iphi group
     clean_roads = []
@@ -971,8 +1222,8 @@ class RoadCleaning(object):
 
       # Loop over roads in road clusters, starting from middle
       for index in self._iter_from_middle(xrange(len(group))):
-        road_id = group[index]
-        road = amap[road_id]
+        road_key = group[index]
+        road = amap[road_key]
         keep = True
         if (0 <= index-1) and road.sort_code < amap[group[index-1]].sort_code:
           keep = False
@@ -981,9 +1232,8 @@ class RoadCleaning(object):
         if keep:
           break
 
-      _get_iphi = lambda x: x[4]
-      g = (_get_iphi(group[0]), _get_iphi(group[-1]))  # first and last road_id's in the iphi group
-      groupinfo[road_id] = g
+      g = (get_road_key_iphi(group[0]), get_road_key_iphi(group[-1]))  # first and last road keys in the iphi group
+      groupinfo[road_key] = g
       clean_roads.append(road)
 
     # sort the roads + kill the siblings
@@ -1079,6 +1329,16 @@ class RoadSlimming(object):
 
 
 # pT assignment module
+# Settings of the inference backend that change the predictions
+def get_inference_settings(inference):
+  if inference == 'sparse':
+    import nn_sparse
+    return 'sparse,min_sparsity=%s' % nn_sparse.min_sparsity
+  elif inference == 'fixed':
+    import nn_fixed
+    return 'fixed,precision=%s,table_size=%s' % (nn_fixed.default_precision, nn_fixed.table_size)
+  return inference
+
 class PtAssignment(object):
   def __init__(self, kerasfile, omtf_input=False, run2_input=False):
     (model_file, model_weights_file, model_omtf_file, model_omtf_weights_file) = kerasfile
@@ -1092,13 +1352,21 @@ class PtAssignment(object):
     from nn_encode_omtf import Encoder as EncoderOmtf
 
     # Load Keras models
-    from nn_models import load_my_model, update_keras_custom_objects
-    update_keras_custom_objects()
+    if inference == 'sparse':
+      from nn_sparse import load_sparse_model as load_model
+    elif inference == 'fixed':
+      from nn_fixed import load_fixed_point_model as load_model
+    else:
+      from nn_models import load_my_model, update_keras_custom_objects
+      update_keras_custom_objects()
+      def load_model(name, weights_name):
+        loaded_model = load_my_model(name=name, weights_name=weights_name)
+        loaded_model.trainable = False
+        assert not loaded_model.updates
+        return loaded_model
 
     # First model (EMTF mode)
-    self.loaded_model = load_my_model(name=model_file, weights_name=model_weights_file)
-    self.loaded_model.trainable = False
-    assert not self.loaded_model.updates
+    self.loaded_model = load_model(name=model_file, weights_name=model_weights_file)
 
     def create_encoder(x):
       nentries = x.shape[0]
@@ -1108,9 +1376,7 @@ class PtAssignment(object):
     self.create_encoder = create_encoder
 
     # Second model (OMTF mode)
-    self.loaded_model_omtf = load_my_model(name=model_omtf_file, weights_name=model_omtf_weights_file)
-    self.loaded_model_omtf.trainable = False
-    assert not self.loaded_model_omtf.updates
+    self.loaded_model_omtf = load_model(name=model_omtf_file, weights_name=model_omtf_weights_file)
 
     def create_encoder_omtf(x):
       nentries = x.shape[0]
@@ -1230,64 +1496,60 @@ class TrackProducer(object):
       trigger = (y_discr < 0.)  # False
     return trigger
 
-  def run(self, slim_roads, variables, predictions, x_mask_vars, x_road_vars):
-
-    # __________________________________________________________________________
-    # Extra pieces
-
-    def get_ndof_from_x_mask(x_mask):
-      assert(x_mask.shape[0] == nlayers)
-      assert(x_mask.dtype == np.bool)
-      valid = ~x_mask
-      return valid.sum()
-
-    def get_modes_from_x_mask(x_mask):
-      assert(x_mask.shape[0] == nlayers)
-      assert(x_mask.dtype == np.bool)
-      valid = ~x_mask
-      mode = np.int32(0)
-      if np.any((valid[0], valid[1], valid[5], valid[9], valid[11])):   # ME1/1, ME1/2, RE1/2, GE1/1, ME0
-        mode |= (1<<3)
-      if np.any((valid[2], valid[6], valid[10])):  # ME2, RE2, GE2/1
-        mode |= (1<<2)
-      if np.any((valid[3], valid[7])):  # ME3, RE3
-        mode |= (1<<1)
-      if np.any((valid[4], valid[8])):  # ME4, RE4
-        mode |= (1<<0)
-
-      mode_me0 = np.int32(0)
-      if valid[11]: # ME0
-        mode_me0 |= (1 << 1)
-      if valid[0]:  # ME1/1
-        mode_me0 |= (1 << 0)
-
-      mode_mb1 = np.int32(0)
-      if valid[12]: # MB1
-        mode_mb1 |= (1 << 1)
-      if np.any((valid[1], valid[2], valid[3], valid[5], valid[6], valid[7], valid[13], valid[14])):
-        mode_mb1 |= (1 << 0)
-
-      mode_mb2 = np.int32(0)
-      if valid[13]: # MB2
-        mode_mb2 |= (1 << 1)
-      if np.any((valid[1], valid[2], valid[3], valid[5], valid[6], valid[7], valid[14])):
-        mode_mb2 |= (1 << 0)
-
-      mode_me13 = np.int32(0)
-      if np.any((valid[1], valid[5])):  # ME1/2+3, RE1/2+3
-        mode_me13 |= (1 << 1)
-      if np.any((valid[2], valid[3], valid[6], valid[7])):
-        mode_me13 |= (1 << 0)
-
-      #mode_me22 = np.int32(0)
-      #if np.any((valid[2], valid[6])):  # ME2/2, RE2/2+3
-      #  mode_me22 |= (1 << 1)
-      #if np.any((valid[3], valid[7])):
-      #  mode_me22 |= (1 << 0)
-
-      mode_omtf = np.max((mode_mb1, mode_mb2, mode_me13))
-      return (mode, mode_me0, mode_omtf)
+  def get_ndof_from_x_mask(self, x_mask):
+    assert(x_mask.shape[0] == nlayers)
+    assert(x_mask.dtype == np.bool)
+    valid = ~x_mask
+    return valid.sum()
+
+  def get_modes_from_x_mask(self, x_mask):
+    assert(x_mask.shape[0] == nlayers)
+    assert(x_mask.dtype == np.bool)
+    valid = ~x_mask
+    mode = np.int32(0)
+    if np.any((valid[0], valid[1], valid[5], valid[9], valid[11])):   # ME1/1, ME1/2, RE1/2, GE1/1, ME0
+      mode |= (1<<3)
+    if np.any((valid[2], valid[6], valid[10])):  # ME2, RE2, GE2/1
+      mode |= (1<<2)
+    if np.any((valid[3], valid[7])):  # ME3, RE3
+      mode |= (1<<1)
+    if np.any((valid[4], valid[8])):  # ME4, RE4
+      mode |= (1<<0)
+
+    mode_me0 = np.int32(0)
+    if valid[11]: # ME0
+      mode_me0 |= (1 << 1)
+    if valid[0]:  # ME1/1
+      mode_me0 |= (1 << 0)
+
+    mode_mb1 = np.int32(0)
+    if valid[12]: # MB1
+      mode_mb1 |= (1 << 1)
+    if np.any((valid[1], valid[2], valid[3], valid[5], valid[6], valid[7], valid[13], valid[14])):
+      mode_mb1 |= (1 << 0)
+
+    mode_mb2 = np.int32(0)
+    if valid[13]: # MB2
+      mode_mb2 |= (1 << 1)
+    if np.any((valid[1], valid[2], valid[3], valid[5], valid[6], valid[7], valid[14])):
+      mode_mb2 |= (1 << 0)
+
+    mode_me13 = np.int32(0)
+    if np.any((valid[1], valid[5])):  # ME1/2+3, RE1/2+3
+      mode_me13 |= (1 << 1)
+    if np.any((valid[2], valid[3], valid[6], valid[7])):
+      mode_me13 |= (1 << 0)
+
+    #mode_me22 = np.int32(0)
+    #if np.any((valid[2], valid[6])):  # ME2/2, RE2/2+3
+    #  mode_me22 |= (1 << 1)
+    #if np.any((valid[3], valid[7])):
+    #  mode_me22 |= (1 << 0)
+
+    mode_omtf = np.max((mode_mb1, mode_mb2, mode_me13))
+    return (mode, mode_me0, mode_omtf)
 
+  def run(self, slim_roads, variables, predictions, x_mask_vars, x_road_vars):
     # __________________________________________________________________________
     assert(len(slim_roads) == len(variables))
     assert(len(slim_roads) == len(predictions))
@@ -1304,8 +1566,8 @@ class TrackProducer(object):
 
       y_meas = np.asscalar(y[0,0])
       y_discr = np.asscalar(y[0,1])
-      ndof = get_ndof_from_x_mask(x_mask)
-      modes = get_modes_from_x_mask(x_mask)
+      ndof = self.get_ndof_from_x_mask(x_mask)
+      modes = self.get_modes_from_x_mask(x_mask)
       strg, zone, theta_median = x_road
 
       passed = self.pass_trigger(ndof, modes, strg, zone, theta_median, y_meas, y_discr)
@@ -1333,23 +1595,258 @@ class GhostBusting(object):
     # zone is reordered such that zone 6 has the lowest priority.
     tracks.sort(key=lambda track: ((track.zone+1) % 7, track.chi2), reverse=True)
 
+    # Hit keys of ME1/1, ME1/2, ME0, MB1, MB2
+    shared_hits = [set(hit.key for hit in track.hits if hit.emtf_layer in (0,1,11,12,13)) for track in tracks]
+
     # Iterate over tracks and remove duplicates (ghosts)
     for i, track in enumerate(tracks):
       keep = True
 
       # Do not share ME1/1, ME1/2, ME0, MB1, MB2
-      for j, track_to_check in enumerate(tracks[:i]):
-        hits_i = [(hit.emtf_layer, hit.emtf_phi) for hit in track.hits if hit.emtf_layer in (0,1,11,12,13)]
-        hits_j = [(hit.emtf_layer, hit.emtf_phi) for hit in track_to_check.hits if hit.emtf_layer in (0,1,11,12,13)]
-        if set(hits_i).intersection(hits_j):
-          keep = False
-          break
+      hits_i = shared_hits[i]
+      if hits_i:
+        for j in xrange(i):
+          if not hits_i.isdisjoint(shared_hits[j]):
+            keep = False
+            break
 
       if keep:
         tracks_after_gb.append(track)
     return tracks_after_gb
 
 
+# ______________________________________________________________________________
+# Stage-output cache
+
+# Decide EMTF hit (type, station) from layer number (inverse of EMTFLayer)
+class EMTFLayerInverse(object):
+  def __init__(self):
+    self.lut = np.array([(1,1), (1,1), (1,2), (1,3), (1,4), (2,1), (2,2), (2,3), (2,4), (3,1), (3,2), (4,1),
+                         (0,1), (0,2), (0,3), (0,4)], dtype=np.int32)
+    assert(self.lut.shape[0] == nlayers)
+
+  def __call__(self, emtf_layer):
+    return self.lut[emtf_layer]
+
+find_emtf_layer_inverse = EMTFLayerInverse()
+
+def get_file_hash(fname, length=12):
+  import hashlib
+  h = hashlib.md5()
+  with open(fname, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()[:length]
+
+# Name of the cached dataset, pileup=None for the particle gun
+def get_cache_dataset(omtf_input, pileup=None):
+  if pileup is not None:
+    dataset = 'minbias_pu%i_%i' % (pileup, jobid)
+  elif omtf_input:
+    dataset = 'pgun_omtf_%i' % jobid
+  else:
+    dataset = 'pgun_%i' % jobid
+  if workunitsfile is not None:
+    # The job id is a work unit, not a static split
+    dataset += '_wu%s' % get_file_hash(workunitsfile)
+  return dataset
+
+# Restore road list from a numpy array (inverse of roads_to_variables)
+# road_info has shape (nroads, 6): (endcap, sector, mode, quality, sort_code, theta_median)
+def variables_to_roads(variables, road_info):
+  roads = []
+  for x, info in zip(variables, road_info):
+    (endcap, sector, mode, quality, sort_code, theta_median) = info
+    (endcap, sector, mode, quality, sort_code) = (int(endcap), int(sector), int(mode), int(quality), int(sort_code))
+    (ipt, ieta, iphi) = x[ROAD_LAYER_NVARS_P1*nlayers:].astype(np.int32)
+    road_id = (endcap, sector, ipt, ieta, iphi)
+    endsec = find_endsec(endcap, sector)
+    x_vars = x[:ROAD_LAYER_NVARS*nlayers].reshape(ROAD_LAYER_NVARS, nlayers)
+    x_mask = x[ROAD_LAYER_NVARS*nlayers:ROAD_LAYER_NVARS_P1*nlayers]
+    hits = []
+    for lay in np.nonzero(x_mask == 0.0)[0]:
+      (emtf_phi, emtf_theta, emtf_bend, emtf_quality, emtf_time,
+       ring, fr, old_emtf_phi, old_emtf_bend, extra_emtf_theta) = x_vars[:, lay].astype(np.int32)
+      (_type, station) = find_emtf_layer_inverse(lay)
+      hit_id = (_type, station, ring, endsec, fr, emtf_time)
+      myhit = Hit(hit_id, lay, emtf_phi, emtf_theta, emtf_bend,
+                  emtf_quality, emtf_time, old_emtf_phi, old_emtf_bend,
+                  extra_emtf_theta, None)  # sim_tp is not stored
+      hits.append(myhit)
+    myroad = Road(road_id, hits, mode, quality, sort_code, theta_median)
+    roads.append(myroad)
+  return roads
+
+# Simple struct used to replay the branches of a cached event
+class CachedObject(object):
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+# Persistent cache of the slim roads of each event
+# A 'roads-only' pass runs PatternRecognition, RoadCleaning and RoadSlimming
+# once and saves the slim road variables, together with the legacy tracks and
+# the gen particles. PtAssignment, TrackProducer, GhostBusting and the
+# histogram filling can then be replayed from the cache alone.
+# The cache file is keyed by the pattern bank file hash, the algorithm and the
+# road budget (max_roads) used in PatternRecognition.
+class RoadsCache(object):
+  track_fields = ('pt', 'xml_pt', 'phi', 'eta', 'q', 'mode', 'endcap', 'sector', 'bx')
+  particle_fields = ('pt', 'phi', 'eta', 'q', 'vx', 'vy', 'vz', 'bx')
+
+  def __init__(self, dataset, bankfile, algo, max_roads=None, cachedir='cache'):
+    self.dataset = dataset
+    self.algo = algo
+    self.bank_hash = get_file_hash(bankfile)
+    self.max_roads = max_roads
+    if max_roads is not None:
+      dataset += '_mr%i' % max_roads
+    self.filename = os.path.join(cachedir, 'roads_%s_%s_%s.npz' % (dataset, algo, self.bank_hash))
+    self._clear()
+
+  def _clear(self):
+    self.nmodes = 0
+    self.events = []
+    self.roads = {}  # mode -> list of (ievt, variables, road_info)
+    self.tracks = []
+    self.particles = []
+
+  def exists(self):
+    return os.path.isfile(self.filename)
+
+  def add(self, ievt, evt, slim_roads_list):
+    # slim_roads_list has one list of slim roads for each algorithm mode (EMTF, OMTF)
+    self.nmodes = max(self.nmodes, len(slim_roads_list))
+    self.events.append(ievt)
+    for mode, slim_roads in enumerate(slim_roads_list):
+      if slim_roads:
+        variables = roads_to_variables(slim_roads)
+        road_info = np.array([(road.id[0], road.id[1], road.mode, road.quality, road.sort_code, road.theta_median) for road in slim_roads], dtype=np.float32)
+        self.roads.setdefault(mode, []).append((ievt, variables, road_info))
+    for trk in evt.tracks:
+      self.tracks.append((ievt,) + tuple(getattr(trk, k) for k in self.track_fields))
+    for part in evt.particles:
+      self.particles.append((ievt,) + tuple(getattr(part, k) for k in self.particle_fields))
+
+  def save(self):
+    outdir = os.path.dirname(self.filename)
+    if outdir and not os.path.isdir(outdir):
+      os.makedirs(outdir)
+    arrays = {}
+    arrays['events'] = np.array(self.events, dtype=np.int32)
+    nmodes = self.nmodes
+    arrays['nmodes'] = np.int32(nmodes)
+    nvars = (ROAD_LAYER_NVARS_P1 * nlayers) + ROAD_INFO_NVARS
+    for mode in xrange(nmodes):
+      entries = self.roads.get(mode, [])
+      arrays['road_event_%i' % mode] = np.array([ievt for (ievt, x, info) in entries for _ in xrange(len(x))], dtype=np.int32)
+      arrays['variables_%i' % mode] = np.concatenate([x for (ievt, x, info) in entries]) if entries else np.zeros((0, nvars), dtype=np.float32)
+      arrays['road_info_%i' % mode] = np.concatenate([info for (ievt, x, info) in entries]) if entries else np.zeros((0, 6), dtype=np.float32)
+    arrays['tracks'] = np.array(self.tracks, dtype=np.float32).reshape(-1, 1+len(self.track_fields))
+    arrays['particles'] = np.array(self.particles, dtype=np.float32).reshape(-1, 1+len(self.particle_fields))
+    print('[INFO] Creating file: %s' % self.filename)
+    tmpfile = self.filename + '.tmp.npz'
+    np.savez_compressed(tmpfile, **arrays)
+    os.rename(tmpfile, self.filename)
+    self._clear()
+
+  def load(self):
+    # Yield one CachedObject per event with attributes:
+    # (ievt, tracks, particles, variables, slim_roads), the last two are lists indexed by mode
+    print('[INFO] Opening file: %s' % self.filename)
+    with np.load(self.filename) as data:
+      arrays = {k: data[k] for k in data.files}
+    events = arrays['events']
+    nmodes = int(arrays['nmodes'])
+
+    def split_by_event(evt_index, arr):
+      # evt_index is sorted, as events are added in order
+      begin = np.searchsorted(evt_index, events, side='left')
+      end = np.searchsorted(evt_index, events, side='right')
+      return [arr[b:e] for (b, e) in zip(begin, end)]
+
+    tracks = split_by_event(arrays['tracks'][:,0].astype(np.int32), arrays['tracks'][:,1:])
+    particles = split_by_event(arrays['particles'][:,0].astype(np.int32), arrays['particles'][:,1:])
+    variables = [split_by_event(arrays['road_event_%i' % mode], arrays['variables_%i' % mode]) for mode in xrange(nmodes)]
+    road_info = [split_by_event(arrays['road_event_%i' % mode], arrays['road_info_%i' % mode]) for mode in xrange(nmodes)]
+
+    for i, ievt in enumerate(events):
+      evt = CachedObject(ievt=ievt)
+      evt.tracks = [CachedObject(**dict(zip(self.track_fields, row))) for row in tracks[i]]
+      evt.particles = [CachedObject(**dict(zip(self.particle_fields, row))) for row in particles[i]]
+      evt.variables = [variables[mode][i] for mode in xrange(nmodes)]
+      evt.slim_roads = [variables_to_roads(variables[mode][i], road_info[mode][i]) for mode in xrange(nmodes)]
+      yield evt
+
+# Periodic checkpoint of the state of an event loop
+# The state (a dict of numpy arrays) is written every 'nevents' events or every
+# 'seconds' seconds, whichever comes first, together with the index of the next
+# event to process. The file is written to a temporary file, then renamed, so
+# that a job that is killed while writing leaves the previous checkpoint intact.
+# The checkpoint file is keyed by the algorithm and a hash of the configuration:
+# the pattern bank file, the keras model files, the replay flag, max_roads and
+# the inference backend with its settings.
+class Checkpoint(object):
+  def __init__(self, dataset, bankfile, algo, kerasfile=None, replay=False, max_roads=None, inference=None,
+               nevents=None, seconds=None, checkpointdir='.'):
+    import hashlib
+    self.dataset = dataset
+    self.algo = algo
+    self.bank_hash = get_file_hash(bankfile)
+    h = hashlib.md5()
+    h.update(self.bank_hash.encode())
+    for fname in (kerasfile or []):
+      h.update(get_file_hash(fname).encode())
+    h.update(('replay=%s,max_roads=%s' % (bool(replay), max_roads)).encode())
+    if inference is not None:
+      h.update(('inference=%s' % get_inference_settings(inference)).encode())
+    self.config_hash = h.hexdigest()[:12]
+    self.filename = os.path.join(checkpointdir, 'checkpoint_%s_%s_%s.npz' % (dataset, algo, self.config_hash))
+    self.nevents = nevents
+    self.seconds = seconds
+    self.enabled = (nevents is not None) or (seconds is not None)
+    self._last_ievt = 0
+    self._last_time = time.time()
+
+  def load(self):
+    # Returns (index of the next event, state), or (0, None) if there is no checkpoint
+    if not (self.enabled and os.path.isfile(self.filename)):
+      return (0, None)
+    print('[INFO] Opening file: %s' % self.filename)
+    with np.load(self.filename) as data:
+      state = {k: data[k] for k in data.files}
+    start = int(state.pop('__next_ievt__'))
+    self._last_ievt = start
+    print('[INFO] Resuming from event: %i' % start)
+    return (start, state)
+
+  def due(self, next_ievt):
+    if not self.enabled:
+      return False
+    if self.nevents is not None and (next_ievt - self._last_ievt) >= self.nevents:
+      return True
+    if self.seconds is not None and (time.time() - self._last_time) >= self.seconds:
+      return True
+    return False
+
+  def save(self, next_ievt, state):
+    outdir = os.path.dirname(self.filename)
+    if outdir and not os.path.isdir(outdir):
+      os.makedirs(outdir)
+    tmpfile = self.filename + '.tmp'
+    with open(tmpfile, 'wb') as f:
+      np.savez(f, __next_ievt__=np.int64(next_ievt), **state)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmpfile, self.filename)
+    self._last_ievt = next_ievt
+    self._last_time = time.time()
+
+  def remove(self):
+    # Called once the final output is written
+    if os.path.isfile(self.filename):
+      os.remove(self.filename)
+
+
 # ______________________________________________________________________________
 # Analysis: dummy
 
@@ -1412,7 +1909,7 @@ class RoadsAnalysis(object):
 
     # Workers
     bank = PatternBank(bankfile)
-    recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
+    recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input, bitmap=bitmap_engine)
     clean = RoadCleaning()
     slim = RoadSlimming(bank)
     out_particles = []
@@ -1530,42 +2027,156 @@ class RoadsAnalysis(object):
 # ______________________________________________________________________________
 # Analysis: rates
 
-class RatesAnalysis(object):
-  def run(self, omtf_input=False, run2_input=False, pileup=200):
-    # Book histograms
-    histograms = {}
+# Rate histogram accumulator
+# Each event's tracks are converted into small arrays once, then the highest pT
+# in each eta region and the eta occupancy for each pT threshold are computed
+# with numpy and accumulated into NumpyHist objects.
+class RatesAccumulator(object):
+  def __init__(self):
+    # (eta_min, eta_max, include_eta_max, zones)
+    self.regions = {
+      "emtf": [
+        (0.8 , 2.4 , True , None),
+        (1.24, 2.4 , True , None),
+        (0.8 , 1.24, False, None),
+        (1.24, 1.65, False, None),
+        (1.65, 2.15, False, None),
+        (2.15, 2.4 , True , None),
+      ],
+      "emtf2026": [
+        (0.8 , 2.4 , True , (0,1,2,3,4,5,6)),
+        (1.24, 2.4 , True , (0,1,2,3,4,5)),
+        (0.8 , 1.24, True , (6,)),
+        (1.24, 1.65, True , (0,1,2,3,4,5)),
+        (1.65, 2.15, True , (0,1,2,3,4,5)),
+        (2.15, 2.4 , True , (0,1,2,3,4,5)),
+      ],
+    }
+    self.region_names = ("0.8_absEtaMax2.4", "1.24_absEtaMax2.4", "0.8_absEtaMax1.24",
+                         "1.24_absEtaMax1.65", "1.65_absEtaMax2.15", "2.15_absEtaMax2.4")
+    self.pt_thresholds = np.arange(14,22+1)
+
+    self.histograms = {}
     hname = "nevents"
-    histograms[hname] = Hist(5, 0, 5, name=hname, title="; count", type='F')
+    self.histograms[hname] = NumpyHist(hname, "; count", 5, 0, 5)
     for m in ("emtf", "emtf2026"):
-      hname = "highest_%s_absEtaMin0.8_absEtaMax2.4_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
-      hname = "highest_%s_absEtaMin1.24_absEtaMax2.4_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
-      hname = "highest_%s_absEtaMin0.8_absEtaMax1.24_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
-      hname = "highest_%s_absEtaMin1.24_absEtaMax1.65_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
-      hname = "highest_%s_absEtaMin1.65_absEtaMax2.15_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
-      hname = "highest_%s_absEtaMin2.15_absEtaMax2.4_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
-
-      for l in xrange(14,22+1):
+      for r in self.region_names:
+        hname = "highest_%s_absEtaMin%s_qmin12_pt" % (m,r)
+        self.histograms[hname] = NumpyHist(hname, "; p_{T} [GeV]; entries", 100, 0., 100.)
+      for l in self.pt_thresholds:
         hname = "%s_ptmin%i_qmin12_eta" % (m,l)
-        histograms[hname] = Hist(18, 0.75, 2.55, name=hname, title="; |#eta|; entries", type='F')
+        self.histograms[hname] = NumpyHist(hname, "; |#eta|; entries", 18, 0.75, 2.55)
+
+  def hnames(self):
+    hnames = ["nevents"]
+    for m in ("emtf", "emtf2026"):
+      for r in self.region_names:
+        hnames.append("highest_%s_absEtaMin%s_qmin12_pt" % (m,r))
+      for l in self.pt_thresholds:
+        hnames.append("%s_ptmin%i_qmin12_eta" % (m,l))
+    return hnames
+
+  def _to_arrays(self, tracks, legacy):
+    # Returns (pt, |eta|, zone, ok) where ok is the track-level selection
+    pt = np.array([trk.pt for trk in tracks], dtype=np.float64)
+    abseta = np.abs(np.array([trk.eta for trk in tracks], dtype=np.float64))
+    if legacy:
+      zone = np.full(pt.shape, -1, dtype=np.int32)
+      bx = np.array([trk.bx for trk in tracks], dtype=np.int32)
+      mode = np.array([trk.mode for trk in tracks], dtype=np.int32)
+      ok = (bx == 0) & np.isin(mode, (11,13,14,15))
+    else:
+      zone = np.array([trk.zone for trk in tracks], dtype=np.int32)
+      ok = np.ones(pt.shape, dtype=np.bool)
+    return (pt, abseta, zone, ok)
+
+  def _fill(self, m, pt, abseta, zone, ok):
+    # Highest pT in each eta region
+    # mask has shape (nregions, ntracks)
+    regions = self.regions[m]
+    mask = np.empty((len(regions), len(pt)), dtype=np.bool)
+    for i, (eta_min, eta_max, include_eta_max, zones) in enumerate(regions):
+      mask[i] = ok & (eta_min <= abseta)
+      mask[i] &= (abseta <= eta_max) if include_eta_max else (abseta < eta_max)
+      if zones is not None:
+        mask[i] &= np.isin(zone, zones)
+    highest_pt = np.where(mask, pt[np.newaxis,:], -999999.).max(axis=1) if len(pt) else np.full((len(regions),), -999999.)
+    for r, x in zip(self.region_names, highest_pt):
+      if x > 0.:
+        self.histograms["highest_%s_absEtaMin%s_qmin12_pt" % (m,r)].fill(min(100.-1e-3, x))
+
+    # Eta occupancy for each pT threshold (each eta bin is counted at most once per event)
+    # mask has shape (nthresholds, ntracks)
+    mask = ok[np.newaxis,:] & (abseta <= 9.9)[np.newaxis,:] & (pt[np.newaxis,:] > self.pt_thresholds[:,np.newaxis].astype(np.float64))
+    for i, l in enumerate(self.pt_thresholds):
+      h = self.histograms["%s_ptmin%i_qmin12_eta" % (m,l)]
+      if mask[i].any():
+        h.fill_bins(np.unique(h.find_bin(abseta[mask[i]])))
+
+  def fill(self, old_tracks, new_tracks):
+    self.histograms["nevents"].fill(1.0)
+    self._fill("emtf", *self._to_arrays(old_tracks, legacy=True))
+    self._fill("emtf2026", *self._to_arrays(new_tracks, legacy=False))
+
+  def write(self):
+    for hname in self.hnames():
+      h = self.histograms[hname].to_hist()
+      h.Write()
+
+  def get_state(self):
+    state = {}
+    for hname in self.hnames():
+      h = self.histograms[hname]
+      state[hname + '.counts'] = h.counts
+      state[hname + '.entries'] = np.int64(h.entries)
+    return state
+
+  def set_state(self, state):
+    for hname in self.hnames():
+      h = self.histograms[hname]
+      assert(h.counts.shape == state[hname + '.counts'].shape)
+      h.counts = state[hname + '.counts'].astype(np.float64)
+      h.entries = int(state[hname + '.entries'])
+
+
+class RatesAnalysis(object):
+  def run(self, omtf_input=False, run2_input=False, pileup=200, replay=False):
+    # Book histograms
+    accumulator = RatesAccumulator()
 
     # Load tree
-    tree = load_minbias_batch(jobid, pileup=pileup)
+    if replay:
+      tree = RoadsCache(get_cache_dataset(omtf_input, pileup=pileup), bankfile, algo, max_roads=max_roads).load()
+    else:
+      tree = load_minbias_batch(jobid, pileup=pileup)
 
     # Workers
     bank = PatternBank(bankfile)
-    recog1, recog2 = PatternRecognition(bank, omtf_input=False, run2_input=run2_input), PatternRecognition(bank, omtf_input=True, run2_input=run2_input)
+    recog1, recog2 = PatternRecognition(bank, omtf_input=False, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads), PatternRecognition(bank, omtf_input=True, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads)
     clean = RoadCleaning()
     slim = RoadSlimming(bank)
     ptassig1, ptassig2 = PtAssignment(kerasfile, omtf_input=False, run2_input=run2_input), PtAssignment(kerasfile, omtf_input=True, run2_input=run2_input)
     trkprod1, trkprod2 = TrackProducer(omtf_input=False, run2_input=run2_input), TrackProducer(omtf_input=True, run2_input=run2_input)
     ghost = GhostBusting()
 
+    # Checkpoint
+    def get_state():
+      state = accumulator.get_state()
+      state['road_budget'] = np.array([(r.n_zones, r.n_zones_truncated, r.n_roads_dropped) for r in (recog1, recog2)], dtype=np.int64)
+      return state
+
+    def set_state(state):
+      accumulator.set_state(state)
+      for r, budget in zip((recog1, recog2), state['road_budget']):
+        (r.n_zones, r.n_zones_truncated, r.n_roads_dropped) = [int(x) for x in budget]
+
+    checkpoint = Checkpoint(get_cache_dataset(omtf_input, pileup=pileup) + '_rates', bankfile, algo,
+                            kerasfile=kerasfile, replay=replay, max_roads=max_roads, inference=inference,
+                            nevents=checkpoint_nevents, seconds=checkpoint_seconds)
+    start, state = checkpoint.load()
+    if state is not None:
+      set_state(state)
+
     # Event range
     n = -1
 
@@ -1574,20 +2185,30 @@ class RatesAnalysis(object):
     for ievt, evt in enumerate(tree):
       if n != -1 and ievt == n:
         break
+      if ievt < start:
+        continue
 
       # EMTF mode
-      roads = recog1.run(evt.hits)
-      clean_roads = clean.run(roads)
-      slim_roads = slim.run(clean_roads)
-      variables = roads_to_variables(slim_roads)
+      if replay:
+        roads = clean_roads = slim_roads = evt.slim_roads[0]
+        variables = evt.variables[0]
+      else:
+        roads = recog1.run(evt.hits)
+        clean_roads = clean.run(roads)
+        slim_roads = slim.run(clean_roads)
+        variables = roads_to_variables(slim_roads)
       variables, predictions, x_mask_vars, x_road_vars = ptassig1.run(variables)
       tracks = trkprod1.run(slim_roads, variables, predictions, x_mask_vars, x_road_vars)
 
       # OMTF mode
-      roads2 = recog2.run(evt.hits)
-      clean_roads2 = clean.run(roads2)
-      slim_roads2 = slim.run(clean_roads2)
-      variables2 = roads_to_variables(slim_roads2)
+      if replay:
+        roads2 = clean_roads2 = slim_roads2 = evt.slim_roads[1]
+        variables2 = evt.variables[1]
+      else:
+        roads2 = recog2.run(evt.hits)
+        clean_roads2 = clean.run(roads2)
+        slim_roads2 = slim.run(clean_roads2)
+        variables2 = roads_to_variables(slim_roads2)
       variables2, predictions2, x_mask_vars2, x_road_vars2 = ptassig2.run(variables2)
       tracks2 = trkprod2.run(slim_roads2, variables2, predictions2, x_mask_vars2, x_road_vars2)
 
@@ -1615,79 +2236,15 @@ class RatesAnalysis(object):
 
       # ________________________________________________________________________
       # Fill histograms
-      histograms["nevents"].fill(1.0)
-
-      def fill_highest_pt():
-        highest_pt = -999999.
-        for itrk, trk in enumerate(tracks):
-          if select(trk):
-            if highest_pt < trk.pt:  # using scaled pT
-              highest_pt = trk.pt
-        if highest_pt > 0.:
-          highest_pt = min(100.-1e-3, highest_pt)
-          histograms[hname].fill(highest_pt)
+      accumulator.fill(evt.tracks, emtf2026_tracks)
 
-      def fill_eta():
-        h = histograms[hname]
-        eta_bins = [False] * (h.GetNbinsX()+2)
-        for itrk, trk in enumerate(tracks):
-          if select(trk):  # using scaled pT
-            b = h.FindFixBin(abs(trk.eta))
-            eta_bins[b] = True
-        for b in xrange(len(eta_bins)):
-          if eta_bins[b]:
-            h.fill(h.GetBinCenter(b))
-
-      tracks = evt.tracks
-      select = lambda trk: trk and (0.8 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin0.8_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin1.24_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (0.8 <= abs(trk.eta) < 1.24) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin0.8_absEtaMax1.24_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) < 1.65) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin1.24_absEtaMax1.65_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.65 <= abs(trk.eta) < 2.15) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin1.65_absEtaMax2.15_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (2.15 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin2.15_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      for l in xrange(14,22+1):
-        select = lambda trk: trk and (0 <= abs(trk.eta) <= 9.9) and (trk.bx == 0) and (trk.mode in (11,13,14,15)) and (trk.pt > float(l))
-        hname = "emtf_ptmin%i_qmin12_eta" % (l)
-        fill_eta()
-
-      tracks = emtf2026_tracks
-      select = lambda trk: trk and (0.8 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5,6)
-      hname = "highest_emtf2026_absEtaMin0.8_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5)
-      hname = "highest_emtf2026_absEtaMin1.24_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (0.8 <= abs(trk.eta) <= 1.24) and trk.zone in (6,)
-      hname = "highest_emtf2026_absEtaMin0.8_absEtaMax1.24_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 1.65) and trk.zone in (0,1,2,3,4,5)
-      hname = "highest_emtf2026_absEtaMin1.24_absEtaMax1.65_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.65 <= abs(trk.eta) <= 2.15) and trk.zone in (0,1,2,3,4,5)
-      hname = "highest_emtf2026_absEtaMin1.65_absEtaMax2.15_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (2.15 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5)
-      hname = "highest_emtf2026_absEtaMin2.15_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      for l in xrange(14,22+1):
-        select = lambda trk: trk and (0 <= abs(trk.eta) <= 9.9) and (trk.pt > float(l))
-        hname = "emtf2026_ptmin%i_qmin12_eta" % (l)
-        fill_eta()
+      if checkpoint.due(ievt+1):
+        checkpoint.save(ievt+1, get_state())
 
     # End loop over events
     unload_tree()
+    recog1.print_road_budget()
+    recog2.print_road_budget()
 
     # __________________________________________________________________________
     # Save histograms
@@ -1696,65 +2253,111 @@ class RatesAnalysis(object):
       outfile = 'histos_tbb_%i.root' % jobid
     print('[INFO] Creating file: %s' % outfile)
     with root_open(outfile, 'recreate') as f:
-      hnames = []
-      hname = "nevents"
-      hnames.append("nevents")
-      for m in ("emtf", "emtf2026"):
-        hname = "highest_%s_absEtaMin0.8_absEtaMax2.4_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin1.24_absEtaMax2.4_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin0.8_absEtaMax1.24_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin1.24_absEtaMax1.65_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin1.65_absEtaMax2.15_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin2.15_absEtaMax2.4_qmin12_pt" % m
-        hnames.append(hname)
-        for l in xrange(14,22+1):
-          hname = "%s_ptmin%i_qmin12_eta" % (m,l)
-          hnames.append(hname)
-      for hname in hnames:
-        h = histograms[hname]
-        h.Write()
+      accumulator.write()
+    checkpoint.remove()
 
 
 # ______________________________________________________________________________
 # Analysis: effie
 
+# Efficiency histogram accumulator
+# For each event, the best matching track pT is computed once per algorithm.
+# The number of L1 pT thresholds passed is found with searchsorted, and the
+# counts are accumulated in a (threshold x variable-bin) cube. The numerator
+# for each threshold is obtained at write-out with a reverse cumulative sum,
+# so the per-event cost does not depend on the number of thresholds.
+class EffieAccumulator(object):
+  def __init__(self, thresholds=(0, 10, 15, 20, 30, 40, 50), eff_pt_bins=None):
+    self.thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    if eff_pt_bins is None:
+      eff_pt_bins = (0., 0.5, 1., 1.5, 2., 3., 4., 5., 6., 7., 8., 10., 12., 14., 16., 18., 20., 22., 24., 27., 30., 34., 40., 48., 60., 80., 120.)
+
+    # (name, title, bins)
+    self.variables = [
+      ("genpt", "; gen p_{T} [GeV]", (eff_pt_bins,)),
+      ("genphi", "; gen #phi {gen p_{T} > 20 GeV}", (76, -190, 190)),
+      ("geneta", "; gen |#eta| {gen p_{T} > 20 GeV}", (85, 0.8, 2.5)),
+      ("geneta_genpt30", "; gen |#eta| {gen p_{T} > 30 GeV}", (85, 0.8, 2.5)),
+    ]
+    self.binnings = {}
+    for (v, title, bins) in self.variables:
+      self.binnings[v] = NumpyHist(v, title, *bins)
+
+    # cube[m][v] has shape (nthresholds+1, nbins+2)
+    # cube[m][v][k] counts the events that pass exactly the k lowest thresholds
+    self.cube = {}
+
+  def _get_cube(self, m):
+    if m not in self.cube:
+      self.cube[m] = {}
+      for (v, title, bins) in self.variables:
+        nbins = self.binnings[v].nbins
+        self.cube[m][v] = np.zeros((len(self.thresholds)+1, nbins+2), dtype=np.float64)
+    return self.cube[m]
+
+  def _fill(self, cube, v, k, x):
+    binx = self.binnings[v].find_bin(x)
+    cube[v][k, binx] += 1.
+
+  def fill(self, m, part, best_pt, part_selected):
+    # trigger at threshold l is (best_pt > l)
+    k = np.searchsorted(self.thresholds, best_pt, side='left')
+    cube = self._get_cube(m)
+    if part_selected:
+      self._fill(cube, "genpt", k, part.pt)
+    if part.pt > 20.:
+      if part_selected:
+        self._fill(cube, "genphi", k, np.rad2deg(part.phi))
+      if part.bx == 0:
+        self._fill(cube, "geneta", k, abs(part.eta))
+    if part.pt > 30.:
+      if part.bx == 0:
+        self._fill(cube, "geneta_genpt30", k, abs(part.eta))
+
+  def to_histograms(self, m):
+    histograms = []
+    cube = self._get_cube(m)
+    # cumsum[v][k] counts the events that pass at least the k lowest thresholds
+    cumsum = {v: np.cumsum(cube[v][::-1], axis=0)[::-1] for v in cube}
+    for i, l in enumerate(self.thresholds):
+      for k in ("denom", "numer"):
+        for (v, title, bins) in self.variables:
+          hname = "%s_eff_vs_%s_l1pt%i_%s" % (m,v,l,k)
+          h = NumpyHist(hname, title, *bins)
+          if k == "denom":
+            h.counts = cumsum[v][0]
+          else:
+            h.counts = cumsum[v][i+1]
+          h.entries = int(h.counts.sum())
+          histograms.append(h.to_hist())
+    return histograms
+
+
 class EffieAnalysis(object):
-  def run(self, omtf_input=False, run2_input=False):
+  def run(self, omtf_input=False, run2_input=False, replay=False):
     # Book histograms
     histograms = {}
     eff_pt_bins = (0., 0.5, 1., 1.5, 2., 3., 4., 5., 6., 7., 8., 10., 12., 14., 16., 18., 20., 22., 24., 27., 30., 34., 40., 48., 60., 80., 120.)
 
-    for m in ("emtf", "emtf2026"):
-      for l in (0, 10, 15, 20, 30, 40, 50):
-        for k in ("denom", "numer"):
-          hname = "%s_eff_vs_genpt_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(eff_pt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
-          hname = "%s_eff_vs_genphi_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(76, -190, 190, name=hname, title="; gen #phi {gen p_{T} > 20 GeV}", type='F')
-          hname = "%s_eff_vs_geneta_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(85, 0.8, 2.5, name=hname, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
-          hname = "%s_eff_vs_geneta_genpt30_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(85, 0.8, 2.5, name=hname, title="; gen |#eta| {gen p_{T} > 30 GeV}", type='F')
+    accumulator = EffieAccumulator(thresholds=(0, 10, 15, 20, 30, 40, 50), eff_pt_bins=eff_pt_bins)
 
+    for m in ("emtf", "emtf2026"):
       hname = "%s_l1pt_vs_genpt" % m
       histograms[hname] = Hist2D(100, -0.5, 0.5, 300, -0.5, 0.5, name=hname, title="; gen q/p_{T} [1/GeV]; q/p_{T} [1/GeV]", type='F')
       hname = "%s_l1ptres_vs_genpt" % m
       histograms[hname] = Hist2D(100, -0.5, 0.5, 300, -1, 2, name=hname, title="; gen q/p_{T} [1/GeV]; #Delta(p_{T})/p_{T}", type='F')
 
     # Load tree
-    if omtf_input:
+    if replay:
+      tree = RoadsCache(get_cache_dataset(omtf_input), bankfile, algo, max_roads=max_roads).load()
+    elif omtf_input:
       tree = load_pgun_batch_omtf(jobid)
     else:
       tree = load_pgun_batch(jobid)
 
     # Workers
     bank = PatternBank(bankfile)
-    recog1, recog2 = PatternRecognition(bank, omtf_input=False, run2_input=run2_input), PatternRecognition(bank, omtf_input=True, run2_input=run2_input)
+    recog1, recog2 = PatternRecognition(bank, omtf_input=False, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads), PatternRecognition(bank, omtf_input=True, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads)
     clean = RoadCleaning()
     slim = RoadSlimming(bank)
     ptassig1, ptassig2 = PtAssignment(kerasfile, omtf_input=False, run2_input=run2_input), PtAssignment(kerasfile, omtf_input=True, run2_input=run2_input)
@@ -1777,18 +2380,26 @@ class EffieAnalysis(object):
       part.invpt = np.true_divide(part.q, part.pt)
 
       # EMTF mode
-      roads = recog1.run(evt.hits)
-      clean_roads = clean.run(roads)
-      slim_roads = slim.run(clean_roads)
-      variables = roads_to_variables(slim_roads)
+      if replay:
+        roads = clean_roads = slim_roads = evt.slim_roads[0]
+        variables = evt.variables[0]
+      else:
+        roads = recog1.run(evt.hits)
+        clean_roads = clean.run(roads)
+        slim_roads = slim.run(clean_roads)
+        variables = roads_to_variables(slim_roads)
       variables, predictions, x_mask_vars, x_road_vars = ptassig1.run(variables)
       tracks = trkprod1.run(slim_roads, variables, predictions, x_mask_vars, x_road_vars)
 
       # OMTF mode
-      roads2 = recog2.run(evt.hits)
-      clean_roads2 = clean.run(roads2)
-      slim_roads2 = slim.run(clean_roads2)
-      variables2 = roads_to_variables(slim_roads2)
+      if replay:
+        roads2 = clean_roads2 = slim_roads2 = evt.slim_roads[1]
+        variables2 = evt.variables[1]
+      else:
+        roads2 = recog2.run(evt.hits)
+        clean_roads2 = clean.run(roads2)
+        slim_roads2 = slim.run(clean_roads2)
+        variables2 = roads_to_variables(slim_roads2)
       variables2, predictions2, x_mask_vars2, x_road_vars2 = ptassig2.run(variables2)
       tracks2 = trkprod2.run(slim_roads2, variables2, predictions2, x_mask_vars2, x_road_vars2)
 
@@ -1804,89 +2415,51 @@ class EffieAnalysis(object):
 
       # ________________________________________________________________________
       # Fill histograms
-      def fill_efficiency_pt():
-        if select_part(part):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname + "_denom"]
-          numer = histograms[hname + "_numer"]
-          denom.fill(part.pt)
-          if trigger:
-            numer.fill(part.pt)
-
-      def fill_efficiency_phi():
-        if select_part(part):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname + "_denom"]
-          numer = histograms[hname + "_numer"]
-          denom.fill(np.rad2deg(part.phi))
-          if trigger:
-            numer.fill(np.rad2deg(part.phi))
-
-      def fill_efficiency_eta():
-        if (part.bx == 0):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname + "_denom"]
-          numer = histograms[hname + "_numer"]
-          denom.fill(abs(part.eta))
-          if trigger:
-            numer.fill(abs(part.eta))
+      def find_best_track_pt():
+        best_pt = -999999.
+        for itrk, trk in enumerate(tracks):
+          if select_track(trk):
+            if best_pt < trk.pt:  # using scaled pT
+              best_pt = trk.pt
+        return best_pt
 
       def fill_resolution():
         if (part.bx == 0):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
+          trigger = (best_pt > 0.)  # using scaled pT
           if trigger:
             trk = tracks[0]
             trk.invpt = np.true_divide(trk.q, trk.xml_pt)  # using unscaled pT
             histograms[hname1].fill(part.invpt, trk.invpt)
             histograms[hname2].fill(abs(part.invpt), (abs(1.0/trk.invpt) - abs(1.0/part.invpt))/abs(1.0/part.invpt))
 
-      for l in (0, 10, 15, 20, 30, 40, 50):
-        tracks = evt.tracks
+      tracks = evt.tracks
+      select_part = lambda part: (1.24 <= abs(part.eta) <= 2.4) and (part.bx == 0)
+      select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
+      best_pt = find_best_track_pt()
+      accumulator.fill("emtf", part, best_pt, select_part(part))
+      hname1 = "emtf_l1pt_vs_genpt"
+      hname2 = "emtf_l1ptres_vs_genpt"
+      fill_resolution()
+
+      tracks = emtf2026_tracks
+      if omtf_input:
+        select_part = lambda part: (0.8 <= abs(part.eta) <= 1.24) and (part.bx == 0)
+        #select_track = lambda trk: trk and (0.8 <= abs(trk.eta) <= 1.24) and trk.zone in (6,)
+        select_track = lambda trk: trk and (0.75 <= abs(trk.eta) <= 1.4) and trk.zone in (6,)
+      else:
         select_part = lambda part: (1.24 <= abs(part.eta) <= 2.4) and (part.bx == 0)
-        select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15)) and (trk.pt > float(l))
-        #
-        hname = "emtf_eff_vs_genpt_l1pt%i" % (l)
-        fill_efficiency_pt()
-        if part.pt > 20.:
-          hname = "emtf_eff_vs_genphi_l1pt%i" % (l)
-          fill_efficiency_phi()
-          hname = "emtf_eff_vs_geneta_l1pt%i" % (l)
-          fill_efficiency_eta()
-        if part.pt > 30.:
-          hname = "emtf_eff_vs_geneta_genpt30_l1pt%i" % (l)
-          fill_efficiency_eta()
-        if l == 0:
-          hname1 = "emtf_l1pt_vs_genpt"
-          hname2 = "emtf_l1ptres_vs_genpt"
-          fill_resolution()
-
-        tracks = emtf2026_tracks
-        if omtf_input:
-          select_part = lambda part: (0.8 <= abs(part.eta) <= 1.24) and (part.bx == 0)
-          #select_track = lambda trk: trk and (0.8 <= abs(trk.eta) <= 1.24) and trk.zone in (6,) and (trk.pt > float(l))
-          select_track = lambda trk: trk and (0.75 <= abs(trk.eta) <= 1.4) and trk.zone in (6,) and (trk.pt > float(l))
-        else:
-          select_part = lambda part: (1.24 <= abs(part.eta) <= 2.4) and (part.bx == 0)
-          #select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5) and (trk.pt > float(l))
-          select_track = lambda trk: trk and (1.1 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5) and (trk.pt > float(l))
-        #
-        hname = "emtf2026_eff_vs_genpt_l1pt%i" % (l)
-        fill_efficiency_pt()
-        if part.pt > 20.:
-          hname = "emtf2026_eff_vs_genphi_l1pt%i" % (l)
-          fill_efficiency_phi()
-          hname = "emtf2026_eff_vs_geneta_l1pt%i" % (l)
-          fill_efficiency_eta()
-        if part.pt > 30.:
-          hname = "emtf2026_eff_vs_geneta_genpt30_l1pt%i" % (l)
-          fill_efficiency_eta()
-        if l == 0:
-          hname1 = "emtf2026_l1pt_vs_genpt"
-          hname2 = "emtf2026_l1ptres_vs_genpt"
-          fill_resolution()
+        #select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5)
+        select_track = lambda trk: trk and (1.1 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5)
+      best_pt = find_best_track_pt()
+      accumulator.fill("emtf2026", part, best_pt, select_part(part))
+      hname1 = "emtf2026_l1pt_vs_genpt"
+      hname2 = "emtf2026_l1ptres_vs_genpt"
+      fill_resolution()
 
     # End loop over events
     unload_tree()
+    recog1.print_road_budget()
+    recog2.print_road_budget()
 
     # __________________________________________________________________________
     # Save histograms
@@ -1895,25 +2468,17 @@ class EffieAnalysis(object):
       outfile = 'histos_tbc_%i.root' % jobid
     print('[INFO] Creating file: %s' % outfile)
     with root_open(outfile, 'recreate') as f:
-      hnames = []
       for m in ("emtf", "emtf2026"):
-        for l in (0, 10, 15, 20, 30, 40, 50):
-          for k in ("denom", "numer"):
-            hname = "%s_eff_vs_genpt_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_genphi_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_geneta_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_geneta_genpt30_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
+        for h in accumulator.to_histograms(m):
+          h.Write()
+        hnames = []
         hname = "%s_l1pt_vs_genpt" % m
         hnames.append(hname)
         hname = "%s_l1ptres_vs_genpt" % m
         hnames.append(hname)
-      for hname in hnames:
-        h = histograms[hname]
-        h.Write()
+        for hname in hnames:
+          h = histograms[hname]
+          h.Write()
 
 
 # ______________________________________________________________________________
@@ -1925,13 +2490,31 @@ class MixingAnalysis(object):
 
     # Workers
     bank = PatternBank(bankfile)
-    recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
+    recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input, bitmap=bitmap_engine)
     clean = RoadCleaning()
     slim = RoadSlimming(bank)
     out_particles = []
     out_roads = []
     npassed, ntotal = 0, 0
 
+    # Checkpoint
+    # The roads are converted to variables at each checkpoint, and kept as arrays
+    out_variables = []
+    out_aux = []
+
+    def flush_roads():
+      if out_roads:
+        out_variables.append(roads_to_variables(out_roads))
+        out_aux.append(np.array(out_particles, dtype=np.float32))
+        del out_roads[:]
+        del out_particles[:]
+
+    checkpoint = Checkpoint('mixing_%i' % jobid, bankfile, algo, nevents=checkpoint_nevents, seconds=checkpoint_seconds)
+    start, state = checkpoint.load()
+    if state is not None:
+      out_variables.append(state['variables'])
+      out_aux.append(state['aux'])
+
     # Event range
     n = -1
 
@@ -1940,6 +2523,8 @@ class MixingAnalysis(object):
     for ievt, evt in enumerate(tree):
       if n != -1 and ievt == n:
         break
+      if ievt < start:
+        continue
 
       roads = recog.run(evt.hits)
       clean_roads = clean.run(roads)
@@ -1992,6 +2577,11 @@ class MixingAnalysis(object):
           for ihit, myhit in enumerate(myroad.hits):
             print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
 
+      if checkpoint.due(ievt+1):
+        flush_roads()
+        checkpoint.save(ievt+1, dict(variables=np.concatenate([roads_to_variables([])] + out_variables),
+                                     aux=np.concatenate([np.zeros((0,4), dtype=np.float32)] + out_aux)))
+
     # End loop over events
     unload_tree()
 
@@ -2003,9 +2593,246 @@ class MixingAnalysis(object):
     print('[INFO] Creating file: %s' % outfile)
     if True:
       assert(len(out_roads) == len(out_particles))
-      variables = roads_to_variables(out_roads)
-      aux = np.array(out_particles, dtype=np.float32)
+      flush_roads()
+      variables = np.concatenate(out_variables) if out_variables else roads_to_variables([])
+      aux = np.concatenate(out_aux) if out_aux else np.array([], dtype=np.float32)
       np.savez_compressed(outfile, variables=variables, aux=aux)
+    checkpoint.remove()
+
+
+# ______________________________________________________________________________
+# Analysis: cache
+
+class CacheAnalysis(object):
+  def run(self, omtf_input=False, run2_input=False, pileup=None):
+    # Load tree
+    # pileup=None for the particle gun (effie), otherwise minbias (rates)
+    if pileup is not None:
+      tree = load_minbias_batch(jobid, pileup=pileup)
+    elif omtf_input:
+      tree = load_pgun_batch_omtf(jobid)
+    else:
+      tree = load_pgun_batch(jobid)
+
+    cache = RoadsCache(get_cache_dataset(omtf_input, pileup=pileup), bankfile, algo, max_roads=max_roads)
+
+    # Workers
+    bank = PatternBank(bankfile)
+    recog1, recog2 = PatternRecognition(bank, omtf_input=False, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads), PatternRecognition(bank, omtf_input=True, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads)
+    clean = RoadCleaning()
+    slim = RoadSlimming(bank)
+
+    # Event range
+    n = -1
+
+    # __________________________________________________________________________
+    # Loop over events
+    for ievt, evt in enumerate(tree):
+      if n != -1 and ievt == n:
+        break
+
+      # EMTF mode
+      roads = recog1.run(evt.hits)
+      clean_roads = clean.run(roads)
+      slim_roads = slim.run(clean_roads)
+
+      # OMTF mode
+      roads2 = recog2.run(evt.hits)
+      clean_roads2 = clean.run(roads2)
+      slim_roads2 = slim.run(clean_roads2)
+
+      cache.add(ievt, evt, [slim_roads, slim_roads2])
+
+      if ievt < 20:
+        print("evt {0} has {1} roads, {2} clean roads, {3} roads2, {4} clean roads2".format(ievt, len(roads), len(clean_roads), len(roads2), len(clean_roads2)))
+
+    # End loop over events
+    unload_tree()
+
+    # __________________________________________________________________________
+    # Save objects
+    cache.save()
+
+
+# ______________________________________________________________________________
+# Analysis: scan
+
+# Stores the NN predictions of every slim road, so that the trigger working
+# points can be scanned offline (see perf_scan.py) without re-running the jobs.
+SCAN_ROAD_FIELDS = ('event_id', 'algo_mode', 'y_meas', 'y_discr', 'ndof', 'mode', 'mode_me0', 'mode_omtf', 'strg', 'zone', 'theta_median')
+SCAN_EVENT_FIELDS = ('event_id', 'part_pt', 'part_eta', 'part_bx')
+
+class ScanAnalysis(object):
+  def run(self, omtf_input=False, run2_input=False, pileup=None, replay=False):
+    # Load tree
+    # pileup=None for the particle gun (effie), otherwise minbias (rates)
+    if replay:
+      tree = RoadsCache(get_cache_dataset(omtf_input, pileup=pileup), bankfile, algo, max_roads=max_roads).load()
+    elif pileup is not None:
+      tree = load_minbias_batch(jobid, pileup=pileup)
+    elif omtf_input:
+      tree = load_pgun_batch_omtf(jobid)
+    else:
+      tree = load_pgun_batch(jobid)
+
+    # Workers
+    bank = PatternBank(bankfile)
+    recog1, recog2 = PatternRecognition(bank, omtf_input=False, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads), PatternRecognition(bank, omtf_input=True, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads)
+    clean = RoadCleaning()
+    slim = RoadSlimming(bank)
+    ptassig1, ptassig2 = PtAssignment(kerasfile, omtf_input=False, run2_input=run2_input), PtAssignment(kerasfile, omtf_input=True, run2_input=run2_input)
+    trkprod1, trkprod2 = TrackProducer(omtf_input=False, run2_input=run2_input), TrackProducer(omtf_input=True, run2_input=run2_input)
+    out_roads = []
+    out_events = []
+
+    # Event range
+    n = -1
+
+    # __________________________________________________________________________
+    # Loop over events
+    for ievt, evt in enumerate(tree):
+      if n != -1 and ievt == n:
+        break
+
+      workers = ((recog1, ptassig1, trkprod1), (recog2, ptassig2, trkprod2))
+      for algo_mode, (recog, ptassig, trkprod) in enumerate(workers):
+        if replay:
+          variables = evt.variables[algo_mode]
+        else:
+          roads = recog.run(evt.hits)
+          clean_roads = clean.run(roads)
+          slim_roads = slim.run(clean_roads)
+          variables = roads_to_variables(slim_roads)
+        variables, predictions, x_mask_vars, x_road_vars = ptassig.run(variables)
+
+        for y, x_mask, x_road in zip(predictions, x_mask_vars, x_road_vars):
+          ndof = trkprod.get_ndof_from_x_mask(x_mask)
+          modes = trkprod.get_modes_from_x_mask(x_mask)
+          strg, zone, theta_median = x_road
+          out_roads.append((ievt, algo_mode, y[0,0], y[0,1], ndof) + tuple(modes) + (strg, zone, theta_median))
+
+      if pileup is None and len(evt.particles) > 0:
+        part = evt.particles[0]  # particle gun
+        out_events.append((ievt, part.pt, part.eta, part.bx))
+      else:
+        out_events.append((ievt, np.nan, np.nan, np.nan))
+
+    # End loop over events
+    unload_tree()
+    recog1.print_road_budget()
+    recog2.print_road_budget()
+
+    # __________________________________________________________________________
+    # Save objects
+    outfile = 'histos_tbf_rates.npz' if pileup is not None else 'histos_tbf_effie.npz'
+    if use_condor:
+      outfile = outfile.replace('.npz', '_%i.npz' % jobid)
+    print('[INFO] Creating file: %s' % outfile)
+    if True:
+      roads = np.array(out_roads, dtype=np.float32).reshape(-1, len(SCAN_ROAD_FIELDS))
+      events = np.array(out_events, dtype=np.float32).reshape(-1, len(SCAN_EVENT_FIELDS))
+      np.savez_compressed(outfile, roads=roads, events=events, road_fields=SCAN_ROAD_FIELDS, event_fields=SCAN_EVENT_FIELDS,
+                          omtf_input=omtf_input)
+
+
+# ______________________________________________________________________________
+# Analysis: profile
+
+# Records how the pattern bank cells (ipt, zone, layer) are used. For each
+# road fired by PatternRecognition, kept by RoadCleaning, or turned into a track
+# (after GhostBusting), the hit offsets (pattern x - road iphi) are stored as
+# one bit mask per layer (bit 0 is offset -23). See prune_pattern_bank.py.
+PROFILE_STAGES = ('fired', 'kept', 'track')
+PROFILE_ROAD_FIELDS = ('event_id', 'stage', 'ipt', 'zone')
+PROFILE_EVENT_FIELDS = ('event_id', 'part_pt', 'part_eta', 'part_bx')
+
+class ProfileAnalysis(object):
+  def _get_offset_masks(self, road_id, hits):
+    iphi = road_id[4]
+    masks = [0] * nlayers
+    for hit in hits:
+      d = find_pattern_x(hit.emtf_phi) - iphi
+      masks[hit.emtf_layer] |= (1 << int(d + PATTERN_X_CENTRAL))
+    return masks
+
+  def run(self, omtf_input=False, run2_input=False, pileup=None):
+    # Load tree
+    # pileup=None for the particle gun (effie), otherwise minbias (rates)
+    if pileup is not None:
+      tree = load_minbias_batch(jobid, pileup=pileup)
+    elif omtf_input:
+      tree = load_pgun_batch_omtf(jobid)
+    else:
+      tree = load_pgun_batch(jobid)
+
+    # Workers
+    bank = PatternBank(bankfile)
+    # Same road budget as in the rates and effie analyses, so that the usage
+    # profile matches what is produced
+    recog1, recog2 = PatternRecognition(bank, omtf_input=False, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads), PatternRecognition(bank, omtf_input=True, run2_input=run2_input, bitmap=bitmap_engine, max_roads=max_roads)
+    clean = RoadCleaning()
+    slim = RoadSlimming(bank)
+    ptassig1, ptassig2 = PtAssignment(kerasfile, omtf_input=False, run2_input=run2_input), PtAssignment(kerasfile, omtf_input=True, run2_input=run2_input)
+    trkprod1, trkprod2 = TrackProducer(omtf_input=False, run2_input=run2_input), TrackProducer(omtf_input=True, run2_input=run2_input)
+    ghost = GhostBusting()
+    out_roads = []
+    out_masks = []
+    out_events = []
+
+    # Event range
+    n = -1
+
+    # __________________________________________________________________________
+    # Loop over events
+    for ievt, evt in enumerate(tree):
+      if n != -1 and ievt == n:
+        break
+
+      tracks = []
+      workers = ((recog1, ptassig1, trkprod1), (recog2, ptassig2, trkprod2))
+      for algo_mode, (recog, ptassig, trkprod) in enumerate(workers):
+        roads = recog.run(evt.hits)
+        clean_roads = clean.run(roads)
+        slim_roads = slim.run(clean_roads)
+        variables = roads_to_variables(slim_roads)
+        variables, predictions, x_mask_vars, x_road_vars = ptassig.run(variables)
+        tracks += trkprod.run(slim_roads, variables, predictions, x_mask_vars, x_road_vars)
+
+        for stage, stage_roads in enumerate((roads, clean_roads)):
+          for road in stage_roads:
+            out_roads.append((ievt, stage, road.id[2], road.id[3]))
+            out_masks.append(self._get_offset_masks(road.id, road.hits))
+
+      # Ghost busting
+      emtf2026_tracks = ghost.run(tracks)
+
+      stage = PROFILE_STAGES.index('track')
+      for trk in emtf2026_tracks:
+        out_roads.append((ievt, stage, trk.id[2], trk.id[3]))  # track id is the road id
+        out_masks.append(self._get_offset_masks(trk.id, trk.hits))
+
+      if pileup is None and len(evt.particles) > 0:
+        part = evt.particles[0]  # particle gun
+        out_events.append((ievt, part.pt, part.eta, part.bx))
+      else:
+        out_events.append((ievt, np.nan, np.nan, np.nan))
+
+    # End loop over events
+    unload_tree()
+
+    # __________________________________________________________________________
+    # Save objects
+    outfile = 'histos_tbg_rates.npz' if pileup is not None else 'histos_tbg_effie.npz'
+    if use_condor:
+      outfile = outfile.replace('.npz', '_%i.npz' % jobid)
+    print('[INFO] Creating file: %s' % outfile)
+    if True:
+      roads = np.array(out_roads, dtype=np.int32).reshape(-1, len(PROFILE_ROAD_FIELDS))
+      masks = np.array(out_masks, dtype=np.uint64).reshape(-1, nlayers)
+      events = np.array(out_events, dtype=np.float32).reshape(-1, len(PROFILE_EVENT_FIELDS))
+      np.savez_compressed(outfile, roads=roads, masks=masks, events=events, stages=PROFILE_STAGES,
+                          road_fields=PROFILE_ROAD_FIELDS, event_fields=PROFILE_EVENT_FIELDS,
+                          omtf_input=omtf_input, bank_hash=get_file_hash(bankfile))
 
 
 # ______________________________________________________________________________
@@ -2033,6 +2860,10 @@ analysis = 'rates'
 #analysis = 'effie'
 #analysis = 'mixing'
 #analysis = 'images'
+#analysis = 'cache'         # roads-only pass for rates, then use 'rates_replay'
+#analysis = 'cache_effie'   # roads-only pass for effie, then use 'effie_replay'
+#analysis = 'scan'          # store road predictions for perf_scan.py (also 'scan_effie')
+#analysis = 'profile'       # pattern bank usage for prune_pattern_bank.py (also 'profile_effie')
 if use_condor:
   analysis = sys.argv[2]
 
@@ -2042,22 +2873,109 @@ if use_condor:
   jobid = int(sys.argv[3])
 
 
+# Checkpoint the state of 'rates' and 'mixing' every N events or every T seconds,
+# whichever comes first. A restarted job resumes from the last checkpoint.
+# Set both to None to disable (the default). The checkpoint is written to the
+# working directory, the condor jdl must use 'when_to_transfer_output = ON_EXIT_OR_EVICT'
+# to get it back after an eviction.
+checkpoint_nevents = None
+checkpoint_seconds = None
+
+# Road budget per (sector, zone) in PatternRecognition, None for no limit
+# Used by 'rates', 'effie', 'scan', 'profile' and the 'cache'/'cache_effie' passes,
+# e.g. to bound the latency at PU250/PU300. The road cache (RoadsCache) is keyed
+# by it. The 'roads' analysis does not use it.
+max_roads = None
+
+# Use the bitmap-dilation engine in PatternRecognition (same roads as the default
+# engine, see benchmark_trackbuilding8.py)
+bitmap_engine = False
+
+
 # Input files
 bankfile = 'pattern_bank_omtf.24.npz'
 
 kerasfile = ['model.24.json', 'model_weights.24.h5', 'model_omtf.24.json', 'model_omtf_weights.24.h5']
 
+# Evaluation of the pT assignment networks (pick one)
+#   'keras'
+#   'sparse': with numpy, the pruned kernels as sparse matrices (see nn_sparse.py)
+#   'fixed': fixed-point emulation of the firmware (see nn_fixed.py)
+inference = 'keras'
+
 infile_r = None  # input file handle
 
-def purge_bad_files(infiles):
-  good_files = []
-  for infile in infiles:
-    try:
-      _ = TreeChain('ntupler/tree', infile)
-      good_files.append(infile)
-    except:
-      pass
-  return good_files
+# Balanced work units (see work_queue.py). When set, jobid is the index of the
+# work unit, and the batch loaders use the files of the unit instead of the
+# static splits.
+workunitsfile = os.environ.get('WORK_UNITS', None)
+
+def get_work_unit(j, dataset):
+  import json
+  with open(workunitsfile) as f:
+    units = json.load(f)
+  if units['dataset'] != dataset:
+    raise RuntimeError('Work units are for dataset {0}, not {1}'.format(units['dataset'], dataset))
+  return units['units'][j]
+
+# Stage the input files of the batch loaders to a local directory, the next
+# stage_nahead files being copied in background threads while the current one
+# is processed. The staged files are removed (least recently used first) when
+# their total size exceeds stage_max_bytes. Set STAGE_DIR to enable.
+stagedir = os.environ.get('STAGE_DIR', None)
+stage_nahead = 2
+stage_max_bytes = 20 << 30
+
+# Local directory standing in for the remote store (for offline tests)
+remote_store = os.environ.get('REMOTE_STORE', None)
+
+# Same usage as TreeChain in the batch loaders (define_collection, iteration),
+# but the files are opened one by one from the local staging directory
+class StagedTreeChain(object):
+  def __init__(self, name, infiles):
+    self.name = name
+    self.infiles = infiles
+    self.collections = []
+
+  def define_collection(self, **kwargs):
+    self.collections.append(kwargs)
+
+  def __iter__(self):
+    from file_staging import StagingCache, Prefetcher
+    cache = StagingCache(stagedir, stage_max_bytes)
+    for infile in Prefetcher(self.infiles, cache, nahead=stage_nahead):
+      with root_open(infile) as f:
+        tree = f.Get(self.name)
+        for kwargs in self.collections:
+          tree.define_collection(**kwargs)
+        for evt in tree:
+          yield evt
+
+def get_tree_chain(infiles):
+  from file_staging import redirect_file
+  infiles = [redirect_file(infile, remote_store) for infile in infiles]
+  if stagedir is not None:
+    return StagedTreeChain('ntupler/tree', infiles)
+  else:
+    return TreeChain('ntupler/tree', infiles)
+
+def is_good_file(infile):
+  try:
+    _ = TreeChain('ntupler/tree', infile)
+    return True
+  except:
+    return False
+
+def purge_bad_files(infiles, nprocs=8):
+  # Open the files concurrently, keep the order
+  from multiprocessing import Pool
+  pool = Pool(processes=nprocs)
+  try:
+    good = pool.map(is_good_file, infiles, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  return [infile for (infile, ok) in zip(infiles, good) if ok]
 
 def load_pgun():
   global infile_r
@@ -2073,17 +2991,26 @@ def load_pgun():
   #tree.define_collection(name='evt_info', prefix='ve_', size='ve_size')
   return tree
 
-def load_pgun_batch(j):
-  #global infile_r
-  #infile_r = root_open('pippo.root', 'w')
-
-  jj = np.split(np.arange(2000), 200)[j]
+def get_pgun_files(jj=None):
+  if jj is None:
+    jj = np.arange(2000)
   infiles = []
   for j in jj:
     infiles.append('root://cmsxrootd-site.fnal.gov//store/group/l1upgrades/L1MuonTrigger/P2_10_4_0/SingleMuon_Endcap_2GeV/ParticleGuns/CRAB3/190207_042919/%04i/ntuple_SingleMuon_Endcap_%i.root' % ((j+1)/1000, (j+1)))
     infiles.append('root://cmsxrootd-site.fnal.gov//store/group/l1upgrades/L1MuonTrigger/P2_10_4_0/SingleMuon_Endcap2_2GeV/ParticleGuns/CRAB3/190207_043023/%04i/ntuple_SingleMuon_Endcap2_%i.root' % ((j+1)/1000, (j+1)))
+  return infiles
 
-  tree = TreeChain('ntupler/tree', infiles)
+def load_pgun_batch(j):
+  #global infile_r
+  #infile_r = root_open('pippo.root', 'w')
+
+  if workunitsfile is not None:
+    infiles = get_work_unit(j, 'pgun')
+  else:
+    jj = np.split(np.arange(2000), 200)[j]
+    infiles = get_pgun_files(jj)
+
+  tree = get_tree_chain(infiles)
   print('[INFO] Opening file: %s' % ' '.join(infiles))
 
   # Define collection
@@ -2107,18 +3034,27 @@ def load_pgun_omtf():
   #tree.define_collection(name='evt_info', prefix='ve_', size='ve_size')
   return tree
 
-def load_pgun_batch_omtf(j):
-  #global infile_r
-  #infile_r = root_open('pippo.root', 'w')
-
-  jj = np.split(np.arange(1000), 100)[j]
+def get_pgun_omtf_files(jj=None):
+  if jj is None:
+    jj = np.arange(1000)
   infiles = []
   for j in jj:
     infiles.append('root://cmsxrootd-site.fnal.gov//store/group/l1upgrades/L1MuonTrigger/P2_10_4_0/SingleMuon_Overlap_3GeV/ParticleGuns/CRAB3/190206_065727/%04i/ntuple_SingleMuon_Overlap_%i.root' % ((j+1)/1000, (j+1)))
     infiles.append('root://cmsxrootd-site.fnal.gov//store/group/l1upgrades/L1MuonTrigger/P2_10_4_0/SingleMuon_Overlap2_3GeV/ParticleGuns/CRAB3/190206_065829/%04i/ntuple_SingleMuon_Overlap2_%i.root' % ((j+1)/1000, (j+1)))
+  return infiles
+
+def load_pgun_batch_omtf(j):
+  #global infile_r
+  #infile_r = root_open('pippo.root', 'w')
+
+  if workunitsfile is not None:
+    infiles = get_work_unit(j, 'pgun_omtf')
+  else:
+    jj = np.split(np.arange(1000), 100)[j]
+    infiles = get_pgun_omtf_files(jj)
 
   #infiles = purge_bad_files(infiles)
-  tree = TreeChain('ntupler/tree', infiles)
+  tree = get_tree_chain(infiles)
   print('[INFO] Opening file: %s' % ' '.join(infiles))
 
   # Define collection
@@ -2128,8 +3064,7 @@ def load_pgun_batch_omtf(j):
   #tree.define_collection(name='evt_info', prefix='ve_', size='ve_size')
   return tree
 
-def load_minbias_batch(j, pileup=200):
-  global infile_r
+def get_minbias_files(pileup=200):
   if pileup == 140:
     pufiles = ['root://cmsxrootd-site.fnal.gov//store/group/l1upgrades/L1MuonTrigger/P2_10_4_0/ntuple_SingleNeutrino_PU140/SingleNeutrino/CRAB3/190209_121318/0000/ntuple_SingleNeutrino_PU140_%i.root' % (i+1) for i in xrange(56)]
   elif pileup == 200:
@@ -2140,11 +3075,21 @@ def load_minbias_batch(j, pileup=200):
     pufiles = ['root://cmsxrootd-site.fnal.gov//store/group/l1upgrades/L1MuonTrigger/P2_10_4_0/ntuple_SingleNeutrino_PU300/SingleNeutrino/CRAB3/190209_121619/0000/ntuple_SingleNeutrino_PU300_%i.root' % (i+1) for i in xrange(53)]
   else:
     raise RunTimeError('Cannot recognize pileup: {0}'.format(pileup))
+  return pufiles
 
-  infile = pufiles[j]
-  infile_r = root_open(infile)
-  tree = infile_r.ntupler.tree
-  print('[INFO] Opening file: %s' % infile)
+def load_minbias_batch(j, pileup=200):
+  global infile_r
+  if workunitsfile is not None:
+    infiles = get_work_unit(j, 'minbias_pu%i' % pileup)
+    tree = get_tree_chain(infiles)
+    print('[INFO] Opening file: %s' % ' '.join(infiles))
+  else:
+    from file_staging import redirect_file
+    pufiles = get_minbias_files(pileup)
+    infile = redirect_file(pufiles[j], remote_store)
+    infile_r = root_open(infile)
+    tree = infile_r.ntupler.tree
+    print('[INFO] Opening file: %s' % infile)
 
   # Define collection
   tree.define_collection(name='hits', prefix='vh_', size='vh_size')
@@ -2153,6 +3098,17 @@ def load_minbias_batch(j, pileup=200):
   tree.define_collection(name='evt_info', prefix='ve_', size='ve_size')
   return tree
 
+def get_dataset_files(dataset):
+  # Datasets: 'pgun', 'pgun_omtf', 'minbias_pu140', 'minbias_pu200', ...
+  if dataset == 'pgun':
+    return get_pgun_files()
+  elif dataset == 'pgun_omtf':
+    return get_pgun_omtf_files()
+  elif dataset.startswith('minbias_pu'):
+    return get_minbias_files(int(dataset[len('minbias_pu'):]))
+  else:
+    raise RuntimeError('Cannot recognize dataset: {0}'.format(dataset))
+
 def load_minbias_batch_for_mixing(j):
   global infile_r
   pufiles = []
@@ -2171,7 +3127,8 @@ def load_minbias_batch_for_mixing(j):
   # For testing purposes (SingleNeutrino, PU200)
   pufiles += ['root://cmsxrootd-site.fnal.gov//store/group/l1upgrades/L1MuonTrigger/P2_10_4_0/ntuple_SingleNeutrino_PU200/SingleNeutrino/CRAB3/190209_121428/0000/ntuple_SingleNeutrino_PU200_%i.root' % (i+1) for i in xrange(30,63)]  # from 30/63
 
-  infile = pufiles[j]
+  from file_staging import redirect_file
+  infile = redirect_file(pufiles[j], remote_store)
   infile_r = root_open(infile)
   tree = infile_r.ntupler.tree
   print('[INFO] Opening file: %s' % infile)
@@ -2195,6 +3152,8 @@ def unload_tree():
 # Main
 
 if __name__ == "__main__":
+  if root_import_error is not None:
+    raise root_import_error
   print('[INFO] Using cmssw     : {0}'.format(os.environ['CMSSW_VERSION']))
   print('[INFO] Using condor    : {0}'.format(use_condor))
   print('[INFO] Using max events: {0}'.format(maxEvents))
@@ -2233,9 +3192,37 @@ if __name__ == "__main__":
     analysis = RatesAnalysis()
     analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=300)
 
+  elif analysis == 'rates_replay':
+    analysis = RatesAnalysis()
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=200, replay=True)
+
   elif analysis == 'effie':
     analysis = EffieAnalysis()
     analysis.run(omtf_input=omtf_input, run2_input=run2_input)
+  elif analysis == 'effie_replay':
+    analysis = EffieAnalysis()
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input, replay=True)
+
+  elif analysis == 'scan':
+    analysis = ScanAnalysis()
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=200)
+  elif analysis == 'scan_effie':
+    analysis = ScanAnalysis()
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
+
+  elif analysis == 'profile':
+    analysis = ProfileAnalysis()
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=200)
+  elif analysis == 'profile_effie':
+    analysis = ProfileAnalysis()
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
+
+  elif analysis == 'cache':
+    analysis = CacheAnalysis()
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=200)
+  elif analysis == 'cache_effie':
+    analysis = CacheAnalysis()
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
 
   elif analysis == 'mixing':
     analysis = MixingAnalysis()
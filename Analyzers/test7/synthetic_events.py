@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""Synthetic events for offline tests and benchmarks of rootpy_trackbuilding8.py.
+
+The hits carry the same fields as the vh_* branches of the ntuples (type,
+station, ring, sector, endcap, emtf_phi, emtf_theta, bend, fr, quality, bx,
+sim_tp1, sim_tp2, ...), so they can be fed directly into PatternRecognition.
+The hit multiplicity per sector is tunable, and scales with the pileup to
+mimic PU140-PU300. Optionally, a muon is added to each event.
+
+This module only depends on numpy.
+"""
+
+import numpy as np
+
+# Enums
+kDT, kCSC, kRPC, kGEM, kME0 = 0, 1, 2, 3, 4
+
+# Chambers: (type, station, ring, min_theta, max_theta, relative occupancy)
+# The theta ranges follow the EMTFZone LUT in rootpy_trackbuilding8.py
+chambers = (
+  (kCSC, 1, 4,   4,  53, 1.0),  # ME1/1a
+  (kCSC, 1, 1,   4,  53, 2.0),  # ME1/1b
+  (kCSC, 1, 2,  46,  88, 1.0),  # ME1/2
+  (kCSC, 1, 3,  98, 125, 0.5),  # ME1/3
+  (kCSC, 2, 1,   4,  49, 2.0),  # ME2/1
+  (kCSC, 2, 2,  53, 111, 1.0),  # ME2/2
+  (kCSC, 3, 1,   4,  40, 2.0),  # ME3/1
+  (kCSC, 3, 2,  44,  96, 1.0),  # ME3/2
+  (kCSC, 4, 1,   4,  35, 2.0),  # ME4/1
+  (kCSC, 4, 2,  38,  90, 1.0),  # ME4/2
+  (kRPC, 1, 2,  52,  84, 0.5),  # RE1/2
+  (kRPC, 1, 3,  80, 120, 0.5),  # RE1/3
+  (kRPC, 2, 2,  56,  88, 0.5),  # RE2/2
+  (kRPC, 2, 3,  76, 112, 0.5),  # RE2/3
+  (kRPC, 3, 1,   4,  36, 1.0),  # RE3/1
+  (kRPC, 3, 2,  40,  84, 0.5),  # RE3/2
+  (kRPC, 3, 3,  40,  92, 0.5),  # RE3/3
+  (kRPC, 4, 1,   4,  31, 1.0),  # RE4/1
+  (kRPC, 4, 2,  36,  84, 0.5),  # RE4/2
+  (kRPC, 4, 3,  36,  84, 0.5),  # RE4/3
+  (kGEM, 1, 1,  16,  52, 1.5),  # GE1/1
+  (kGEM, 2, 1,   7,  46, 1.5),  # GE2/1
+  (kME0, 1, 1,   4,  23, 3.0),  # ME0
+  (kDT , 1, 1,  92, 130, 0.5),  # MB1
+  (kDT , 2, 1, 108, 138, 0.5),  # MB2
+  (kDT , 3, 1, 126, 144, 0.5),  # MB3
+)
+
+hit_fields = ('type', 'station', 'ring', 'sector', 'endcap', 'emtf_phi', 'emtf_theta', 'bend', 'fr',
+              'quality', 'bx', 'sim_tp1', 'sim_tp2', 'pattern', 'wire', 'time', 'neighbor', 'sim_phi', 'sim_theta')
+
+emtf_phi_max = 4920  # (82 deg) * 60
+
+
+# ______________________________________________________________________________
+# Data Formats
+
+class SyntheticHit(object):
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+class SyntheticParticle(object):
+  def __init__(self, pt, eta, phi, q, vx=0., vy=0., vz=0., bx=0):
+    self.pt = pt
+    self.eta = eta
+    self.phi = phi
+    self.q = q
+    self.vx = vx
+    self.vy = vy
+    self.vz = vz
+    self.bx = bx
+    self.theta = 2. * np.arctan(np.exp(-eta))
+
+class SyntheticEvent(object):
+  def __init__(self, hits, particles=None, tracks=None):
+    self.hits = hits
+    self.particles = particles if particles is not None else []
+    self.tracks = tracks if tracks is not None else []  # no legacy EMTF tracks
+
+
+# ______________________________________________________________________________
+# Generator
+
+class SyntheticEventGenerator(object):
+  def __init__(self, pileup=200, hits_per_sector_pu200=40., shape=4., add_muon=False, seed=2026):
+    # The number of hits per sector follows a gamma-Poisson distribution with
+    # mean (hits_per_sector_pu200 * pileup / 200) and a long tail set by shape
+    self.pileup = pileup
+    self.mean_hits = hits_per_sector_pu200 * float(pileup) / 200.
+    self.shape = shape
+    self.add_muon = add_muon
+    self.rng = np.random.RandomState(seed)
+
+    weights = np.array([c[5] for c in chambers], dtype=np.float64)
+    self.chamber_probs = weights / weights.sum()
+
+  def _make_hit(self, chamber, endcap, sector, emtf_phi, emtf_theta, bend, bx, is_muon):
+    (_type, station, ring, min_theta, max_theta, _) = chamber
+    rng = self.rng
+    if _type == kCSC:
+      quality = rng.randint(4, 7)
+      pattern = rng.randint(2, 11)
+    elif _type == kDT:
+      quality = rng.randint(1, 7)
+      pattern = 0
+    elif _type == kRPC:
+      quality = 0
+      pattern = 0
+    else:
+      quality = rng.randint(1, 8)
+      pattern = 0
+    if _type == kDT and rng.rand() < 0.5:
+      wire = -1  # no theta measurement
+    else:
+      wire = rng.randint(0, 100)
+    sim_tp = 0 if is_muon else -1
+    hit = SyntheticHit(type=_type, station=station, ring=ring, sector=sector, endcap=endcap,
+                       emtf_phi=int(emtf_phi), emtf_theta=int(emtf_theta), bend=int(bend), fr=rng.randint(0, 2),
+                       quality=quality, bx=bx, sim_tp1=sim_tp, sim_tp2=sim_tp, pattern=pattern, wire=wire,
+                       time=float(bx) * 25., neighbor=0, sim_phi=0., sim_theta=0.)
+    return hit
+
+  def _make_background(self, endcap, sector):
+    rng = self.rng
+    nhits = rng.poisson(rng.gamma(self.shape, self.mean_hits / self.shape))
+    ichambers = rng.choice(len(chambers), size=nhits, p=self.chamber_probs)
+    hits = []
+    for ichamber in ichambers:
+      chamber = chambers[ichamber]
+      emtf_phi = rng.randint(0, emtf_phi_max)
+      emtf_theta = rng.randint(chamber[3], chamber[4]+1)
+      bend = np.clip(rng.normal(0., 10.), -32, 31)
+      bx = rng.choice((-1, 0, 0, 0, 0, 0, 1))
+      hits.append(self._make_hit(chamber, endcap, sector, emtf_phi, emtf_theta, bend, bx, False))
+    return hits
+
+  def _make_muon(self):
+    # Straight-line approximation: phi is shifted by (q/pT) in each station
+    rng = self.rng
+    endcap = rng.choice((-1, +1))
+    sector = rng.randint(1, 7)
+    q = rng.choice((-1, +1))
+    pt = 1.0 / rng.uniform(1./200, 1./2)
+    emtf_theta = rng.randint(8, 90)
+    emtf_phi0 = rng.randint(1200, 4400)
+    eta = -np.log(np.tan(np.deg2rad(emtf_theta * (45.0-8.5)/128. + 8.5)/2.)) * endcap
+    phi = np.deg2rad(float(emtf_phi0)/60. - 22. + 15. + 60. * (sector-1))
+    part = SyntheticParticle(pt, eta, (phi + np.pi) % (2*np.pi) - np.pi, q)
+
+    dphi_per_station = (0., -600., -750., -850.)  # in emtf_phi unit, per unit of q/pT
+    hits = []
+    for chamber in chambers:
+      (_type, station, ring, min_theta, max_theta, _) = chamber
+      if not (min_theta <= emtf_theta <= max_theta):
+        continue
+      if _type == kCSC and station == 1 and ring == 4:  # ME1/1a and ME1/1b overlap, keep one
+        continue
+      emtf_phi = emtf_phi0 + dphi_per_station[station-1] * (q / pt) * endcap + rng.normal(0., 4.)
+      emtf_phi = np.clip(emtf_phi, 0, emtf_phi_max-1)
+      bend = np.clip(-40. * (q / pt) * endcap * 8., -32, 31)
+      hits.append(self._make_hit(chamber, endcap, sector, emtf_phi, emtf_theta, bend, 0, True))
+    return hits, part
+
+  def generate(self):
+    hits = []
+    particles = []
+    for endcap in (-1, +1):
+      for sector in (1, 2, 3, 4, 5, 6):
+        hits += self._make_background(endcap, sector)
+    if self.add_muon:
+      muon_hits, part = self._make_muon()
+      hits += muon_hits
+      particles.append(part)
+    return SyntheticEvent(hits, particles)
+
+  def __iter__(self):
+    while True:
+      yield self.generate()
+
+  def take(self, n):
+    return [self.generate() for _ in range(n)]
+
+
+# ______________________________________________________________________________
+# Pattern bank
+
+def make_synthetic_bank(outfile, nlayers=16, npt=9, neta=7):
+  # Windows in quadstrip unit, centered at 0 and widening with |ipt - central ipt|.
+  # The arrays have the same format as pattern_bank_*.npz, readable by PatternBank.
+  patterns_phi = np.zeros((npt, neta, nlayers, 3), dtype=np.int32)
+  patterns_match = np.zeros((npt, neta, nlayers, 3), dtype=np.int32)
+  central = npt // 2
+  dphi_per_layer = np.array([0, 0, 1, 2, 2, 0, 1, 2, 2, 0, 1, 0, 1, 2, 3, 3], dtype=np.int32)[:nlayers]
+  for ipt in range(npt):
+    bend = ipt - central
+    for lay in range(nlayers):
+      offset = bend * dphi_per_layer[lay]
+      half_width = 1 + abs(bend) // 2
+      patterns_phi[ipt, :, lay] = (offset - half_width, offset, offset + half_width)
+      patterns_match[ipt, :, lay] = (-64, offset * 32, 64)
+  np.savez_compressed(outfile, patterns_phi=patterns_phi, patterns_match=patterns_match)
+  return outfile
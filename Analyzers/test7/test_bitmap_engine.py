@@ -0,0 +1,39 @@
+"""Tests of the bitmap-dilation engine of PatternRecognition against the
+default engine, on events from synthetic_events.py.
+
+Usage: python -m pytest test_bitmap_engine.py
+"""
+
+import copy
+
+import pytest
+
+import rootpy_trackbuilding8 as tb
+from synthetic_events import SyntheticEventGenerator
+
+
+def summarize(roads):
+  return sorted((road.id, road.mode, road.quality, road.sort_code, road.theta_median,
+                 [(hit.id, hit.emtf_layer, hit.emtf_phi, hit.emtf_theta, hit.emtf_bend, hit.sim_tp) for hit in road.hits]) for road in roads)
+
+@pytest.mark.parametrize('omtf_input', [False, True])
+@pytest.mark.parametrize('pileup', [140, 300])
+def test_same_roads(bankfile, omtf_input, pileup):
+  bank = tb.PatternBank(bankfile)
+  recog1 = tb.PatternRecognition(bank, omtf_input=omtf_input)
+  recog2 = tb.PatternRecognition(bank, omtf_input=omtf_input, bitmap=True)
+  nroads = 0
+  for evt in SyntheticEventGenerator(pileup=pileup, add_muon=True, seed=pileup).take(20):
+    roads1 = summarize(recog1.run(copy.deepcopy(evt.hits)))
+    roads2 = summarize(recog2.run(copy.deepcopy(evt.hits)))
+    assert roads1 == roads2
+    nroads += len(roads1)
+  assert nroads > 0
+
+def test_same_roads_with_budget(bankfile):
+  bank = tb.PatternBank(bankfile)
+  recog1 = tb.PatternRecognition(bank, max_roads=4)
+  recog2 = tb.PatternRecognition(bank, bitmap=True, max_roads=4)
+  for evt in SyntheticEventGenerator(pileup=300, add_muon=True, seed=1).take(10):
+    assert summarize(recog1.run(copy.deepcopy(evt.hits))) == summarize(recog2.run(copy.deepcopy(evt.hits)))
+  assert recog1.n_roads_dropped == recog2.n_roads_dropped > 0
@@ -0,0 +1,59 @@
+"""Tests of the Checkpoint of the rates event loop: save, resume, and the
+configuration key.
+
+Usage: python -m pytest test_checkpoint.py
+"""
+
+import numpy as np
+
+import rootpy_trackbuilding8 as tb
+
+
+def test_checkpoint_roundtrip(tmpdir, bankfile):
+  kerasfile = []
+  for name in ('model.json', 'model_weights.h5'):
+    tmpdir.join(name).write(name)
+    kerasfile.append(str(tmpdir.join(name)))
+  checkpointdir = str(tmpdir.join('checkpoints'))
+
+  def make_checkpoint(**kwargs):
+    kwargs.setdefault('inference', 'keras')
+    return tb.Checkpoint('pgun_0', bankfile, 'default', kerasfile=kerasfile, checkpointdir=checkpointdir, **kwargs)
+
+  # Disabled by default
+  checkpoint = make_checkpoint()
+  assert not checkpoint.enabled
+  assert not checkpoint.due(1000000)
+  assert checkpoint.load() == (0, None)
+
+  accumulator = tb.RatesAccumulator()
+  rng = np.random.RandomState(2026)
+  for ievt in range(50):
+    tracks = [tb.CachedObject(pt=rng.exponential(10.), eta=rng.uniform(-3., 3.), zone=rng.randint(0, 7)) for _ in range(3)]
+    accumulator.fill([], tracks)
+
+  checkpoint = make_checkpoint(nevents=50)
+  assert not checkpoint.due(49)
+  assert checkpoint.due(50)
+  checkpoint.save(50, accumulator.get_state())
+
+  # Resume
+  checkpoint = make_checkpoint(nevents=50)
+  (start, state) = checkpoint.load()
+  assert start == 50
+  restored = tb.RatesAccumulator()
+  restored.set_state(state)
+  for hname, h in accumulator.histograms.items():
+    assert np.array_equal(restored.histograms[hname].counts, h.counts)
+    assert restored.histograms[hname].entries == h.entries
+  assert not checkpoint.due(99)
+  assert checkpoint.due(100)
+
+  # A different configuration does not resume
+  for kwargs in (dict(replay=True), dict(max_roads=20), dict(inference='sparse'), dict(inference='fixed')):
+    assert make_checkpoint(nevents=50, **kwargs).load() == (0, None)
+  tmpdir.join('model.json').write('other')
+  assert make_checkpoint(nevents=50).load() == (0, None)
+
+  checkpoint.remove()
+  assert checkpoint.load() == (0, None)
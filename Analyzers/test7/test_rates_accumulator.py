@@ -0,0 +1,94 @@
+"""Tests of NumpyHist and RatesAccumulator against the original filling of
+the rates histograms, one entry at a time.
+
+Usage: python -m pytest test_rates_accumulator.py
+"""
+
+import numpy as np
+import pytest
+
+import rootpy_trackbuilding8 as tb
+
+
+def find_bin(h, x):
+  # Same as TAxis::FindFixBin(), one value at a time
+  if h.edges is None:
+    if x < h.xmin:
+      return 0
+    if not x < h.xmax:
+      return h.nbins + 1
+    return 1 + int(h.nbins * (x - h.xmin) / (h.xmax - h.xmin))
+  for b in range(len(h.edges)):
+    if x < h.edges[b]:
+      return b
+  return h.nbins + 1
+
+@pytest.mark.parametrize('bins', [(18, 0.75, 2.55), (np.array([0., 1., 2.5, 5., 10., 50.]),)])
+def test_numpy_hist(bins):
+  h = tb.NumpyHist('h', 'h', *bins)
+  rng = np.random.RandomState(1)
+  x = np.concatenate((rng.uniform(h.xmin - 1., h.xmax + 1., size=1000), [h.xmin, h.xmax], np.linspace(h.xmin, h.xmax, 7)))
+  counts = np.zeros((h.nbins+2,), dtype=np.float64)
+  for xx in x:
+    counts[find_bin(h, xx)] += 1
+  h.fill(x)
+  assert np.array_equal(h.counts, counts)
+  assert h.entries == len(x)
+
+# (eta_min, eta_max, include_eta_max, zones) of the regions in RatesAccumulator.region_names
+rates_regions = {
+  'emtf': [(0.8, 2.4, True, None), (1.24, 2.4, True, None), (0.8, 1.24, False, None),
+           (1.24, 1.65, False, None), (1.65, 2.15, False, None), (2.15, 2.4, True, None)],
+  'emtf2026': [(0.8, 2.4, True, (0,1,2,3,4,5,6)), (1.24, 2.4, True, (0,1,2,3,4,5)), (0.8, 1.24, True, (6,)),
+               (1.24, 1.65, True, (0,1,2,3,4,5)), (1.65, 2.15, True, (0,1,2,3,4,5)), (2.15, 2.4, True, (0,1,2,3,4,5))],
+}
+
+def fill_rates(accumulator, counts, old_tracks, new_tracks):
+  # The original loop over the tracks in RatesAnalysis, one entry at a time
+  def fill(hname, x):
+    counts[hname][find_bin(accumulator.histograms[hname], x)] += 1
+
+  def select(m, region, trk):
+    (eta_min, eta_max, include_eta_max, zones) = region
+    if m == 'emtf' and not (trk.bx == 0 and trk.mode in (11,13,14,15)):
+      return False
+    if zones is not None and trk.zone not in zones:
+      return False
+    if include_eta_max:
+      return eta_min <= abs(trk.eta) <= eta_max
+    return eta_min <= abs(trk.eta) < eta_max
+
+  fill('nevents', 1.0)
+  for m, tracks in (('emtf', old_tracks), ('emtf2026', new_tracks)):
+    for r, region in zip(accumulator.region_names, rates_regions[m]):
+      highest_pt = -999999.
+      for trk in tracks:
+        if select(m, region, trk) and highest_pt < trk.pt:
+          highest_pt = trk.pt
+      if highest_pt > 0.:
+        fill('highest_%s_absEtaMin%s_qmin12_pt' % (m,r), min(100.-1e-3, highest_pt))
+    for l in range(14, 22+1):
+      hname = '%s_ptmin%i_qmin12_eta' % (m,l)
+      filled = set()
+      for trk in tracks:
+        ok = (trk.bx == 0 and trk.mode in (11,13,14,15)) if m == 'emtf' else True
+        if ok and abs(trk.eta) <= 9.9 and trk.pt > l:
+          filled.add(find_bin(accumulator.histograms[hname], abs(trk.eta)))
+      for b in filled:
+        counts[hname][b] += 1
+
+def test_rates_accumulator():
+  accumulator = tb.RatesAccumulator()
+  counts = dict((hname, np.zeros_like(h.counts)) for hname, h in accumulator.histograms.items())
+
+  rng = np.random.RandomState(2026)
+  for ievt in range(2000):
+    old_tracks = [tb.CachedObject(pt=rng.exponential(10.), eta=rng.choice([1.24, 1.65, 2.4, rng.uniform(-3., 3.)]),
+                                  bx=rng.choice([0, 0, 0, -1]), mode=rng.choice([15, 14, 11, 7, 3])) for _ in range(rng.poisson(2))]
+    new_tracks = [tb.CachedObject(pt=rng.exponential(10.), eta=rng.choice([0.8, 1.24, 2.15, rng.uniform(-3., 3.)]),
+                                  zone=rng.randint(0, 7)) for _ in range(rng.poisson(2))]
+    accumulator.fill(old_tracks, new_tracks)
+    fill_rates(accumulator, counts, old_tracks, new_tracks)
+
+  for hname, h in accumulator.histograms.items():
+    assert np.array_equal(h.counts, counts[hname]), hname
@@ -0,0 +1,44 @@
+"""Tests of the packed road and hit keys of rootpy_trackbuilding8.py against
+the tuple ids, on events from synthetic_events.py.
+
+Usage: python -m pytest test_road_keys.py
+"""
+
+import copy
+import itertools
+
+import numpy as np
+
+import rootpy_trackbuilding8 as tb
+from synthetic_events import SyntheticEventGenerator
+
+
+def test_road_key_roundtrip():
+  road_ids = list(itertools.product((-1, 1), range(1, 7), range(9), range(7), (0, 33, 100, 144, 154)))
+  keys = [tb.encode_road_id(*road_id) for road_id in road_ids]
+  for key, road_id in zip(keys, road_ids):
+    assert tb.decode_road_id(key) == road_id
+    assert tb.get_road_key_iphi(key) == road_id[4]
+
+  # Same order as the tuples
+  assert sorted(keys) == [tb.encode_road_id(*road_id) for road_id in sorted(road_ids)]
+
+  # Same results with numpy arrays
+  decoded = np.stack(tb.decode_road_id(np.array(keys, dtype=np.int64)), axis=1)
+  assert np.array_equal(decoded, np.array(road_ids))
+
+def test_hit_key_roundtrip():
+  for emtf_layer in range(tb.nlayers):
+    for emtf_phi in (-8192, -1, 0, 1, 4919, 8191):
+      assert tb.decode_hit_key(tb.encode_hit_key(emtf_layer, emtf_phi)) == (emtf_layer, emtf_phi)
+
+def test_road_keys_in_events(bankfile):
+  bank = tb.PatternBank(bankfile)
+  recog = tb.PatternRecognition(bank)
+  for evt in SyntheticEventGenerator(pileup=200, add_muon=True).take(10):
+    roads = recog.run(copy.deepcopy(evt.hits))
+    assert len(roads) > 0
+    assert [road.key for road in roads] == [tb.encode_road_id(*road.id) for road in roads]
+    assert len(set(road.key for road in roads)) == len(set(road.id for road in roads))
+    for road in roads:
+      assert all(hit.key == tb.encode_hit_key(hit.emtf_layer, hit.emtf_phi) for hit in road.hits)
@@ -0,0 +1,53 @@
+"""Tests of the synthetic events and pattern bank of synthetic_events.py.
+
+Usage: python -m pytest test_synthetic_events.py
+"""
+
+import copy
+
+import numpy as np
+import pytest
+
+import rootpy_trackbuilding8 as tb
+from synthetic_events import SyntheticEventGenerator, chambers, hit_fields, emtf_phi_max
+
+
+def test_reproducible():
+  evts1 = SyntheticEventGenerator(pileup=200, add_muon=True, seed=1).take(5)
+  evts2 = SyntheticEventGenerator(pileup=200, add_muon=True, seed=1).take(5)
+  for evt1, evt2 in zip(evts1, evts2):
+    assert [hit.__dict__ for hit in evt1.hits] == [hit.__dict__ for hit in evt2.hits]
+    assert [part.__dict__ for part in evt1.particles] == [part.__dict__ for part in evt2.particles]
+
+def test_hits():
+  theta_ranges = dict(((c[0], c[1], c[2]), (c[3], c[4])) for c in chambers)
+  for evt in SyntheticEventGenerator(pileup=200, add_muon=True, seed=2).take(10):
+    assert len(evt.particles) == 1
+    assert evt.tracks == []
+    nmuon = 0
+    for hit in evt.hits:
+      assert all(hasattr(hit, k) for k in hit_fields)
+      (min_theta, max_theta) = theta_ranges[(hit.type, hit.station, hit.ring)]
+      assert min_theta <= hit.emtf_theta <= max_theta
+      assert 0 <= hit.emtf_phi < emtf_phi_max
+      assert hit.endcap in (-1, +1) and 1 <= hit.sector <= 6
+      if hit.sim_tp1 == 0:
+        nmuon += 1
+    assert nmuon > 0
+
+def test_pileup_scaling():
+  # 12 sectors, hits_per_sector_pu200 hits per sector at PU200
+  for pileup in (140, 300):
+    nhits = [len(evt.hits) for evt in SyntheticEventGenerator(pileup=pileup, seed=3).take(200)]
+    assert np.mean(nhits) == pytest.approx(12 * 40. * pileup / 200., rel=0.1)
+
+def test_bank(bankfile):
+  bank = tb.PatternBank(bankfile)
+  recog = tb.PatternRecognition(bank)
+  evts = SyntheticEventGenerator(pileup=200, add_muon=True, seed=4).take(20)
+  nfound = 0
+  for evt in evts:
+    roads = recog.run(copy.deepcopy(evt.hits))
+    if any(hit.sim_tp for road in roads for hit in road.hits):
+      nfound += 1
+  assert nfound >= 0.9 * len(evts)
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+"""Cost-aware work queue for the rootpy_trackbuilding8.py jobs.
+
+By default, the jobs use static splits of the input files (e.g. 10 particle
+gun files per job id, or one minbias file per job id), regardless of how many
+events or hits each file holds. Here, the input files of a dataset are indexed
+by their number of events and their mean hit multiplicity, and are grouped
+into work units of balanced cost (longest-processing-time-first). A work unit
+is a list of whole files, and the files are not split further.
+
+The work units are written to a json file. The jobs use them when the
+environment variable WORK_UNITS points to that file, and the job id is then
+the index of the work unit. The units can be run by N local worker processes
+that pull from a shared queue (most expensive first), with failed units put
+back in the queue, or be submitted to Condor.
+
+Datasets: 'pgun', 'pgun_omtf', 'minbias_pu140', 'minbias_pu200', ...
+
+Usage:
+  python work_queue.py index  minbias_pu200 [--nprocs 8]
+  python work_queue.py split  minbias_pu200 --njobs 100 [--outfile work_units.json]
+  python work_queue.py local  omtf rates work_units.json [--nworkers 8] [--max-retries 2]
+  python work_queue.py condor omtf rates work_units.json [--outfile rates.jdl] [--executable worker8.sh]
+  python work_queue.py resubmit omtf rates work_units.json
+"""
+
+import argparse
+import glob
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from six.moves import range, queue
+
+
+# ______________________________________________________________________________
+# Settings
+
+# Cost per event, in units of hits (accounts for the per-event overhead)
+cost_per_event = 20.
+
+# Cost per file, in units of hits (accounts for opening the file over xrootd)
+cost_per_file = 2e5
+
+# Number of events read to estimate the mean hit multiplicity of a file
+nsample = 500
+
+# Output files of the analyses, used to find the missing work units. The files of
+# the roads-only passes ('cache', 'cache_effie') are named by RoadsCache in
+# rootpy_trackbuilding8.py, after the work units file hash, the road budget (if
+# any), the algorithm and the pattern bank hash. The names are matched with glob.
+output_files = {
+  'roads'         : 'histos_tba_%(jobid)i.npz',
+  'rates'         : 'histos_tbb_%(jobid)i.root',
+  'rates140'      : 'histos_tbb_%(jobid)i.root',
+  'rates250'      : 'histos_tbb_%(jobid)i.root',
+  'rates300'      : 'histos_tbb_%(jobid)i.root',
+  'rates_replay'  : 'histos_tbb_%(jobid)i.root',
+  'effie'         : 'histos_tbc_%(jobid)i.root',
+  'effie_replay'  : 'histos_tbc_%(jobid)i.root',
+  'scan'          : 'histos_tbf_rates_%(jobid)i.npz',
+  'scan_effie'    : 'histos_tbf_effie_%(jobid)i.npz',
+  'profile'       : 'histos_tbg_rates_%(jobid)i.npz',
+  'profile_effie' : 'histos_tbg_effie_%(jobid)i.npz',
+  'cache'         : 'cache/roads_%(dataset)s_%(jobid)i_wu%(units_hash)s*_%(algo)s_%(bank_hash)s.npz',
+  'cache_effie'   : 'cache/roads_%(dataset)s_%(jobid)i_wu%(units_hash)s*_%(algo)s_%(bank_hash)s.npz',
+}
+
+script = 'rootpy_trackbuilding8.py'
+
+
+# ______________________________________________________________________________
+# Functions
+
+def get_dataset(algo, analysis):
+  # Same input as the analyses in rootpy_trackbuilding8.py
+  if analysis in ('rates', 'rates_replay', 'scan', 'profile', 'cache'):
+    return 'minbias_pu200'
+  elif analysis in ('rates140', 'rates250', 'rates300'):
+    return 'minbias_pu%s' % analysis[len('rates'):]
+  elif analysis in ('roads', 'effie', 'effie_replay', 'scan_effie', 'profile_effie', 'cache_effie'):
+    return 'pgun_omtf' if algo == 'omtf' else 'pgun'
+  else:
+    raise RuntimeError('Cannot use work units for analysis: {0}'.format(analysis))
+
+def get_index_file(dataset):
+  return 'work_index_%s.json' % dataset
+
+def index_file(infile):
+  # Returns (infile, nevents, mean_hits), or (infile, -1, 0.) if the file cannot be read
+  from rootpy.io import root_open
+  try:
+    with root_open(infile) as f:
+      tree = f.ntupler.tree
+      nevents = int(tree.GetEntries())
+      tree.SetBranchStatus('*', 0)
+      tree.SetBranchStatus('vh_size', 1)
+      n = min(nevents, nsample)
+      nhits = 0
+      for i in range(n):
+        tree.GetEntry(i)
+        nhits += tree.vh_size
+      mean_hits = float(nhits) / n if n > 0 else 0.
+  except Exception as e:
+    print('[WARNING] Cannot read file: {0} ({1})'.format(infile, e))
+    return (infile, -1, 0.)
+  return (infile, nevents, mean_hits)
+
+def build_index(dataset, nprocs=8):
+  from rootpy_trackbuilding8 import get_dataset_files
+  infiles = get_dataset_files(dataset)
+
+  # Only index the files that are not in the existing index
+  index = {}
+  fname = get_index_file(dataset)
+  if os.path.isfile(fname):
+    with open(fname) as f:
+      index = json.load(f)
+  todo = [infile for infile in infiles if infile not in index]
+  print('[INFO] Indexing {0} files ({1} already indexed)'.format(len(todo), len(infiles) - len(todo)))
+
+  pool = multiprocessing.Pool(processes=nprocs)
+  try:
+    for i, (infile, nevents, mean_hits) in enumerate(pool.imap_unordered(index_file, todo)):
+      if nevents >= 0:
+        index[infile] = [nevents, mean_hits]
+      if (i+1) % 100 == 0:
+        print('[INFO] Indexed {0}/{1} files'.format(i+1, len(todo)))
+  finally:
+    pool.close()
+    pool.join()
+
+  print('[INFO] Creating file: %s' % fname)
+  with open(fname, 'w') as f:
+    json.dump(index, f, indent=0, sort_keys=True)
+  return index
+
+def get_file_cost(nevents, mean_hits):
+  return cost_per_file + nevents * (cost_per_event + mean_hits)
+
+def split_units(index, njobs):
+  # Longest-processing-time-first: assign the most expensive file to the
+  # cheapest unit so far
+  files = sorted(index.items(), key=lambda x: (-get_file_cost(*x[1]), x[0]))
+  heap = [(0., i) for i in range(njobs)]
+  units = [[] for i in range(njobs)]
+  costs = [0. for i in range(njobs)]
+  for infile, (nevents, mean_hits) in files:
+    cost, i = heapq.heappop(heap)
+    units[i].append(infile)
+    costs[i] = cost + get_file_cost(nevents, mean_hits)
+    heapq.heappush(heap, (costs[i], i))
+
+  # Drop the empty units (if more jobs than files), most expensive first
+  order = sorted([i for i in range(njobs) if units[i]], key=lambda i: -costs[i])
+  return [units[i] for i in order], [costs[i] for i in order]
+
+def load_units(fname):
+  with open(fname) as f:
+    return json.load(f)
+
+def get_file_hash(fname, length=12):
+  # Same as get_file_hash() in rootpy_trackbuilding8.py
+  h = hashlib.md5()
+  with open(fname, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()[:length]
+
+def get_missing_units(algo, analysis, unitsfile, units):
+  if analysis not in output_files:
+    raise RuntimeError('Cannot recognize the output files of analysis: {0}'.format(analysis))
+  fields = dict(dataset=get_dataset(algo, analysis), algo=algo, units_hash=get_file_hash(unitsfile), bank_hash='?' * 12)
+  return [j for j in range(len(units['units'])) if not glob.glob(output_files[analysis] % dict(fields, jobid=j))]
+
+def run_local(algo, analysis, unitsfile, jobids, nworkers=8, max_retries=2):
+  units = load_units(unitsfile)
+  assert(units['dataset'] == get_dataset(algo, analysis))
+
+  # Shared queue, most expensive first so that the tail is made of cheap units
+  q = queue.Queue()
+  for j in sorted(jobids, key=lambda j: -units['costs'][j]):
+    q.put(j)
+
+  env = os.environ.copy()
+  env['CONDOR_EXEC'] = 'work_queue.py'
+  env['WORK_UNITS'] = os.path.abspath(unitsfile)
+
+  if not os.path.isdir('logs'):
+    os.makedirs('logs')
+
+  lock = threading.Lock()
+  attempts = dict((j, 0) for j in jobids)
+  timing = {}
+  failed = []
+
+  def worker():
+    while True:
+      try:
+        j = q.get_nowait()
+      except queue.Empty:
+        return
+      with lock:
+        attempts[j] += 1
+      logfile = os.path.join('logs', 'unit_%s_%i.log' % (analysis, j))
+      t0 = time.time()
+      with open(logfile, 'w') as f:
+        status = subprocess.call([sys.executable, script, algo, analysis, str(j)], stdout=f, stderr=subprocess.STDOUT, env=env)
+      dt = time.time() - t0
+      with lock:
+        if status == 0:
+          timing[j] = dt
+          print('[INFO] Unit {0} done in {1:.1f} s'.format(j, dt))
+        elif attempts[j] <= max_retries:
+          print('[WARNING] Unit {0} failed with status {1} (attempt {2}), re-queued. See {3}'.format(j, status, attempts[j], logfile))
+          q.put(j)
+        else:
+          print('[ERROR] Unit {0} failed with status {1} (attempt {2}). See {3}'.format(j, status, attempts[j], logfile))
+          failed.append(j)
+
+  t_start = time.time()
+  threads = [threading.Thread(target=worker) for _ in range(nworkers)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  t_total = time.time() - t_start
+
+  if timing:
+    times = sorted(timing.values())
+    mean = sum(times) / len(times)
+    print('[INFO] {0} units done, {1} failed, wall time: {2:.1f} s'.format(len(timing), len(failed), t_total))
+    print('[INFO] Unit time: mean {0:.1f} s, max {1:.1f} s, max/mean {2:.2f}'.format(mean, times[-1], times[-1] / mean))
+  return sorted(failed)
+
+def write_jdl(algo, analysis, unitsfile, jobids, outfile, executable, tarball='default.tgz'):
+  # Same layout as rates.jdl and effie.jdl. The executable must forward its
+  # arguments (algo, analysis, jobid) to rootpy_trackbuilding8.py, and set
+  # WORK_UNITS to the transferred units file, e.g. worker8.sh (not worker.sh,
+  # which runs rootpy_trackbuilding7.py)
+  if not os.path.isfile(executable):
+    raise RuntimeError('Cannot find executable: {0}'.format(executable))
+  lines = [
+    '# Automatically generated on {0} by work_queue.py'.format(time.strftime('%a %b %d %H:%M:%S %Z %Y')),
+    'universe = vanilla',
+    'should_transfer_files = YES',
+    'when_to_transfer_output = ON_EXIT_OR_EVICT',  # keep the checkpoints of evicted jobs
+    '',
+    'executable = {0}'.format(executable),
+    'transfer_input_files = {0},{1}'.format(tarball, unitsfile),
+    'environment = "WORK_UNITS={0}"'.format(os.path.basename(unitsfile)),  # in the scratch directory
+    'output = logs/job_$(Cluster)_$(Process).out',
+    'error = logs/job_$(Cluster)_$(Process).err',
+    'log = logs/job_$(Cluster)_$(Process).log',
+    '',
+    '+ProjectName = cms.org.ufl',
+    '',
+  ]
+  for j in jobids:
+    lines.append('arguments = {0} {1} {2}'.format(algo, analysis, j))
+    lines.append('queue 1')
+  print('[INFO] Creating file: %s' % outfile)
+  with open(outfile, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Cost-aware work queue for rootpy_trackbuilding8.py')
+  subparsers = parser.add_subparsers(dest='command')
+
+  p = subparsers.add_parser('index', help='index the input files of a dataset')
+  p.add_argument('dataset')
+  p.add_argument('--nprocs', type=int, default=8)
+
+  p = subparsers.add_parser('split', help='build balanced work units')
+  p.add_argument('dataset')
+  p.add_argument('--njobs', type=int, required=True)
+  p.add_argument('--outfile', default=None)
+
+  for command in ('local', 'condor', 'resubmit'):
+    p = subparsers.add_parser(command)
+    p.add_argument('algo')
+    p.add_argument('analysis')
+    p.add_argument('unitsfile')
+    p.add_argument('--outfile', default=None, help='jdl file (condor, resubmit)')
+    p.add_argument('--executable', default='worker8.sh', help='Condor executable (condor, resubmit)')
+    p.add_argument('--nworkers', type=int, default=8, help='local worker processes (local, resubmit --local)')
+    p.add_argument('--max-retries', type=int, default=2)
+    if command == 'resubmit':
+      p.add_argument('--local', action='store_true', help='run the missing units locally')
+  args = parser.parse_args()
+
+  if args.command == 'index':
+    build_index(args.dataset, nprocs=args.nprocs)
+
+  elif args.command == 'split':
+    fname = get_index_file(args.dataset)
+    if not os.path.isfile(fname):
+      raise RuntimeError('Cannot find index file: {0}. Run the index command first.'.format(fname))
+    with open(fname) as f:
+      index = json.load(f)
+    units, costs = split_units(index, args.njobs)
+    mean = sum(costs) / len(costs)
+    print('[INFO] {0} files in {1} units, cost max/mean: {2:.3f}'.format(len(index), len(units), max(costs) / mean))
+    outfile = args.outfile or 'work_units_%s.json' % args.dataset
+    print('[INFO] Creating file: %s' % outfile)
+    with open(outfile, 'w') as f:
+      json.dump(dict(dataset=args.dataset, units=units, costs=costs), f, indent=0)
+
+  elif args.command == 'local':
+    units = load_units(args.unitsfile)
+    failed = run_local(args.algo, args.analysis, args.unitsfile, range(len(units['units'])),
+                       nworkers=args.nworkers, max_retries=args.max_retries)
+    sys.exit(1 if failed else 0)
+
+  elif args.command == 'condor':
+    units = load_units(args.unitsfile)
+    assert(units['dataset'] == get_dataset(args.algo, args.analysis))
+    outfile = args.outfile or '%s.jdl' % args.analysis
+    write_jdl(args.algo, args.analysis, args.unitsfile, range(len(units['units'])), outfile, args.executable)
+
+  elif args.command == 'resubmit':
+    units = load_units(args.unitsfile)
+    missing = get_missing_units(args.algo, args.analysis, args.unitsfile, units)
+    print('[INFO] Missing units: {0}'.format(' '.join(map(str, missing)) or 'none'))
+    if missing:
+      if args.local:
+        failed = run_local(args.algo, args.analysis, args.unitsfile, missing,
+                           nworkers=args.nworkers, max_retries=args.max_retries)
+        sys.exit(1 if failed else 0)
+      else:
+        outfile = args.outfile or '%s_resubmit.jdl' % args.analysis
+        write_jdl(args.algo, args.analysis, args.unitsfile, missing, outfile, args.executable)
+
+  else:
+    parser.print_help()
+    sys.exit(1)
@@ -0,0 +1,102 @@
+#!/usr/bin/env bash
+
+# Worker for rootpy_trackbuilding8.py, based on worker.sh
+# Usage: worker8.sh ALGO ANALYSIS JOBID
+# If WORK_UNITS names a work units file (see work_queue.py) transferred with
+# the job, JOBID is the index of the work unit.
+export HOME=`pwd` 
+
+# The SCRAM architecture and CMSSW version of the submission environment.
+readonly SUBMIT_SCRAM_ARCH="slc6_amd64_gcc630"
+readonly SUBMIT_CMSSW_VERSION="CMSSW_10_1_7"
+
+# Capture the executable name and job input file from the command line.
+readonly CONDOR_EXEC="$(basename $0)"
+export CONDOR_EXEC
+readonly TARBALL="default.tgz"
+readonly ALGO="$1"
+readonly ANALYSIS="$2"
+readonly JOBID="$3"
+
+
+echo "$(date) - $CONDOR_EXEC - INFO - condor_scratch: $_CONDOR_SCRATCH_DIR"
+echo "$(date) - $CONDOR_EXEC - INFO - pwd: $PWD"
+echo "$(date) - $CONDOR_EXEC - INFO - args: $ALGO $ANALYSIS $JOBID"
+
+echo "$(date) - $CONDOR_EXEC - INFO - Unpacking files"
+tar xzf $TARBALL
+
+echo "$(date) - $CONDOR_EXEC - INFO - Setting up $SUBMIT_CMSSW_VERSION"
+
+# Setup the CMS software environment.
+export SCRAM_ARCH="$SUBMIT_SCRAM_ARCH"
+source /cvmfs/cms.cern.ch/cmsset_default.sh
+
+# Checkout the CMSSW release and set the runtime environment. These
+# commands are often invoked by their aliases "cmsrel" and "cmsenv".
+#scram project CMSSW "$SUBMIT_CMSSW_VERSION"
+cd "$SUBMIT_CMSSW_VERSION/src"
+#scramv1 b ProjectRename
+eval "$(scramv1 runtime -sh)"
+
+echo $CMSSW_RELEASE_BASE
+echo $CMSSW_BASE
+which python
+echo $HOME
+#XDG_CACHE_HOME=$_CONDOR_SCRATCH_DIR/.cache
+
+echo "$(date) - $CONDOR_EXEC - INFO - Setting up virtualenv"
+#source venv/bin/activate
+
+# Change back to the worker node's scratch directory.
+cd "$_CONDOR_SCRATCH_DIR"
+
+echo "$(date) - $CONDOR_EXEC - INFO - pwd: $PWD"
+
+echo "$(date) - $CONDOR_EXEC - INFO - ls: -"
+ls -a
+
+# Do Science
+echo "$(date) - $CONDOR_EXEC - INFO - Stand back I'm going to try Science!"
+
+# The work units file is transferred to the scratch directory
+if [ -n "$WORK_UNITS" ]; then
+  export WORK_UNITS="$_CONDOR_SCRATCH_DIR/$(basename $WORK_UNITS)"
+  echo "$(date) - $CONDOR_EXEC - INFO - work units: $WORK_UNITS"
+  if [ ! -f "$WORK_UNITS" ]; then
+    echo "$(date) - $CONDOR_EXEC - ERROR - cannot find work units file: $WORK_UNITS"
+    exit 1
+  fi
+fi
+
+echo "python rootpy_trackbuilding8.py $ALGO $ANALYSIS $JOBID"
+
+python rootpy_trackbuilding8.py $ALGO $ANALYSIS $JOBID
+
+EXIT_STATUS=$?
+ERROR_TYPE=""
+ERROR_MESSAGE="This is an error message."
+
+echo "$(date) - $CONDOR_EXEC - INFO - Postprocessing"
+
+# Prepare reports
+if [ $EXIT_STATUS -ne 0 ]; then
+  cat << EOF > FrameworkJobReport.xml
+<FrameworkJobReport>
+<FrameworkError ExitStatus="$EXIT_STATUS" Type="$ERROR_TYPE" >
+$ERROR_MESSAGE
+</FrameworkError>
+</FrameworkJobReport>
+EOF
+fi
+
+# Clean up
+tar tzf $TARBALL | xargs rm -rf
+rm -rf $TARBALL
+rm -rf *.pyc
+
+echo "$(date) - $CONDOR_EXEC - INFO - ls: -"
+ls -l
+
+echo "$(date) - $CONDOR_EXEC - INFO - Science complete!"
+exit $EXIT_STATUS
\ No newline at end of file